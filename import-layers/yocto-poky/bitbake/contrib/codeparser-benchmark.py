@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Parse the recipes of the build directory the script is run from, collect
+# the shell functions in them as bb.data.build_dependencies() would see them
+# and report how fast bb.codeparser gets through them with an empty cache,
+# with the full pysh parser only, with and without the templates shared
+# between recipes, and once the cache is warm. With --check the commands
+# found through bb.pysh.pyshscan and through the templates are compared
+# against parsing each function on its own with the full parser.
+#
+import os
+import sys
+import time
+import logging
+import optparse
+
+# For importing bb.codeparser
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.tinfoil
+import bb.cache
+import bb.codeparser
+from bb.pysh import pyshyacc, pyshlex, sherrors
+
+logger = logging.getLogger("BitBake.Benchmark")
+
+class Expansions(dict):
+    """What the expressions in a function expanded to in its recipe, which
+    is all bb.codeparser.shell_template() asks the datastore for"""
+    def expand(self, s):
+        return self[s]
+
+class FullShellParser(bb.codeparser.ShellParser):
+    """ShellParser always using the full pysh parser"""
+    def _parse_shell(self, value):
+        try:
+            tokens, _ = pyshyacc.parse(value, eof=True, debug=False)
+        except pyshlex.NeedMore:
+            raise sherrors.ShellSyntaxError("Unexpected EOF")
+        for token in tokens:
+            self.process_tokens(token)
+
+def collect_functions(tinfoil, layers, limit):
+    cooker = tinfoil.cooker
+    cooker.collection = bb.cooker.CookerCollectFiles(cooker.recipecache.bbfile_config_priorities)
+    bbfiles, _ = cooker.collection.collect_bbfiles(cooker.data, cooker.expanded_data)
+    if layers:
+        dirs = [l for l in (cooker.data.getVar("BBLAYERS", True) or "").split()
+                if os.path.basename(l) in layers]
+        bbfiles = [f for f in bbfiles if any(f.startswith(l + "/") for l in dirs)]
+    if limit:
+        bbfiles = bbfiles[:limit]
+
+    functions = []
+    recipes = 0
+    for fn in bbfiles:
+        try:
+            datastores = bb.cache.Cache.load_bbfile(fn, cooker.collection.get_file_appends(fn),
+                                                    tinfoil.config_data)
+        except Exception:
+            continue
+        recipes += 1
+        for d in datastores.values():
+            for key in d.keys():
+                if not d.getVarFlag(key, "func", False) or d.getVarFlag(key, "python", False):
+                    continue
+                body = d.getVar(key, False)
+                if not body:
+                    continue
+                try:
+                    expansions = Expansions()
+                    for match in bb.codeparser.expansion_regexp.finditer(body):
+                        expansions[match.group()] = d.expand(match.group())
+                    functions.append((key, body, d.expand(body), expansions))
+                except Exception:
+                    pass
+    return recipes, functions
+
+def clear_cache():
+    for cache in bb.codeparser.codeparsercache.cachedata + bb.codeparser.codeparsercache.cachedata_extras:
+        cache.clear()
+
+def parse(functions, templates, parserclass):
+    errors = 0
+    start = time.time()
+    for key, body, code, expansions in functions:
+        parser = parserclass(key, logger)
+        try:
+            if templates:
+                parser.parse_shell(code, body, expansions)
+            else:
+                parser.parse_shell(code)
+        except Exception:
+            errors += 1
+    return time.time() - start, errors
+
+def commands(parser, code):
+    try:
+        parser._parse_shell(code)
+    except Exception as exc:
+        return exc.__class__.__name__
+    return sorted(parser.allexecs), sorted(parser.funcdefs)
+
+def check(functions):
+    differences = 0
+    checked = set()
+    for key, body, code, expansions in functions:
+        if code in checked:
+            continue
+        checked.add(code)
+        reference = FullShellParser(key, logger)
+        result = commands(reference, code)
+        scanned = commands(bb.codeparser.ShellParser(key, logger), code)
+        if scanned != result:
+            differences += 1
+            print("%s: %s scanned, %s parsed" % (key, scanned, result))
+            continue
+
+        execs = bb.codeparser.ShellParser(key, logger).parse_template(body, code, expansions)
+        if execs is None:
+            continue
+        if set(execs) != reference.allexecs - reference.funcdefs:
+            differences += 1
+            print("%s: %s through the template, %s parsed" %
+                  (key, sorted(execs), sorted(reference.allexecs - reference.funcdefs)))
+    return differences, len(checked)
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("-l", "--layers", default = "",
+                      help = "Only use the recipes of these layers (directory names, e.g. \"meta meta-phosphor\")")
+    parser.add_option("-n", "--recipes", type = "int", default = 0,
+                      help = "Only use the first n recipes")
+    parser.add_option("-c", "--check", action = "store_true", default = False,
+                      help = "Check the results from pyshscan and from templates against the full parser")
+    options, args = parser.parse_args(sys.argv[1:])
+
+    tinfoil = bb.tinfoil.Tinfoil()
+    try:
+        tinfoil.prepare(config_only = True)
+        start = time.time()
+        recipes, functions = collect_functions(tinfoil, options.layers.split(), options.recipes)
+        print("Collected %d shell functions (%d distinct, %d distinct before expansion) from %d recipes in %.1fs" %
+              (len(functions), len(set(f[2] for f in functions)), len(set(f[1] for f in functions)),
+               recipes, time.time() - start))
+
+        for name, templates, parserclass in (("cold, full parser", False, FullShellParser),
+                                             ("cold, no templates", False, bb.codeparser.ShellParser),
+                                             ("cold", True, bb.codeparser.ShellParser),
+                                             ("warm", True, bb.codeparser.ShellParser)):
+            if name.startswith("cold"):
+                clear_cache()
+            spent, errors = parse(functions, templates, parserclass)
+            print("%-20s %.3fs (%.0f functions/s), %d errors" % (name, spent, len(functions) / spent, errors))
+            if name == "cold":
+                codeparsercache = bb.codeparser.codeparsercache
+                templatecache = codeparsercache.templatecacheextras
+                print("%20s %d templates (%d usable), %d functions parsed on their own" %
+                      ("", len(templatecache), len([t for t in templatecache.values() if t]),
+                       len(codeparsercache.shellcacheextras)))
+
+        if options.check:
+            clear_cache()
+            print("%d of %d distinct functions differ" % check(functions))
+    finally:
+        tinfoil.shutdown()
+
+if __name__ == "__main__":
+    sys.exit(main())
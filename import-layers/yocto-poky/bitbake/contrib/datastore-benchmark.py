@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Parse recipes from the current build directory and report how much time
+# went into the datastore: the number of getVar, setVar and createCopy calls
+# and the time spent in them and in working out the task signatures from the
+# variable dependencies, then the time taken to read every variable of each
+# recipe through a chain of copies as task execution does. Recipes are
+# given as file names or recipe names (e.g. obmc-phosphor-image); without
+# any, every recipe in BBFILES is parsed.
+#
+import os
+import sys
+import time
+import optparse
+
+# For importing bb
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.tinfoil
+import bb.cache
+import bb.data
+import bb.data_smart
+import bb.siggen
+
+class CallStats(object):
+    """
+    Count calls to and time spent in a function or method, not counting
+    the time of calls it makes to itself
+    """
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.calls = 0
+        self.time = 0.0
+        self.depth = 0
+        self.orig = getattr(owner, name)
+
+        stats = self
+        orig = self.orig
+        def wrapper(*args, **kwargs):
+            stats.calls += 1
+            if stats.depth:
+                return orig(*args, **kwargs)
+            stats.depth += 1
+            start = time.time()
+            try:
+                return orig(*args, **kwargs)
+            finally:
+                stats.time += time.time() - start
+                stats.depth -= 1
+        setattr(owner, name, wrapper)
+
+    def restore(self):
+        setattr(self.owner, self.name, self.orig)
+
+def find_recipes(tinfoil, names):
+    cooker = tinfoil.cooker
+    cooker.collection = bb.cooker.CookerCollectFiles(cooker.recipecache.bbfile_config_priorities)
+    bbfiles, _ = cooker.collection.collect_bbfiles(cooker.data, cooker.expanded_data)
+    if not names:
+        return bbfiles
+
+    found = []
+    for name in names:
+        if os.path.exists(name):
+            found.append(os.path.abspath(name))
+            continue
+        matches = [fn for fn in bbfiles if os.path.basename(fn).split("_")[0].split(".bb")[0] == name]
+        if not matches:
+            sys.stderr.write("No recipe found for %s\n" % name)
+            sys.exit(1)
+        found.append(matches[-1])
+    return found
+
+def read_all(d, depth):
+    for _ in xrange(depth):
+        d = bb.data.createCopy(d)
+    for key in d.keys():
+        d.getVar(key, False)
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options] [recipe ...]")
+    parser.add_option("-d", "--depth", type = "int", default = 3,
+                      help = "Number of copies to read the variables through (default 3)")
+    parser.add_option("-r", "--repeat", type = "int", default = 1,
+                      help = "Number of times to parse each recipe (default 1)")
+    options, args = parser.parse_args(sys.argv[1:])
+
+    tinfoil = bb.tinfoil.Tinfoil()
+    try:
+        tinfoil.prepare(config_only = True)
+        recipes = find_recipes(tinfoil, args)
+
+        stats = [CallStats(bb.data_smart.DataSmart, name) for name in ("getVar", "setVar", "createCopy")]
+        stats.append(CallStats(bb.data, "generate_dependencies"))
+        stats.append(CallStats(bb.data, "dependency_closures"))
+        stats.append(CallStats(bb.siggen.SignatureGeneratorBasic, "_build_data"))
+        datastores = []
+        start = time.time()
+        for _ in xrange(options.repeat):
+            datastores = []
+            for fn in recipes:
+                appends = tinfoil.cooker.collection.get_file_appends(fn)
+                datastores.extend(bb.cache.Cache.load_bbfile(fn, appends, tinfoil.config_data).values())
+        parsetime = time.time() - start
+        for s in stats:
+            s.restore()
+
+        print("Parsed %d recipes %d times in %.3fs" % (len(recipes), options.repeat, parsetime))
+        for s in stats:
+            print("  %-21s %9d calls %8.3fs" % (s.name, s.calls, s.time))
+
+        start = time.time()
+        for d in datastores:
+            read_all(d, options.depth)
+        readtime = time.time() - start
+        print("Read every variable of %d datastores through %d copies in %.3fs" %
+              (len(datastores), options.depth, readtime))
+    finally:
+        tinfoil.shutdown()
+
+if __name__ == "__main__":
+    sys.exit(main())
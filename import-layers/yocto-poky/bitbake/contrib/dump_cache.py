@@ -18,7 +18,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 #
-# This is used for dumping the bb_cache.dat, the output format is:
+# This is used for dumping the bb_cache.dat, the argument is the data file
+# (its .idx index is expected next to it), the output format is:
 # recipe_path PN PV PACKAGES
 #
 import os
@@ -27,10 +28,9 @@ import warnings
 
 # For importing bb.cache
 sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.cache
 from bb.cache import CoreRecipeInfo
 
-import cPickle as pickle
-
 def main(argv=None):
     """
     Get the mapping for the target recipe.
@@ -39,29 +39,27 @@ def main(argv=None):
         print >>sys.stderr, "Error, need one argument!"
         return 2
 
-    cachefile = argv[0]
+    cachefile = bb.cache.RecipeInfoFile(argv[0])
+    reason = cachefile.load()
+    if reason:
+        print >>sys.stderr, "Error, %s" % reason
+        return 1
 
-    with open(cachefile, "rb") as cachefile:
-        pickled = pickle.Unpickler(cachefile)
-        while cachefile:
-            try:
-                key = pickled.load()
-                val = pickled.load()
-            except Exception:
-                break
-            if isinstance(val, CoreRecipeInfo) and (not val.skipped):
-                pn = val.pn
-                # Filter out the native recipes.
-                if key.startswith('virtual:native:') or pn.endswith("-native"):
-                    continue
+    for key in sorted(cachefile.index):
+        val = cachefile.get(key)
+        if isinstance(val, CoreRecipeInfo) and (not val.skipped):
+            pn = val.pn
+            # Filter out the native recipes.
+            if key.startswith('virtual:native:') or pn.endswith("-native"):
+                continue
 
-                # 1.0 is the default version for a no PV recipe.
-                if val.__dict__.has_key("pv"):
-                    pv = val.pv
-                else:
-                    pv = "1.0"
+            # 1.0 is the default version for a no PV recipe.
+            if val.__dict__.has_key("pv"):
+                pv = val.pv
+            else:
+                pv = "1.0"
 
-                print("%s %s %s %s" % (key, pn, pv, ' '.join(val.packages)))
+            print("%s %s %s %s" % (key, pn, pv, ' '.join(val.packages)))
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv[1:]))
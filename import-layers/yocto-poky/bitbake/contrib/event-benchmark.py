@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Register a number of class event handlers, most of them with an event
+# mask as addhandler handlers from layers usually have, and report how many
+# events bb.event.fire_class_handlers() gets through per second, both for
+# events nothing subscribes to and for ones some handlers do.
+#
+import os
+import sys
+import time
+import optparse
+
+# For importing bb.event
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.event
+import bb.data
+
+class BenchmarkEvent(bb.event.Event):
+    """An event nothing subscribes to"""
+
+class SubscribedEvent(bb.event.Event):
+    """An event every handler with a mask subscribes to"""
+
+def register_handlers(count, catchall):
+    masks = ["bb.event.ConfigParsed", "bb.event.BuildStarted", "bb.build.TaskStarted",
+             "bb.runqueue.runQueueTaskStarted", "bb.event.BuildCompleted"]
+    calls = [0]
+    def handler(e):
+        calls[0] += 1
+
+    for i in xrange(count):
+        if i < catchall:
+            mask = None
+        else:
+            mask = [masks[i % len(masks)], "__main__.SubscribedEvent"]
+        bb.event.register("benchmark_handler_%d" % i, handler, mask)
+    return calls
+
+def fire(eventclass, count, d):
+    start = time.time()
+    for _ in xrange(count):
+        bb.event.fire_class_handlers(eventclass(), d)
+    return time.time() - start
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("-H", "--handlers", type = "int", default = 100,
+                      help = "Number of handlers to register (default 100)")
+    parser.add_option("-c", "--catchall", type = "int", default = 0,
+                      help = "Number of those registered without a mask (default 0)")
+    parser.add_option("-n", "--events", type = "int", default = 100000,
+                      help = "Number of events of each kind to fire (default 100000)")
+    options, args = parser.parse_args(sys.argv[1:])
+
+    d = bb.data.init()
+    calls = register_handlers(options.handlers, options.catchall)
+    print("Registered %d handlers, %d of them without a mask" % (options.handlers, options.catchall))
+
+    for eventclass in (BenchmarkEvent, SubscribedEvent):
+        calls[0] = 0
+        spent = fire(eventclass, options.events, d)
+        print("%-16s %d events in %.3fs (%.0f events/s, %d handler calls)" %
+              (eventclass.__name__, options.events, spent, options.events / spent, calls[0]))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Hammer one bb.persist_data domain from many processes at once, the way
+# parse workers look up and store BB_URI_HEADREVS, and report how many
+# operations per second they get through. Each process looks keys up,
+# mostly ones already stored, and stores the ones it does not find; with
+# --batch the stores are grouped into transactions of that many. The
+# database starts out empty in a temporary directory, and its contents are
+# checked at the end.
+#
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import optparse
+import multiprocessing
+
+# For importing bb.persist_data
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.persist_data
+
+class Config(object):
+    """Just enough of a datastore for bb.persist_data.persist()"""
+    def __init__(self, persistdir):
+        self.persistdir = persistdir
+
+    def getVar(self, var, expand=False):
+        if var == "PERSISTENT_DIR":
+            return self.persistdir
+        return None
+
+def worker(persistdir, number, options, results):
+    rand = random.Random(number)
+    d = Config(persistdir)
+    errors = 0
+    start = time.time()
+    pending = {}
+    for i in xrange(options.operations):
+        if rand.random() < options.writes:
+            key = "%d-%d" % (number, i)
+        else:
+            key = "shared-%d" % rand.randrange(options.keys)
+        try:
+            # As FetchMethod.latest_revision() does
+            revs = bb.persist_data.persist("BB_URI_HEADREVS", d)
+            try:
+                revs[key]
+            except KeyError:
+                if options.batch:
+                    pending[key] = "rev-%s" % key
+                    if len(pending) >= options.batch:
+                        with revs:
+                            for k, v in pending.iteritems():
+                                revs[k] = v
+                        pending = {}
+                else:
+                    revs[key] = "rev-%s" % key
+        except Exception as exc:
+            errors += 1
+    if pending:
+        revs = bb.persist_data.persist("BB_URI_HEADREVS", d)
+        with revs:
+            for k, v in pending.iteritems():
+                revs[k] = v
+    results.put((time.time() - start, errors))
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("-p", "--processes", type = "int", default = 8,
+                      help = "Number of processes (default 8)")
+    parser.add_option("-n", "--operations", type = "int", default = 2000,
+                      help = "Number of lookups each process makes (default 2000)")
+    parser.add_option("-w", "--writes", type = "float", default = 0.1,
+                      help = "Fraction of the lookups for keys no other process uses (default 0.1)")
+    parser.add_option("-k", "--keys", type = "int", default = 200,
+                      help = "Number of keys the processes share (default 200)")
+    parser.add_option("-b", "--batch", type = "int", default = 0,
+                      help = "Store the keys not found in transactions of this many")
+    options, args = parser.parse_args(sys.argv[1:])
+
+    persistdir = tempfile.mkdtemp(prefix = "persist-data-")
+    try:
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target = worker, args = (persistdir, i, options, results))
+                   for i in xrange(options.processes)]
+        start = time.time()
+        for w in workers:
+            w.start()
+        spent = []
+        errors = 0
+        for w in workers:
+            s, e = results.get()
+            spent.append(s)
+            errors += e
+        elapsed = time.time() - start
+        for w in workers:
+            w.join()
+
+        revs = bb.persist_data.persist("BB_URI_HEADREVS", Config(persistdir))
+        items = revs.items()
+        wrong = len([k for k, v in items if v != "rev-%s" % k])
+        duplicates = len(items) - len(set(k for k, v in items))
+    finally:
+        shutil.rmtree(persistdir)
+
+    operations = options.processes * options.operations
+    print("%d processes made %d lookups in %.3fs (%.0f lookups/s), slowest process %.3fs, %d errors" %
+          (options.processes, operations, elapsed, operations / elapsed, max(spent), errors))
+    print("%d keys stored, %d with a wrong value, %d stored more than once" %
+          (len(items), wrong, duplicates))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Simulate many build tasks asking a PR server for PR values at the same
+# time, as do_package does, and report the throughput and latency of the
+# calls. Each client is a separate process with its own connection. Some of
+# the checksums asked for are new, the others were asked for before, by the
+# same client or another one. Without --remote a server with an empty
+# database is started in a temporary directory, and stopped afterwards.
+# The values handed out are checked for consistency at the end: the value
+# of a checksum may only go up, and no two checksums of the same version
+# may get the same value.
+#
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import optparse
+import multiprocessing
+
+# For importing prserv
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import prserv.serv
+
+def client(host, port, number, options, results):
+    rand = random.Random(number)
+    conn = prserv.serv.PRServerConnection(host, port)
+    queries = []
+    for i in xrange(options.calls):
+        version = "1.0-r0-%d" % rand.randrange(options.versions)
+        if i and rand.random() < options.repeat:
+            # Ask for a checksum some client asked for already
+            checksum = "%d-%d" % (rand.randrange(options.clients), rand.randrange(i))
+        else:
+            checksum = "%d-%d" % (number, i)
+        queries.append((version, "core2-64", checksum))
+
+    latencies = []
+    values = []
+    errors = 0
+    step = options.batch or 1
+    for i in xrange(0, len(queries), step):
+        batch = queries[i:i + step]
+        start = time.time()
+        try:
+            if options.batch:
+                answers = conn.getPRs(batch)
+            else:
+                answers = [conn.getPR(*batch[0])]
+        except Exception:
+            answers = [None] * len(batch)
+        latencies.append(time.time() - start)
+        for query, value in zip(batch, answers):
+            if value is None:
+                errors += 1
+            else:
+                values.append((query, value))
+    results.put((latencies, values, errors))
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def check(clientvalues):
+    """Count the values lower than the one a client got earlier for the
+    same checksum, and the values given to several checksums of the same
+    version"""
+    decreased = 0
+    byvalue = {}
+    for values in clientvalues:
+        last = {}
+        for query, value in values:
+            if value < last.get(query, value):
+                decreased += 1
+            last[query] = value
+            version, pkgarch, checksum = query
+            byvalue.setdefault((version, pkgarch, value), set()).add(checksum)
+    return decreased, len([v for v in byvalue if len(byvalue[v]) > 1])
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("-r", "--remote", help = "Use the PR server at host:port rather than starting one")
+    parser.add_option("-c", "--clients", type = "int", default = 20,
+                      help = "Number of clients (default 20)")
+    parser.add_option("-n", "--calls", type = "int", default = 200,
+                      help = "Number of PR values each client asks for (default 200)")
+    parser.add_option("-b", "--batch", type = "int", default = 0,
+                      help = "Ask for this many values per getPRs call rather than calling getPR for each")
+    parser.add_option("-p", "--repeat", type = "float", default = 0.3,
+                      help = "Fraction of the checksums asked for which were asked for before (default 0.3)")
+    parser.add_option("-v", "--versions", type = "int", default = 50,
+                      help = "Number of versions the checksums are spread over (default 50)")
+    options, args = parser.parse_args(sys.argv[1:])
+
+    tempdir = None
+    if options.remote:
+        host, port = options.remote.split(":")
+        port = int(port)
+    else:
+        tempdir = tempfile.mkdtemp(prefix = "prserv-load-")
+        server = prserv.serv.PRServer(os.path.join(tempdir, "prserv.sqlite3"),
+                                      os.path.join(tempdir, "prserv.log"), ("localhost", 0),
+                                      daemon = False)
+        server.start()
+        host, port = server.getinfo()
+        # Wait for the server to open its database
+        prserv.serv.PRServerConnection(host, port).ping()
+
+    try:
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target = client, args = (host, port, i, options, results))
+                   for i in xrange(options.clients)]
+        start = time.time()
+        for c in clients:
+            c.start()
+        latencies, clientvalues, errors = [], [], 0
+        for c in clients:
+            l, v, e = results.get()
+            latencies += l
+            clientvalues.append(v)
+            errors += e
+        spent = time.time() - start
+        for c in clients:
+            c.join()
+    finally:
+        if not options.remote:
+            prserv.serv.PRServerConnection(host, port).terminate()
+            time.sleep(0.5)
+            shutil.rmtree(tempdir)
+
+    latencies.sort()
+    values = sum(len(v) for v in clientvalues)
+    print("%d clients got %d values in %d calls in %.3fs (%.0f values/s), %d errors" %
+          (options.clients, values, len(latencies), spent, values / spent, errors))
+    print("Latency: mean %.1fms, median %.1fms, 95%% %.1fms, max %.1fms" %
+          (1000 * sum(latencies) / len(latencies), 1000 * percentile(latencies, 0.5),
+           1000 * percentile(latencies, 0.95), 1000 * latencies[-1]))
+    print("Inconsistencies: %d values went down, %d values were given to several checksums" %
+          check(clientvalues))
+
+if __name__ == "__main__":
+    sys.exit(main())
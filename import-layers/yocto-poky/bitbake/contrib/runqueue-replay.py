@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Replay a recorded task graph (the task-depends.dot written by
+# "bitbake -g <target>") through the runqueue schedulers and report how
+# long the scheduling decisions took and how long the build would take.
+# Task durations come from the task resource history of an earlier build
+# (bb_task_resources.dat in the PERSISTENT_DIR given with -H); without it
+# every task takes one time unit. BB_NUMBER_THREADS is set with -j.
+#
+import os
+import sys
+import re
+import time
+import heapq
+import shutil
+import tempfile
+import optparse
+
+# For importing bb.runqueue
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.runqueue
+import bb.siggen
+import bb.parse
+import bb.data
+
+class ReplayTaskData(object):
+    def __init__(self):
+        self.fn_index = []
+
+class ReplayDataCache(object):
+    def __init__(self):
+        self.stamp = {}
+        self.stamp_extrainfo = {}
+        self.pkg_fn = {}
+
+class ReplayData(object):
+    """
+    Enough of RunQueueData for the schedulers, built from task-depends.dot
+    """
+    def __init__(self, dotfile, stampdir):
+        self.taskData = ReplayTaskData()
+        self.dataCache = ReplayDataCache()
+        self.runq_fnid = []
+        self.runq_task = []
+        self.runq_depends = []
+        self.runq_revdeps = []
+        self.names = []
+
+        node_re = re.compile(r'^"([^"]+)" \[label="[^"]*\\n([^"\\]*)"\]$')
+        edge_re = re.compile(r'^"([^"]+)" -> "([^"]+)"$')
+
+        taskids = {}
+        fnids = {}
+        edges = []
+        with open(dotfile) as f:
+            for line in f:
+                line = line.strip()
+                m = node_re.match(line)
+                if m:
+                    name, fn = m.groups()
+                    pn, taskname = name.rsplit(".", 1)
+                    if fn not in fnids:
+                        fnids[fn] = len(self.taskData.fn_index)
+                        self.taskData.fn_index.append(fn)
+                        self.dataCache.stamp[fn] = os.path.join(stampdir, pn)
+                        self.dataCache.stamp_extrainfo[fn] = {}
+                        self.dataCache.pkg_fn[fn] = pn
+                    taskids[name] = len(self.names)
+                    self.names.append(name)
+                    self.runq_fnid.append(fnids[fn])
+                    self.runq_task.append(taskname)
+                    self.runq_depends.append(set())
+                    self.runq_revdeps.append(set())
+                    continue
+                m = edge_re.match(line)
+                if m:
+                    edges.append(m.groups())
+
+        for task, dep in edges:
+            if task not in taskids or dep not in taskids:
+                continue
+            self.runq_depends[taskids[task]].add(taskids[dep])
+            self.runq_revdeps[taskids[dep]].add(taskids[task])
+
+        endpoints = [task for task in xrange(len(self.names)) if not self.runq_revdeps[task]]
+        self.runq_weight = bb.runqueue.RunQueueData.calculate_task_weights.im_func(self, endpoints)
+
+class ReplayStats(object):
+    def __init__(self):
+        self.active = 0
+
+class ReplayQueue(object):
+    """
+    Stand-in for RunQueueExecuteTasks which runs every task for as long as
+    it took in the recorded build, or one time unit
+    """
+    def __init__(self, rqdata, threads, cfgData, taskhistory):
+        self.rqdata = rqdata
+        self.cfgData = cfgData
+        self.taskhistory = taskhistory
+        self.durations = None
+        if taskhistory:
+            self.durations = taskhistory.task_durations(rqdata)
+        if not self.durations:
+            self.durations = [1] * len(rqdata.runq_fnid)
+        self.number_tasks = threads
+        self.stats = ReplayStats()
+        numtasks = len(rqdata.runq_fnid)
+        self.runq_running = [0] * numtasks
+        self.runq_complete = [0] * numtasks
+        self.runq_buildable = [0] * numtasks
+        for task in xrange(numtasks):
+            if not rqdata.runq_depends[task]:
+                self.runq_buildable[task] = 1
+        self.build_stamps = {}
+        self.build_stamps2 = set()
+
+    def replay(self, scheduler):
+        start = time.time()
+        self.sched = scheduler(self, self.rqdata)
+        setup = time.time() - start
+
+        spent = 0.0
+        decisions = 0
+        now = 0
+        running = []
+        while True:
+            while True:
+                before = time.time()
+                task = self.sched.next()
+                spent += time.time() - before
+                decisions += 1
+                if task is None:
+                    break
+                self.runq_running[task] = 1
+                self.build_stamps[task] = self.sched.stamps[task]
+                self.build_stamps2.add(self.build_stamps[task])
+                self.stats.active += 1
+                heapq.heappush(running, (now + self.durations[task], task))
+
+            if not running:
+                break
+
+            now, task = heapq.heappop(running)
+            self.stats.active -= 1
+            self.build_stamps2.discard(self.build_stamps.pop(task))
+            self.runq_complete[task] = 1
+            for revdep in self.rqdata.runq_revdeps[task]:
+                if self.runq_buildable[revdep]:
+                    continue
+                if all(self.runq_complete[dep] for dep in self.rqdata.runq_depends[revdep]):
+                    self.runq_buildable[revdep] = 1
+                    before = time.time()
+                    self.sched.newbuilable(revdep)
+                    spent += time.time() - before
+
+        return setup, spent, decisions, now
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options] task-depends.dot")
+    parser.add_option("-j", "--threads", type = "int", default = 8,
+                      help = "Number of tasks to run in parallel (default 8)")
+    parser.add_option("-s", "--scheduler", action = "append", default = [],
+                      help = "Scheduler to replay (default: all built in schedulers)")
+    parser.add_option("-H", "--history", metavar = "DIR",
+                      help = "PERSISTENT_DIR of the build to take task durations from")
+    options, args = parser.parse_args(sys.argv[1:])
+    if len(args) != 1:
+        parser.error("need the task-depends.dot file to replay")
+
+    schedulers = set(obj for obj in bb.runqueue.__dict__.values()
+                         if type(obj) is type and
+                            issubclass(obj, bb.runqueue.RunQueueScheduler))
+    if options.scheduler:
+        schedulers = [s for s in schedulers if s.name in options.scheduler]
+
+    stampdir = tempfile.mkdtemp(prefix = "runqueue-replay")
+    try:
+        bb.parse.siggen = bb.siggen.SignatureGenerator(None)
+        cfgData = bb.data.init()
+        taskhistory = None
+        if options.history:
+            cfgData.setVar("PERSISTENT_DIR", options.history)
+            taskhistory = bb.runqueue.TaskResourceHistory(cfgData)
+            if not taskhistory.history:
+                parser.error("no task history found in %s" % options.history)
+        rqdata = ReplayData(args[0], stampdir)
+        print("Replaying %d tasks from %d recipes with %d threads" %
+              (len(rqdata.names), len(rqdata.taskData.fn_index), options.threads))
+        for scheduler in sorted(schedulers, key = lambda s: s.name):
+            rq = ReplayQueue(rqdata, options.threads, cfgData, taskhistory)
+            setup, spent, decisions, walltime = rq.replay(scheduler)
+            if taskhistory:
+                predicted = "predicted wall time %.1fs" % walltime
+            else:
+                predicted = "%d steps" % walltime
+            print("%-12s setup %.3fs, %d decisions in %.3fs (%.1fus each), %s" %
+                  (scheduler.name, setup, decisions, spent, spent * 1e6 / max(decisions, 1), predicted))
+    finally:
+        shutil.rmtree(stampdir)
+
+if __name__ == "__main__":
+    sys.exit(main())
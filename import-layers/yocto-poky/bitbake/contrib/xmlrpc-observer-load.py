@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Simulate many observer-only clients (as Toaster and "--observe-only" UIs
+# are) reading variables from a bitbake xmlrpc server while the client
+# owning it keeps changing the configuration, and report how long the
+# observers' calls took. Without --remote a server is started for the
+# build directory the script is run from, and stopped afterwards; -a starts
+# it with --async-server.
+#
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+import optparse
+
+# For importing bb.server.xmlrpc
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import bb.server.xmlrpc
+
+def connect(host, port, token):
+    server, transport = bb.server.xmlrpc._create_server(host, port)
+    transport.set_connection_token(token)
+    return server
+
+def observer(host, port, variables, calls, latencies, errors):
+    server = connect(host, port, "observer")
+    for i in xrange(calls):
+        command = ["getVariable", variables[i % len(variables)]]
+        start = time.time()
+        try:
+            _, error = server.runCommand(command)
+        except Exception as exc:
+            error = str(exc)
+        latencies.append(time.time() - start)
+        if error:
+            errors.append(error)
+
+def writer(host, port, token, done, writes, errors):
+    server = connect(host, port, token)
+    count = 0
+    while not done.is_set():
+        for command in (["setVariable", "OBSERVER_LOAD_TEST", str(count)],
+                        ["getVariable", "OBSERVER_LOAD_TEST"]):
+            _, error = server.runCommand(command)
+            if error:
+                errors.append(error)
+        count += 1
+    writes.append(count)
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server(port, concurrent):
+    bitbake = os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../bin/bitbake')
+    cmd = [bitbake, "--server-only", "-t", "xmlrpc", "-B", "localhost:%d" % port]
+    if concurrent:
+        cmd.append("--async-server")
+    subprocess.check_call(cmd)
+    server = connect("localhost", port, None)
+    # Wait for the configuration to be parsed
+    token = server.addClient()
+    connect("localhost", port, token).runCommand(["getVariable", "TOPDIR"])
+    connect("localhost", port, token).removeClient()
+
+def stop_server(host, port):
+    server = connect(host, port, None)
+    token = server.addClient()
+    connect(host, port, token).terminateServer()
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("-r", "--remote", help = "Use the server at host:port rather than starting one")
+    parser.add_option("-a", "--async-server", action = "store_true", default = False,
+                      help = "Start the server with --async-server")
+    parser.add_option("-n", "--observers", type = "int", default = 50,
+                      help = "Number of observers (default 50)")
+    parser.add_option("-c", "--calls", type = "int", default = 100,
+                      help = "Number of calls each observer makes (default 100)")
+    parser.add_option("-w", "--writers", type = "int", default = 1,
+                      help = "Number of threads of the owning client changing the configuration meanwhile (default 1)")
+    parser.add_option("-v", "--variables", default = "TOPDIR MACHINE DISTRO BBPATH BB_NUMBER_THREADS",
+                      help = "Variables the observers read")
+    options, args = parser.parse_args(sys.argv[1:])
+
+    if options.remote:
+        host, port = options.remote.split(":")
+        port = int(port)
+    else:
+        host, port = "localhost", free_port()
+        start_server(port, options.async_server)
+
+    try:
+        token = None
+        if options.writers:
+            token = connect(host, port, None).addClient()
+            if token is None:
+                sys.stderr.write("The server already has a client, use -w 0\n")
+                return 1
+
+        latencies = []
+        errors = []
+        writes = []
+        done = threading.Event()
+        writers = [threading.Thread(target = writer, args = (host, port, token, done, writes, errors))
+                   for _ in xrange(options.writers)]
+        observers = [threading.Thread(target = observer, args = (host, port, options.variables.split(),
+                                                                 options.calls, latencies, errors))
+                     for _ in xrange(options.observers)]
+        for t in writers:
+            t.start()
+        start = time.time()
+        for t in observers:
+            t.start()
+        for t in observers:
+            t.join()
+        spent = time.time() - start
+        done.set()
+        for t in writers:
+            t.join()
+        if token:
+            connect(host, port, token).removeClient()
+    finally:
+        if not options.remote:
+            stop_server(host, port)
+
+    latencies.sort()
+    print("%d observers made %d calls in %.3fs (%.0f calls/s), %d errors" %
+          (options.observers, len(latencies), spent, len(latencies) / spent, len(errors)))
+    print("Latency: mean %.1fms, median %.1fms, 95%% %.1fms, max %.1fms" %
+          (1000 * sum(latencies) / len(latencies), 1000 * percentile(latencies, 0.5),
+           1000 * percentile(latencies, 0.95), 1000 * latencies[-1]))
+    if options.writers:
+        print("Configuration changed %d times meanwhile" % sum(writes))
+    for error in sorted(set(errors))[:5]:
+        print("Error: %s" % error)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -133,16 +133,56 @@ class TaskInvalid(TaskBase):
         super(TaskInvalid, self).__init__(task, None, metadata)
         self._message = "No such task '%s'" % task
 
+class TaskProgress(event.Event):
+    """Output of a running task so far: the number of lines and the last one"""
+    def __init__(self, lines, lastline):
+        self.lines = lines
+        self.lastline = lastline
+        event.Event.__init__(self)
+
 
 class LogTee(object):
+    """
+    Write output to a log file and pass it on to a logger as well. What is
+    written within interval seconds, up to maxsize bytes, is passed on at
+    once, as whole lines, since each record becomes an event for the server
+    and the UI.
+    """
+    interval = 0.5
+    maxsize = 65536
+
     def __init__(self, logger, outfile):
         self.outfile = outfile
         self.logger = logger
         self.name = self.outfile.name
+        self.pending = []
+        self.pendingsize = 0
+        self.sent = 0
 
     def write(self, string):
-        self.logger.plain(string)
         self.outfile.write(string)
+        self.pending.append(string)
+        self.pendingsize += len(string)
+        now = time.time()
+        if self.pendingsize >= self.maxsize or now - self.sent >= self.interval:
+            self.sent = now
+            data = "".join(self.pending)
+            end = data.rfind("\n")
+            if end >= 0:
+                self.logger.plain(data[:end])
+                data = data[end + 1:]
+            self.pending = [data] if data else []
+            self.pendingsize = len(data)
+
+    def send(self):
+        if self.pending:
+            data = "".join(self.pending)
+            if data.endswith("\n"):
+                data = data[:-1]
+            self.logger.plain(data)
+            self.pending = []
+            self.pendingsize = 0
+            self.sent = time.time()
 
     def __enter__(self):
         self.outfile.__enter__()
@@ -154,6 +194,52 @@ class LogTee(object):
     def __repr__(self):
         return '<LogTee {0}>'.format(self.name)
     def flush(self):
+        self.send()
+        self.outfile.flush()
+
+class LogSummary(object):
+    """
+    Write output to a log file, firing a TaskProgress event at most every
+    interval seconds rather than passing the output on
+    """
+    interval = 1
+
+    def __init__(self, outfile, d):
+        self.outfile = outfile
+        self.d = d
+        self.name = self.outfile.name
+        self.lines = 0
+        self.lastline = ""
+        self.sentlines = 0
+        self.sent = 0
+
+    def write(self, string):
+        self.outfile.write(string)
+        self.lines += string.count("\n")
+        string = string.rstrip("\n")
+        if string:
+            self.lastline = string[string.rfind("\n") + 1:]
+        if time.time() - self.sent >= self.interval:
+            self.send()
+
+    def send(self):
+        if self.lines != self.sentlines:
+            event.fire(TaskProgress(self.lines, self.lastline[:200]), self.d)
+            self.sentlines = self.lines
+            self.sent = time.time()
+
+    def __enter__(self):
+        self.outfile.__enter__()
+        return self
+
+    def __exit__(self, *excinfo):
+        self.outfile.__exit__(*excinfo)
+
+    def __repr__(self):
+        return '<LogSummary {0}>'.format(self.name)
+
+    def flush(self):
+        self.send()
         self.outfile.flush()
 
 #
@@ -331,10 +417,14 @@ exit $ret
         if fakerootcmd:
             cmd = [fakerootcmd, runfile]
 
-    if bb.msg.loggerDefaultVerbose:
+    # What else than the log file gets the output of the command
+    output = d.getVar('BB_TASK_OUTPUT', True) or "tee"
+    if output == "summary":
+        logfile = LogSummary(sys.stdout, d)
+    elif output == "tee" and bb.msg.loggerDefaultVerbose:
         logfile = LogTee(logger, sys.stdout)
     else:
-        logfile = sys.stdout
+        logfile = None
 
     def readfifo(data):
         lines = data.split('\0')
@@ -376,7 +466,14 @@ exit $ret
 
             try:
                 with open(os.devnull, 'r+') as stdin:
-                    bb.process.run(cmd, shell=False, stdin=stdin, log=logfile, extrafiles=[(fifo,readfifo)])
+                    if logfile:
+                        bb.process.run(cmd, shell=False, stdin=stdin, log=logfile, extrafiles=[(fifo,readfifo)])
+                    else:
+                        # Nothing to pass on, let the command write to the
+                        # log file itself
+                        sys.stdout.flush()
+                        bb.process.run(cmd, shell=False, stdin=stdin, stdout=sys.stdout, log=sys.stdout,
+                                       extrafiles=[(fifo,readfifo)])
             except bb.process.CmdError:
                 logfn = d.getVar('BB_LOGFILE', True)
                 raise FuncFailed(func, logfn)
@@ -31,6 +31,9 @@
 
 import os
 import logging
+import mmap
+import struct
+import binascii
 from collections import defaultdict
 import bb.utils
 
@@ -43,11 +46,45 @@ except ImportError:
     logger.info("Importing cPickle failed. "
                 "Falling back to a very slow implementation.")
 
-__cache_version__ = "149"
+__cache_version__ = "151"
+
+# Fraction of a cache data file allowed to be dead space (superseded or
+# removed records) before sync() compacts it instead of appending
+CACHE_COMPACT_RATIO = 0.5
 
 def getCacheFile(path, filename, data_hash):
     return os.path.join(path, filename + "." + data_hash)
 
+# Snapshot of the configuration datastore: (data, structural hash, digest
+# per variable, bit per variable). Taken by Cache before any parser
+# processes are forked and before parsing modifies the datastore.
+_config_snapshot = (None, None, {}, {})
+
+def config_snapshot(configdata):
+    global _config_snapshot
+    # The datastore keeps its digests up to date as it is written to, so
+    # this is cheap enough to repeat for each Cache. The bits only need
+    # renumbering when the set of variables, part of the structure, changes.
+    config_hash, digests = configdata.get_hash_components()
+    data, old_hash, _, varbits = _config_snapshot
+    if data is not configdata or old_hash != config_hash:
+        varbits = dict((var, 1 << i) for i, var in enumerate(sorted(digests)))
+    _config_snapshot = (configdata, config_hash, digests, varbits)
+    return _config_snapshot[1:]
+
+def config_read_mask(configdata, reads):
+    """
+    Convert the configuration variables read while parsing into a bitmask,
+    or -1 (everything) if the configuration hasn't been indexed
+    """
+    data, _, _, varbits = _config_snapshot
+    if data is not configdata:
+        return -1
+    mask = 0
+    for var in reads:
+        mask |= varbits.get(var, 0)
+    return mask
+
 # RecipeInfoCommon defines common data retrieving methods
 # from meta data for caches. CoreRecipeInfo as well as other
 # Extra RecipeInfo needs to inherit this class
@@ -94,6 +131,10 @@ class CoreRecipeInfo(RecipeInfoCommon):
 
     cachefile = "bb_cache.dat"   
 
+    # Bitmask of the configuration variables (see config_read_mask) the
+    # parse read; all bits set means any configuration change invalidates
+    configmask = -1
+
     def __init__(self, filename, metadata):      
         self.file_depends = metadata.getVar('__depends', False)
         self.timestamp = bb.parse.cached_mtime(filename)
@@ -251,6 +292,229 @@ class CoreRecipeInfo(RecipeInfoCommon):
         cachedata.extradepsfunc[fn] = self.extradepsfunc
 
 
+class RecipeInfoFile(object):
+    """
+    On-disk store for one RecipeInfoCommon class
+
+    The records live in an append-only data file of individually pickled
+    RecipeInfo objects. A separate index file maps each cache key to the
+    (offset, length) of its current record, so loading only needs the
+    index; the data file is mmapped and records are unpickled on demand.
+    Superseded and removed records are left in place as dead space until
+    it exceeds CACHE_COMPACT_RATIO of the file, at which point the live
+    records are copied (without being decoded) into a fresh data file.
+    """
+
+    def __init__(self, cachefile):
+        self.cachefile = cachefile
+        self.indexfile = cachefile + ".idx"
+        self.close()
+
+    def close(self):
+        if getattr(self, "map", None):
+            self.map.close()
+        self.map = None
+        self.index = {}
+        self.generation = None
+        self.datasize = 0
+        self.deadsize = 0
+        self.meta = {}
+
+    def load(self):
+        """
+        Read the index and map the data file, returning a reason string
+        if the on-disk cache can't be used
+        """
+        try:
+            with open(self.indexfile, "rb") as f:
+                p = pickle.Unpickler(f)
+                header = p.load()
+                cache_ver, bitbake_ver = header[0], header[1]
+                if cache_ver != __cache_version__:
+                    return "Cache version mismatch"
+                if bitbake_ver != bb.__version__:
+                    return "Bitbake version mismatch"
+                generation, datasize, deadsize = header[2:]
+                index = p.load()
+                meta = p.load()
+        except Exception:
+            return "Invalid cache"
+
+        try:
+            with open(self.cachefile, "rb") as f:
+                # Anything past datasize is an interrupted append the index
+                # never referenced
+                if os.fstat(f.fileno()).st_size < datasize:
+                    return "Truncated cache"
+                if datasize:
+                    self.map = mmap.mmap(f.fileno(), datasize, access=mmap.ACCESS_READ)
+        except (IOError, OSError, mmap.error):
+            return "Invalid cache"
+
+        self.index = index
+        self.meta = meta
+        self.generation = generation
+        self.datasize = datasize
+        self.deadsize = deadsize
+        return None
+
+    def raw(self, key):
+        offset, length = self.index[key]
+        return self.map[offset:offset + length]
+
+    def get(self, key):
+        return pickle.loads(self.raw(key))
+
+    def write(self, live, changed, removed):
+        """
+        Persist the cache. live maps every key to keep to either a
+        RecipeInfo object (parsed this session) or None (unchanged, still
+        in the index); changed and removed are the keys which differ from
+        what was loaded. The meta dict is stored alongside the index.
+        """
+        glf = bb.utils.lockfile(self.cachefile + ".lock")
+        try:
+            ondisk = None
+            try:
+                with open(self.indexfile, "rb") as f:
+                    ondisk = pickle.load(f)[2]
+            except Exception:
+                pass
+
+            deadsize = self.deadsize
+            for key in changed | removed:
+                if key in self.index:
+                    deadsize += self.index[key][1]
+
+            # Only append if nobody else rewrote the files since we read them
+            if ondisk is not None and ondisk == self.generation and \
+                    deadsize <= CACHE_COMPACT_RATIO * self.datasize:
+                index, datasize = self._append(live, changed)
+            else:
+                index, datasize = self._rewrite(live)
+                deadsize = 0
+
+            generation = binascii.hexlify(os.urandom(8))
+            tmpfile = self.indexfile + ".tmp.%s" % os.getpid()
+            with open(tmpfile, "wb") as f:
+                p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+                p.dump((__cache_version__, bb.__version__, generation, datasize, deadsize))
+                p.dump(index)
+                p.dump(self.meta)
+            os.rename(tmpfile, self.indexfile)
+        finally:
+            bb.utils.unlockfile(glf)
+
+        self.close()
+
+    def _append(self, live, changed):
+        index = dict((key, self.index[key]) for key in live if key not in changed)
+        with open(self.cachefile, "r+b") as f:
+            f.seek(self.datasize)
+            f.truncate()
+            offset = self.datasize
+            for key in changed:
+                if key not in live:
+                    continue
+                record = pickle.dumps(live[key], pickle.HIGHEST_PROTOCOL)
+                f.write(record)
+                index[key] = (offset, len(record))
+                offset += len(record)
+        return index, offset
+
+    def _rewrite(self, live):
+        index = {}
+        offset = 0
+        tmpfile = self.cachefile + ".tmp.%s" % os.getpid()
+        with open(tmpfile, "wb") as f:
+            for key, info in live.iteritems():
+                if info is None:
+                    record = self.raw(key)
+                else:
+                    record = pickle.dumps(info, pickle.HIGHEST_PROTOCOL)
+                f.write(record)
+                index[key] = (offset, len(record))
+                offset += len(record)
+        os.rename(tmpfile, self.cachefile)
+        return index, offset
+
+class RecipeInfoCache(object):
+    """
+    Mapping of cache key to info_array (one entry per RecipeInfoFile),
+    lazily backed by the on-disk cache files
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.infos = {}
+        self.changed = set()
+        self.removed = set()
+
+    def ondisk(self, key):
+        if key in self.removed or not self.files:
+            return False
+        for f in self.files:
+            if key not in f.index:
+                return False
+        return True
+
+    def __contains__(self, key):
+        return key in self.infos or self.ondisk(key)
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        keys = set(self.infos)
+        if self.files:
+            keys.update(key for key in self.files[0].index if self.ondisk(key))
+        return keys
+
+    def core(self, key):
+        """Return only the CoreRecipeInfo for key, decoding nothing else"""
+        if key not in self.infos:
+            if not self.ondisk(key):
+                raise KeyError(key)
+            self.infos[key] = [None] * len(self.files)
+        info_array = self.infos[key]
+        if info_array[0] is None:
+            info_array[0] = self.files[0].get(key)
+        return info_array[0]
+
+    def __getitem__(self, key):
+        self.core(key)
+        info_array = self.infos[key]
+        for i, f in enumerate(self.files):
+            if info_array[i] is None:
+                info_array[i] = f.get(key)
+        return info_array
+
+    def __setitem__(self, key, info_array):
+        self.infos[key] = info_array
+        self.changed.add(key)
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.infos.pop(key, None)
+        self.changed.discard(key)
+        self.removed.add(key)
+
+    def sync(self):
+        keys = self.keys()
+        for i, f in enumerate(self.files):
+            live = {}
+            for key in keys:
+                if key in self.changed:
+                    live[key] = self.infos[key][i]
+                else:
+                    live[key] = None
+            f.write(live, self.changed, self.removed)
+        self.infos = {}
+        self.changed = set()
+        self.removed = set()
+
 
 class Cache(object):
     """
@@ -265,11 +529,14 @@ class Cache(object):
         self.cachedir = data.getVar("CACHE", True)
         self.clean = set()
         self.checked = set()
-        self.depends_cache = {}
+        self.depends_cache = RecipeInfoCache([])
         self.data = None
         self.data_fn = None
         self.cacheclean = True
         self.data_hash = data_hash
+        self.config_changed = 0
+        # Seconds each recipe took to parse last time, used to schedule parsing
+        self.parse_times = {}
 
         if self.cachedir in [None, '']:
             self.has_cache = False
@@ -278,80 +545,60 @@ class Cache(object):
             return
 
         self.has_cache = True
-        self.cachefile = getCacheFile(self.cachedir, "bb_cache.dat", self.data_hash)
+
+        # The cache files are named after the structure of the configuration
+        # only; entries survive changes to variable values and are checked
+        # against the variables they read instead (see cacheValidUpdate)
+        self.config_hash, self.config_digests, self.config_varbits = config_snapshot(data)
+
+        self.cachefile = getCacheFile(self.cachedir, "bb_cache.dat", self.config_hash)
 
         logger.debug(1, "Using cache in '%s'", self.cachedir)
         bb.utils.mkdirhier(self.cachedir)
 
         cache_ok = True
+        cachefiles = []
         if self.caches_array:
             for cache_class in self.caches_array:
                 if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                    cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                    cache_ok = cache_ok and os.path.exists(cachefile)
+                    cachefile = RecipeInfoFile(getCacheFile(self.cachedir, cache_class.cachefile, self.config_hash))
+                    cache_ok = cache_ok and os.path.exists(cachefile.indexfile)
+                    cachefiles.append(cachefile)
                     cache_class.init_cacheData(self)
+        self.depends_cache = RecipeInfoCache(cachefiles)
         if cache_ok:
             self.load_cachefile()
         elif os.path.isfile(self.cachefile):
             logger.info("Out of date cache found, rebuilding...")
 
     def load_cachefile(self):
-        # Firstly, using core cache file information for
-        # valid checking
-        with open(self.cachefile, "rb") as cachefile:
-            pickled = pickle.Unpickler(cachefile)
-            try:
-                cache_ver = pickled.load()
-                bitbake_ver = pickled.load()
-            except Exception:
-                logger.info('Invalid cache, rebuilding...')
-                return
-
-            if cache_ver != __cache_version__:
-                logger.info('Cache version mismatch, rebuilding...')
-                return
-            elif bitbake_ver != bb.__version__:
-                logger.info('Bitbake version mismatch, rebuilding...')
-                return
-
-
+        cachefiles = self.depends_cache.files
         cachesize = 0
-        previous_progress = 0
-        previous_percent = 0
-
-        # Calculate the correct cachesize of all those cache files
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                with open(cachefile, "rb") as cachefile:
-                    cachesize += os.fstat(cachefile.fileno()).st_size
+        for cachefile in cachefiles:
+            cachesize += os.path.getsize(cachefile.indexfile)
 
         bb.event.fire(bb.event.CacheLoadStarted(cachesize), self.data)
-        
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                with open(cachefile, "rb") as cachefile:
-                    pickled = pickle.Unpickler(cachefile)                    
-                    while cachefile:
-                        try:
-                            key = pickled.load()
-                            value = pickled.load()
-                        except Exception:
-                            break
-                        if self.depends_cache.has_key(key):
-                            self.depends_cache[key].append(value)
-                        else:
-                            self.depends_cache[key] = [value]
-                        # only fire events on even percentage boundaries
-                        current_progress = cachefile.tell() + previous_progress
-                        current_percent = 100 * current_progress / cachesize
-                        if current_percent > previous_percent:
-                            previous_percent = current_percent
-                            bb.event.fire(bb.event.CacheLoadProgress(current_progress, cachesize),
-                                          self.data)
-
-                    previous_progress += current_progress
+
+        # Only the indexes are read here, the recipe info records themselves
+        # are decoded from the mmapped data files when first looked up
+        current_progress = 0
+        for cachefile in cachefiles:
+            reason = cachefile.load()
+            if reason:
+                logger.info('%s, rebuilding...' % reason)
+                for cachefile in cachefiles:
+                    cachefile.close()
+                break
+            current_progress += os.path.getsize(cachefile.indexfile)
+            bb.event.fire(bb.event.CacheLoadProgress(current_progress, cachesize),
+                          self.data)
+        else:
+            self.parse_times = dict(cachefiles[0].meta.get("parse_times", {}))
+            old_digests = cachefiles[0].meta.get("config_digests", {})
+            for var, digest in self.config_digests.iteritems():
+                if old_digests.get(var) != digest:
+                    logger.debug(1, "Cache: configuration variable %s changed", var)
+                    self.config_changed |= self.config_varbits[var]
 
         # Note: depends cache number is corresponding to the parsing file numbers.
         # The same file has several caches, still regarded as one item in the cache
@@ -359,7 +606,6 @@ class Cache(object):
                                                   len(self.depends_cache)),
                       self.data)
 
-    
     @staticmethod
     def virtualfn2realfn(virtualfn):
         """
@@ -402,7 +648,8 @@ class Cache(object):
     def parse(cls, filename, appends, configdata, caches_array):
         """Parse the specified filename, returning the recipe information"""
         infos = []
-        datastores = cls.load_bbfile(filename, appends, configdata)
+        tracker = bb.data_smart.VariableReadTracker(configdata)
+        datastores = cls.load_bbfile(filename, appends, configdata, tracker)
         depends = []
         for variant, data in sorted(datastores.iteritems(),
                                     key=lambda i: i[0],
@@ -419,6 +666,12 @@ class Cache(object):
                     info_array.append(info)
             infos.append((virtualfn, info_array))
 
+        # All variants share the reads of the whole parse, including the
+        # ones made extracting the recipe information above
+        configmask = config_read_mask(configdata, tracker.reads)
+        for _, info_array in infos:
+            info_array[0].configmask = configmask
+
         return infos
 
     def load(self, filename, appends, configdata):
@@ -433,8 +686,7 @@ class Cache(object):
         if cached:
             infos = []
             # info_array item is a list of [CoreRecipeInfo, XXXRecipeInfo]
-            info_array = self.depends_cache[filename]
-            for variant in info_array[0].variants:
+            for variant in self.depends_cache.core(filename).variants:
                 virtualfn = self.realfn2virtual(filename, variant)
                 infos.append((virtualfn, self.depends_cache[virtualfn]))
         else:
@@ -499,7 +751,8 @@ class Cache(object):
             self.remove(fn)
             return False
 
-        info_array = self.depends_cache[fn]
+        # Only the core info is needed to validate the entry
+        info_array = [self.depends_cache.core(fn)]
         # Check the file's timestamp
         if mtime != info_array[0].timestamp:
             logger.debug(2, "Cache: %s changed", fn)
@@ -549,6 +802,11 @@ class Cache(object):
                         self.remove(fn)
                         return False
 
+        if info_array[0].configmask & self.config_changed:
+            logger.debug(2, "Cache: configuration read by %s changed", fn)
+            self.remove(fn)
+            return False
+
         if appends != info_array[0].appends:
             logger.debug(2, "Cache: appends for %s changed", fn)
             logger.debug(2, "%s to %s" % (str(appends), str(info_array[0].appends)))
@@ -603,30 +861,17 @@ class Cache(object):
             logger.debug(2, "Cache is clean, not saving.")
             return
 
-        file_dict = {}
-        pickler_dict = {}
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cache_class_name = cache_class.__name__
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                file_dict[cache_class_name] = open(cachefile, "wb")
-                pickler_dict[cache_class_name] =  pickle.Pickler(file_dict[cache_class_name], pickle.HIGHEST_PROTOCOL)
-                   
-        pickler_dict['CoreRecipeInfo'].dump(__cache_version__)
-        pickler_dict['CoreRecipeInfo'].dump(bb.__version__)
+        # Entries which weren't validated against the changed configuration
+        # can't be carried over to the new configuration snapshot
+        if self.config_changed:
+            for key in self.depends_cache.keys():
+                if key not in self.clean and key not in self.depends_cache.changed:
+                    del self.depends_cache[key]
 
-        try:
-            for key, info_array in self.depends_cache.iteritems():
-                for info in info_array:
-                    if isinstance(info, RecipeInfoCommon):
-                        cache_class_name = info.__class__.__name__
-                        pickler_dict[cache_class_name].dump(key)
-                        pickler_dict[cache_class_name].dump(info)
-        finally:
-            for cache_class in self.caches_array:
-                if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                    cache_class_name = cache_class.__name__
-                    file_dict[cache_class_name].close()
+        self.depends_cache.files[0].meta["config_digests"] = self.config_digests
+        self.depends_cache.files[0].meta["parse_times"] = dict((fn, t) for fn, t in self.parse_times.iteritems()
+                                                                 if fn in self.depends_cache)
+        self.depends_cache.sync()
 
         del self.depends_cache
 
@@ -663,10 +908,11 @@ class Cache(object):
         self.add_info(file_name, info_array, cacheData, parsed)
 
     @staticmethod
-    def load_bbfile(bbfile, appends, config):
+    def load_bbfile(bbfile, appends, config, tracker=None):
         """
         Load and parse one .bb build file
         Return the data and whether parsing resulted in the file being skipped
+        If tracker is given, it records the configuration variables read
         """
         chdir_back = False
 
@@ -678,6 +924,7 @@ class Cache(object):
         oldpath = os.path.abspath(os.getcwd())
         parse.cached_mtime_noerror(bbfile_loc)
         bb_data = config.createCopy()
+        bb_data.readtracker = tracker
         # The ConfHandler first looks if there is a TOPDIR and if not
         # then it would call getcwd().
         # Previously, we chdir()ed to bbfile_loc, called the handler
@@ -748,12 +995,22 @@ class MultiProcessCache(object):
     BitBake multi-process cache implementation
 
     Used by the codeparser & file checksum caches
+
+    The cache is a snapshot file plus a log next to it. Each process
+    appends the entries it added to the log (save_extras(), which also picks
+    up whatever other processes appended since), so processes started later
+    in the same run see them without any merge step. Once the log outgrows
+    CACHE_COMPACT_RATIO of the snapshot, or prune_data() drops entries from
+    it, save_merge() folds it back in.
     """
 
     def __init__(self):
         self.cachefile = None
         self.cachedata = self.create_cachedata()
         self.cachedata_extras = self.create_cachedata()
+        self.logfile = None
+        self.logid = None
+        self.logoffset = 0
 
     def init_cache(self, d, cache_file_name=None):
         cachedir = (d.getVar("PERSISTENT_DIR", True) or
@@ -763,52 +1020,122 @@ class MultiProcessCache(object):
         bb.utils.mkdirhier(cachedir)
         self.cachefile = os.path.join(cachedir,
                                       cache_file_name or self.__class__.cache_file_name)
+        self.logfile = self.cachefile + ".log"
         logger.debug(1, "Using cache in '%s'", self.cachefile)
 
-        glf = bb.utils.lockfile(self.cachefile + ".lock")
+        glf = bb.utils.lockfile(self.cachefile + ".lock", shared=True)
+        try:
+            self.load()
+        finally:
+            bb.utils.unlockfile(glf)
 
+    def create_cachedata(self):
+        data = [{}]
+        return data
+
+    def load(self):
+        """
+        Load the snapshot and everything in the log, with the lock held
+        """
+        data = self.create_cachedata()
         try:
             with open(self.cachefile, "rb") as f:
                 p = pickle.Unpickler(f)
-                data, version = p.load()
+                snapshot, version = p.load()
+            if version == self.__class__.CACHE_VERSION:
+                data = snapshot
         except:
-            bb.utils.unlockfile(glf)
-            return
+            pass
 
-        bb.utils.unlockfile(glf)
+        # Update in place, subclasses hold references to the dicts
+        for j in range(0, len(self.cachedata)):
+            self.cachedata[j].clear()
+            self.cachedata[j].update(data[j])
+        self.logid = None
+        self.logoffset = 0
+        self.read_log()
 
-        if version != self.__class__.CACHE_VERSION:
+    def read_log(self):
+        """
+        Merge in the entries appended to the log since it was last read,
+        with the lock held
+        """
+        try:
+            f = open(self.logfile, "rb")
+        except IOError:
             return
+        with f:
+            st = os.fstat(f.fileno())
+            logid = (st.st_dev, st.st_ino)
+            if self.logid not in (None, logid) or st.st_size < self.logoffset:
+                # The log was compacted into the snapshot
+                f.close()
+                self.load()
+                return
+            self.logid = logid
+            f.seek(self.logoffset)
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    break
+                length = struct.unpack(">I", header)[0]
+                record = f.read(length)
+                if len(record) < length:
+                    # Only part of a record made it to disk, ignore it
+                    break
+                try:
+                    extradata, version = pickle.loads(record)
+                except Exception:
+                    extradata, version = None, None
+                if version == self.__class__.CACHE_VERSION:
+                    self.merge_data(extradata, self.cachedata)
+                self.logoffset = f.tell()
 
-        self.cachedata = data
+    def sync(self):
+        """
+        Pick up the entries other processes have appended to the log
+        """
+        if not self.logfile:
+            return
+        try:
+            st = os.stat(self.logfile)
+        except OSError:
+            return
+        if (st.st_dev, st.st_ino) == self.logid and st.st_size == self.logoffset:
+            return
 
-    def create_cachedata(self):
-        data = [{}]
-        return data
+        glf = bb.utils.lockfile(self.cachefile + ".lock", shared=True)
+        try:
+            self.read_log()
+        finally:
+            bb.utils.unlockfile(glf)
 
     def save_extras(self):
         if not self.cachefile:
             return
 
-        glf = bb.utils.lockfile(self.cachefile + ".lock", shared=True)
+        if not any(self.cachedata_extras):
+            self.sync()
+            return
 
-        i = os.getpid()
-        lf = None
-        while not lf:
-            lf = bb.utils.lockfile(self.cachefile + ".lock." + str(i), retry=False)
-            if not lf or os.path.exists(self.cachefile + "-" + str(i)):
-                if lf:
-                    bb.utils.unlockfile(lf)
-                    lf = None
-                i = i + 1
-                continue
+        record = pickle.dumps([self.cachedata_extras, self.__class__.CACHE_VERSION], -1)
 
-            with open(self.cachefile + "-" + str(i), "wb") as f:
-                p = pickle.Pickler(f, -1)
-                p.dump([self.cachedata_extras, self.__class__.CACHE_VERSION])
+        glf = bb.utils.lockfile(self.cachefile + ".lock")
+        try:
+            self.read_log()
+            with open(self.logfile, "ab") as f:
+                f.write(struct.pack(">I", len(record)) + record)
+                f.flush()
+                st = os.fstat(f.fileno())
+            self.logid = (st.st_dev, st.st_ino)
+            self.logoffset = st.st_size
+        finally:
+            bb.utils.unlockfile(glf)
 
-        bb.utils.unlockfile(lf)
-        bb.utils.unlockfile(glf)
+        # The entries are in the log now, keep using them from cachedata
+        self.merge_data(self.cachedata_extras, self.cachedata)
+        for extras in self.cachedata_extras:
+            extras.clear()
 
     def merge_data(self, source, dest):
         for j in range(0,len(dest)):
@@ -816,34 +1143,41 @@ class MultiProcessCache(object):
                 if h not in dest[j]:
                     dest[j][h] = source[j][h]
 
+    def prune_data(self, data):
+        """
+        Drop entries which are no longer wanted from data, about to be
+        written out as the snapshot, and return whether there were any
+        """
+        return False
+
     def save_merge(self):
         if not self.cachefile:
             return
 
         glf = bb.utils.lockfile(self.cachefile + ".lock")
+        try:
+            # Per process files left by older versions
+            for f in [y for y in os.listdir(os.path.dirname(self.cachefile)) if y.startswith(os.path.basename(self.cachefile) + '-')]:
+                bb.utils.remove(os.path.join(os.path.dirname(self.cachefile), f))
 
-        data = self.cachedata
-
-        for f in [y for y in os.listdir(os.path.dirname(self.cachefile)) if y.startswith(os.path.basename(self.cachefile) + '-')]:
-            f = os.path.join(os.path.dirname(self.cachefile), f)
+            self.read_log()
             try:
-                with open(f, "rb") as fd:
-                    p = pickle.Unpickler(fd)
-                    extradata, version = p.load()
-            except (IOError, EOFError):
-                os.unlink(f)
-                continue
-
-            if version != self.__class__.CACHE_VERSION:
-                os.unlink(f)
-                continue
-
-            self.merge_data(extradata, data)
-            os.unlink(f)
-
-        with open(self.cachefile, "wb") as f:
-            p = pickle.Pickler(f, -1)
-            p.dump([data, self.__class__.CACHE_VERSION])
-
-        bb.utils.unlockfile(glf)
+                snapshotsize = os.path.getsize(self.cachefile)
+            except OSError:
+                snapshotsize = 0
+            if self.logoffset and (self.prune_data(self.cachedata) or
+                                   self.logoffset > CACHE_COMPACT_RATIO * snapshotsize):
+                with open(self.cachefile + ".tmp", "wb") as f:
+                    p = pickle.Pickler(f, -1)
+                    p.dump([self.cachedata, self.__class__.CACHE_VERSION])
+                os.rename(self.cachefile + ".tmp", self.cachefile)
+                # Replace the log rather than truncating it so that other
+                # processes notice and reload the snapshot
+                open(self.logfile + ".tmp", "wb").close()
+                os.rename(self.logfile + ".tmp", self.logfile)
+                self.logid = None
+                self.logoffset = 0
+                self.read_log()
+        finally:
+            bb.utils.unlockfile(glf)
 
@@ -16,11 +16,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import glob
+import multiprocessing.pool
 import operator
 import os
 import stat
 import bb.utils
 import logging
+from collections import namedtuple
 from bb.cache import MultiProcessCache
 
 logger = logging.getLogger("BitBake.Cache")
@@ -58,62 +60,152 @@ class FileMtimeCache(object):
     def clear(self):
         self.cache.clear()
 
-# Checksum + mtime cache (persistent)
+class FileKey(namedtuple("FileKey", ["dev", "ino", "size", "mtime"])):
+    """
+    What identifies the content of a file, mtime in nanoseconds
+    """
+    __slots__ = ()
+
+# Checksum cache (persistent). Entries are keyed on the path and also on
+# the device, inode, size and mtime of the file, so hardlinks and renamed or
+# moved files reuse the checksum of the content they share.
 class FileChecksumCache(MultiProcessCache):
     cache_file_name = "local_file_checksum_cache.dat"
-    CACHE_VERSION = 1
+    CACHE_VERSION = 4
+
+    # How many files to checksum at once
+    threads = 8
 
     def __init__(self):
-        self.mtime_cache = FileMtimeCache()
+        self.pool = None
+        self.poolpid = None
+        self.hits = 0
+        self.reused = 0
+        self.misses = 0
         MultiProcessCache.__init__(self)
 
-    def get_checksum(self, f):
-        entry = self.cachedata[0].get(f)
-        cmtime = self.mtime_cache.cached_mtime(f)
+    def create_cachedata(self):
+        # path -> (file key, checksum) and file key -> checksum
+        data = [{}, {}]
+        return data
+
+    @staticmethod
+    def file_key(f):
+        st = os.stat(f)
+        mtime_ns = getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 1000000000)
+        # Inode numbers are only unique within a filesystem
+        return FileKey(st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+    def lookup(self, f):
+        """
+        Return the key of a file and its cached checksum, or None if the
+        file has to be checksummed
+        """
+        key = self.file_key(f)
+        entry = self.cachedata_extras[0].get(f) or self.cachedata[0].get(f)
         if entry:
-            (mtime, hashval) = entry
-            if cmtime == mtime:
-                return hashval
-            else:
-                bb.debug(2, "file %s changed mtime, recompute checksum" % f)
+            if entry[0] == key:
+                self.hits += 1
+                return key, entry[1]
+            bb.debug(2, "file %s changed, recompute checksum" % f)
+
+        hashval = self.cachedata_extras[1].get(key) or self.cachedata[1].get(key)
+        if hashval:
+            self.reused += 1
+            self.cachedata_extras[0][f] = (key, hashval)
+        return key, hashval
+
+    def store(self, f, key, hashval):
+        self.cachedata_extras[0][f] = (key, hashval)
+        self.cachedata_extras[1][key] = hashval
 
-        hashval = bb.utils.md5_file(f)
-        self.cachedata_extras[0][f] = (cmtime, hashval)
+    def get_checksum(self, f):
+        key, hashval = self.lookup(f)
+        if not hashval:
+            self.misses += 1
+            hashval = bb.utils.md5_file(f)
+            self.store(f, key, hashval)
         return hashval
 
+    def checksum_files(self, files):
+        """
+        Return a dict of the checksums of files, computing the ones which
+        aren't cached in parallel. Files which can't be read are None.
+        """
+        def md5_file(f):
+            try:
+                return bb.utils.md5_file(f), None
+            except (IOError, OSError) as e:
+                return None, e
+
+        checksums = {}
+        pending = {}
+        for f in files:
+            try:
+                key, hashval = self.lookup(f)
+            except OSError as e:
+                checksums[f] = e
+                continue
+            if hashval:
+                checksums[f] = hashval
+            else:
+                pending.setdefault(key, []).append(f)
+
+        if not pending:
+            return checksums
+
+        # Files sharing a key (hardlinks) are only read once
+        keys = pending.keys()
+        paths = [pending[key][0] for key in keys]
+        self.misses += len(paths)
+        if len(paths) > 1:
+            if self.poolpid != os.getpid():
+                # A pool inherited across fork() has no threads
+                self.pool = multiprocessing.pool.ThreadPool(self.threads)
+                self.poolpid = os.getpid()
+            results = self.pool.map(md5_file, paths)
+        else:
+            results = [md5_file(paths[0])]
+
+        for key, (hashval, error) in zip(keys, results):
+            for f in pending[key]:
+                if hashval:
+                    self.store(f, key, hashval)
+                    checksums[f] = hashval
+                else:
+                    checksums[f] = error
+        return checksums
+
     def merge_data(self, source, dest):
         for h in source[0]:
-            if h in dest:
-                (smtime, _) = source[0][h]
-                (dmtime, _) = dest[0][h]
-                if smtime > dmtime:
+            if h in dest[0]:
+                (skey, _) = source[0][h]
+                (dkey, _) = dest[0][h]
+                # Keep the most recent of what the processes saw
+                if skey.mtime > dkey.mtime:
                     dest[0][h] = source[0][h]
             else:
                 dest[0][h] = source[0][h]
+        dest[1].update(source[1])
+
+    def save_extras(self):
+        logger.debug(1, "Local file checksums: %d cached, %d reused from other paths, %d computed",
+                     self.hits, self.reused, self.misses)
+        MultiProcessCache.save_extras(self)
 
     def get_checksums(self, filelist, pn):
         """Get checksums for a list of files"""
 
-        def checksum_file(f):
-            try:
-                checksum = self.get_checksum(f)
-            except OSError as e:
-                bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, os.path.basename(f), e))
-                return None
-            return checksum
-
-        def checksum_dir(pth):
+        def list_dir(pth):
             # Handle directories recursively
-            dirchecksums = []
+            dirfiles = []
             for root, dirs, files in os.walk(pth):
                 for name in files:
-                    fullpth = os.path.join(root, name)
-                    checksum = checksum_file(fullpth)
-                    if checksum:
-                        dirchecksums.append((fullpth, checksum))
-            return dirchecksums
+                    dirfiles.append(os.path.join(root, name))
+            return dirfiles
 
-        checksums = []
+        # (path, whether it was found in a directory)
+        files = []
         for pth in filelist.split():
             exist = pth.split(":")[1]
             if exist == "False":
@@ -124,16 +216,25 @@ class FileChecksumCache(MultiProcessCache):
                 for f in glob.glob(pth):
                     if os.path.isdir(f):
                         if not os.path.islink(f):
-                            checksums.extend(checksum_dir(f))
+                            files.extend((dirf, True) for dirf in list_dir(f))
                     else:
-                        checksum = checksum_file(f)
-                        checksums.append((f, checksum))
+                        files.append((f, False))
             elif os.path.isdir(pth):
                 if not os.path.islink(pth):
-                    checksums.extend(checksum_dir(pth))
+                    files.extend((dirf, True) for dirf in list_dir(pth))
             else:
-                checksum = checksum_file(pth)
-                checksums.append((pth, checksum))
+                files.append((pth, False))
+
+        results = self.checksum_files([f for f, _ in files])
+
+        checksums = []
+        for f, indir in files:
+            checksum = results[f]
+            if not isinstance(checksum, str):
+                bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, os.path.basename(f), checksum))
+                checksum = None
+            if checksum or not indir:
+                checksums.append((f, checksum))
 
         checksums.sort(key=operator.itemgetter(1))
         return checksums
@@ -1,10 +1,13 @@
 import ast
 import codegen
 import logging
+import hashlib
 import os.path
+import re
+import threading
 import bb.utils, bb.data
 from itertools import chain
-from pysh import pyshyacc, pyshlex, sherrors
+from pysh import pyshyacc, pyshlex, pyshscan, sherrors
 from bb.cache import MultiProcessCache
 
 
@@ -36,6 +39,73 @@ def check_indent(codestr):
 
     return codestr
 
+def codedigest(code):
+    """Return the key the results of parsing code are cached under"""
+    if isinstance(code, unicode):
+        code = code.encode("utf-8")
+    else:
+        code = str(code)
+    return hashlib.md5(code).digest()
+
+# Shell functions are parsed once expanded, so the same function from a class
+# reads differently in every recipe. What matters for the commands it runs is
+# the shape of the code though, so the expansions which are plain words get
+# replaced by a marker and the parse of that template is shared between all
+# the datastores expanding the function to plain words in the same places.
+# If one of those words is in a position where it could be a command (or a
+# name the shell grammar treats differently from other words) the template
+# can't be used and the expanded code gets parsed as before.
+templatemarker = "__bb_expansion__"
+expansion_regexp = re.compile(r"\${@.+?}|\${[^{}@\n\t :]+}")
+word_regexp = re.compile(r"^[\w./:+,%@=~-]+$")
+heredoc_regexp = re.compile(r"<<-?\s*[\"']?([^\s\"'<>|&;()]+)")
+
+def shell_template(body, value, d):
+    """Return the template of the shell code body which d expands to
+    value, or None if there isn't a usable one"""
+    if templatemarker in body:
+        return None
+
+    pieces = []
+    piece = []
+    expanded = []
+    last = 0
+    for match in expansion_regexp.finditer(body):
+        try:
+            word = d.expand(match.group())
+        except Exception:
+            return None
+        piece.append(body[last:match.start()])
+        if word_regexp.match(word) and not pyshlex.get_reserved(word):
+            pieces.append("".join(piece))
+            piece = []
+            expanded.append(word)
+        else:
+            piece.append(word)
+        last = match.end()
+    piece.append(body[last:])
+    pieces.append("".join(piece))
+
+    # Expressions nested in others (${${FOO}}, or variables referenced from
+    # python expressions) get expanded first, they don't add up to value
+    expansion = [pieces[0]]
+    for word, piece in zip(expanded, pieces[1:]):
+        expansion.append(word)
+        expansion.append(piece)
+    if "".join(expansion) != value:
+        return None
+    template = templatemarker.join(pieces)
+
+    if "<<" in template:
+        # Here documents have to end on the same lines
+        delimiters = set(heredoc_regexp.findall(template))
+        if any(templatemarker in delimiter for delimiter in delimiters):
+            return None
+        for line, expandedline in zip(template.split("\n"), value.split("\n")):
+            if templatemarker in line and expandedline.strip() in delimiters:
+                return None
+    return template
+
 
 # Basically pickle, in python 2.7.3 at least, does badly with data duplication 
 # upon pickling and unpickling. Combine this with duplicate objects and things
@@ -117,35 +187,41 @@ class shellCacheLine(object):
 
 class CodeParserCache(MultiProcessCache):
     cache_file_name = "bb_codeparser.dat"
-    CACHE_VERSION = 7
+    CACHE_VERSION = 8
 
     def __init__(self):
         MultiProcessCache.__init__(self)
         self.pythoncache = self.cachedata[0]
         self.shellcache = self.cachedata[1]
+        self.templatecache = self.cachedata[2]
         self.pythoncacheextras = self.cachedata_extras[0]
         self.shellcacheextras = self.cachedata_extras[1]
+        self.templatecacheextras = self.cachedata_extras[2]
 
         # To avoid duplication in the codeparser cache, keep
         # a lookup of hashes of objects we already have
         self.pythoncachelines = {}
         self.shellcachelines = {}
+        # Configuration snapshots can be expanded in several threads at once
+        self.lock = threading.Lock()
 
     def newPythonCacheLine(self, refs, execs, contains):
-        cacheline = pythonCacheLine(refs, execs, contains)
-        h = hash(cacheline)
-        if h in self.pythoncachelines:
-            return self.pythoncachelines[h]
-        self.pythoncachelines[h] = cacheline
-        return cacheline
+        with self.lock:
+            cacheline = pythonCacheLine(refs, execs, contains)
+            h = hash(cacheline)
+            if h in self.pythoncachelines:
+                return self.pythoncachelines[h]
+            self.pythoncachelines[h] = cacheline
+            return cacheline
 
     def newShellCacheLine(self, execs):
-        cacheline = shellCacheLine(execs)
-        h = hash(cacheline)
-        if h in self.shellcachelines:
-            return self.shellcachelines[h]
-        self.shellcachelines[h] = cacheline
-        return cacheline
+        with self.lock:
+            cacheline = shellCacheLine(execs)
+            h = hash(cacheline)
+            if h in self.shellcachelines:
+                return self.shellcachelines[h]
+            self.shellcachelines[h] = cacheline
+            return cacheline
 
     def init_cache(self, d):
         # Check if we already have the caches
@@ -157,9 +233,12 @@ class CodeParserCache(MultiProcessCache):
         # cachedata gets re-assigned in the parent
         self.pythoncache = self.cachedata[0]
         self.shellcache = self.cachedata[1]
+        self.templatecache = self.cachedata[2]
 
     def create_cachedata(self):
-        data = [{}, {}]
+        # Python code, shell code and shell templates (where None records
+        # that the template can't be used)
+        data = [{}, {}, {}]
         return data
 
 codeparsercache = CodeParserCache()
@@ -173,6 +252,31 @@ def parser_cache_save():
 def parser_cache_savemerge():
     codeparsercache.save_merge()
 
+def parser_cache_prewarm(d):
+    """Parse the functions the classes inherited by the configuration d
+    define, ahead of any recipe (and any parser process) needing them"""
+    for key in d.keys():
+        if not d.getVarFlag(key, "func", False):
+            continue
+        filename = d.getVarFlag(key, "filename", False)
+        if not filename or not filename.endswith(".bbclass"):
+            continue
+        body = d.getVar(key, False)
+        if not body:
+            continue
+        try:
+            if d.getVarFlag(key, "python", False):
+                PythonParser(key, logger).parse_python(body, filename=filename,
+                                                       lineno=d.getVarFlag(key, "lineno", False))
+            else:
+                ShellParser(key, logger).parse_template(body, d.expand(body), d)
+        except Exception:
+            # Left for the recipes to report
+            pass
+
+    # The parser processes inherit these, they don't need to log them again
+    parser_cache_save()
+
 Logger = logging.getLoggerClass()
 class BufferedLogger(Logger):
     def __init__(self, name, level=0, target=None):
@@ -268,7 +372,7 @@ class PythonParser():
         if not node or not node.strip():
             return
 
-        h = hash(str(node))
+        h = codedigest(node)
 
         if h in codeparsercache.pythoncache:
             self.references = set(codeparsercache.pythoncache[h].refs)
@@ -301,19 +405,23 @@ class PythonParser():
 
 class ShellParser():
     def __init__(self, name, log):
+        self.name = name
         self.funcdefs = set()
         self.allexecs = set()
         self.execs = set()
+        self.marker = None
+        self.markerused = False
         self.log = BufferedLogger('BitBake.Data.%s' % name, logging.DEBUG, log)
         self.unhandled_template = "unable to handle non-literal command '%s'"
         self.unhandled_template = "while parsing %s, %s" % (name, self.unhandled_template)
 
-    def parse_shell(self, value):
+    def parse_shell(self, value, body=None, d=None):
         """Parse the supplied shell code in a string, returning the external
-        commands it executes.
+        commands it executes. If the code is the expansion of body in the
+        datastore d, the result may come from the template of body.
         """
 
-        h = hash(str(value))
+        h = codedigest(value)
 
         if h in codeparsercache.shellcache:
             self.execs = set(codeparsercache.shellcache[h].execs)
@@ -323,6 +431,12 @@ class ShellParser():
             self.execs = set(codeparsercache.shellcacheextras[h].execs)
             return self.execs
 
+        if body:
+            execs = self.parse_template(body, value, d)
+            if execs is not None:
+                self.execs = set(execs)
+                return self.execs
+
         self._parse_shell(value)
         self.execs = set(cmd for cmd in self.allexecs if cmd not in self.funcdefs)
 
@@ -330,11 +444,50 @@ class ShellParser():
 
         return self.execs
 
+    def parse_template(self, body, value, d):
+        """Return the commands the shell code body, which d expands to value,
+        executes according to its template, or None if it has no usable one
+        """
+        template = shell_template(body, value, d)
+        if template is None:
+            return None
+
+        h = codedigest(template)
+        for cache in (codeparsercache.templatecache, codeparsercache.templatecacheextras):
+            if h in cache:
+                return cache[h] and cache[h].execs
+
+        parser = ShellParser(self.name, self.log.target)
+        parser.marker = templatemarker
+        try:
+            parser._parse_shell(template)
+            usable = not parser.markerused
+        except Exception:
+            # Whatever is wrong with it gets reported parsing the code itself
+            usable = False
+        if not usable:
+            codeparsercache.templatecacheextras[h] = None
+            return None
+
+        self.log.buffer.extend(parser.log.buffer)
+        cacheline = codeparsercache.newShellCacheLine(set(cmd for cmd in parser.allexecs if cmd not in parser.funcdefs))
+        codeparsercache.templatecacheextras[h] = cacheline
+        return cacheline.execs
+
+    def check_marker(self, word):
+        """Note a template marker in word, in a position where the value
+        it stands for matters"""
+        if self.marker and self.marker in word:
+            self.markerused = True
+
     def _parse_shell(self, value):
         try:
-            tokens, _ = pyshyacc.parse(value, eof=True, debug=False)
-        except pyshlex.NeedMore:
-            raise sherrors.ShellSyntaxError("Unexpected EOF")
+            tokens = pyshscan.parse(value)
+        except pyshscan.Unsupported:
+            try:
+                tokens, _ = pyshyacc.parse(value, eof=True, debug=False)
+            except pyshlex.NeedMore:
+                raise sherrors.ShellSyntaxError("Unexpected EOF")
 
         for token in tokens:
             self.process_tokens(token)
@@ -345,6 +498,7 @@ class ShellParser():
         """
 
         def function_definition(value):
+            self.check_marker(value.name)
             self.funcdefs.add(value.name)
             return [value.body], None
 
@@ -364,14 +518,20 @@ class ShellParser():
             else:
                 return chain(main, rest)
 
+        def for_clause(value):
+            self.check_marker(value.name)
+            return value.cmds, value.items
+
         def simple_command(value):
+            for assign in value.assigns:
+                self.check_marker(assign[1][0])
             return None, chain(value.words, (assign[1] for assign in value.assigns))
 
         token_handlers = {
             "and_or": lambda x: ((x.left, x.right), None),
             "async": lambda x: ([x], None),
             "brace_group": lambda x: (x.cmds, None),
-            "for_clause": lambda x: (x.cmds, x.items),
+            "for_clause": for_clause,
             "function_definition": function_definition,
             "if_clause": lambda x: (if_clause(x), None),
             "pipeline": lambda x: (x.commands, None),
@@ -404,6 +564,11 @@ class ShellParser():
 
         words = list(words)
         for word in list(words):
+            # Only commands substitutions matter here; the lexer already went
+            # through the word, so a trailing '$' is all that could still be
+            # found to be invalid
+            if "`" not in word[1] and "$(" not in word[1] and not word[1].endswith("$"):
+                continue
             wtree = pyshlex.make_wordtree(word[1])
             for part in wtree:
                 if not isinstance(part, list):
@@ -419,6 +584,8 @@ class ShellParser():
 
         usetoken = False
         for word in words:
+            if usetoken or word[0] in ("cmd_name", "cmd_word"):
+                self.check_marker(word[1])
             if word[0] in ("cmd_name", "cmd_word") or \
                (usetoken and word[0] == "TOKEN"):
                 if "=" in word[1]:
@@ -25,6 +25,8 @@ Commands are either synchronous or asynchronous.
 Async commands return data to the client in the form of events.
 Sync commands must only return data through the function return value
 and must not trigger events, directly or indirectly.
+Sync commands which only read the configuration can be marked to be run
+from a snapshot of it, from another thread than the cooker's.
 Commands are queued in a CommandQueue
 """
 
@@ -47,6 +49,13 @@ class CommandFailed(CommandExit):
 class CommandError(Exception):
     pass
 
+class SnapshotCommand(object):
+    """
+    What a command run from a snapshot gets in place of the Command
+    """
+    def __init__(self, snapshot):
+        self.cooker = snapshot
+
 class Command:
     """
     A queue of asynchronous commands for bitbake
@@ -86,6 +95,28 @@ class Command:
         self.cooker.configuration.server_register_idlecallback(self.cooker.runCommands, self.cooker)
         return True, None
 
+    def runSnapshotCommand(self, commandline, snapshot, ro_only = False):
+        """
+        Run a synchronous command against a bb.cooker.CookerSnapshot rather
+        than the cooker, which can be done from another thread. Returns None
+        for commands not marked as able to, they have to be passed to
+        runCommand() instead.
+        """
+        command_method = getattr(self.cmds_sync, commandline[0], None)
+        if not getattr(command_method, 'snapshot', False):
+            return None
+        if ro_only and not getattr(command_method, 'readonly', False):
+            return None
+        try:
+            result = command_method(SnapshotCommand(snapshot), commandline[1:])
+        except CommandError as exc:
+            return None, exc.args[0]
+        except (Exception, SystemExit):
+            import traceback
+            return None, traceback.format_exc()
+        else:
+            return result, None
+
     def runAsyncCommand(self):
         try:
             if self.cooker.state in (bb.cooker.state.error, bb.cooker.state.shutdown, bb.cooker.state.forceshutdown):
@@ -160,6 +191,7 @@ class CommandsSync:
         flaglist = params[0]
         return command.cooker.getAllKeysWithFlags(flaglist)
     getAllKeysWithFlags.readonly = True
+    getAllKeysWithFlags.snapshot = True
 
     def getVariable(self, command, params):
         """
@@ -172,6 +204,7 @@ class CommandsSync:
 
         return command.cooker.data.getVar(varname, expand)
     getVariable.readonly = True
+    getVariable.snapshot = True
 
     def setVariable(self, command, params):
         """
@@ -225,6 +258,7 @@ class CommandsSync:
         return bb.utils.cpu_count()
     getCpuCount.readonly = True
     getCpuCount.needconfig = False
+    getCpuCount.snapshot = True
 
     def matchFile(self, command, params):
         fMatch = params[0]
@@ -281,6 +315,17 @@ class CommandsSync:
     setEventMask.needconfig = False
     setEventMask.readonly = True
 
+    def getEventStats(self, command, params):
+        """
+        Get the counters of the transport passing events to a UI, if it
+        keeps any
+        """
+        handlerNum = params[0]
+        return bb.event.get_UIHstats(handlerNum)
+    getEventStats.needconfig = False
+    getEventStats.readonly = True
+    getEventStats.snapshot = True
+
     def setFeatures(self, command, params):
         """
         Set the cooker features to include the passed list of features
@@ -1430,27 +1430,20 @@ class BBCooker:
 
 
     def getAllKeysWithFlags(self, flaglist):
-        dump = {}
-        for k in self.data.keys():
-            try:
-                expand = True
-                flags = self.data.getVarFlags(k)
-                if flags and "func" in flags and "python" in flags:
-                    expand = False
-                v = self.data.getVar(k, expand)
-                if not k.startswith("__") and not isinstance(v, bb.data_smart.DataSmart):
-                    dump[k] = {
-    'v' : v ,
-    'history' : self.data.varhistory.variable(k),
-                    }
-                    for d in flaglist:
-                        if flags and d in flags:
-                            dump[k][d] = flags[d]
-                        else:
-                            dump[k][d] = None
-            except Exception as e:
-                print(e)
-        return dump
+        return get_keys_with_flags(self.data, flaglist)
+
+    def getSnapshot(self, previous = None):
+        """
+        Return a CookerSnapshot of the configuration, or None when it has to
+        be reloaded before commands can read it. previous is returned again
+        if nothing changed since it was taken.
+        """
+        if self.state != state.running and not self.baseconfig_valid:
+            return None
+        data = self.data.createSnapshot()
+        if previous is not None and previous.data is data:
+            return previous
+        return CookerSnapshot(data)
 
 
     def generateNewImage(self, image, base_image, package_queue, timestamp, description):
@@ -1670,6 +1663,48 @@ class BBCooker:
         if hasattr(self, 'lock') and self.lock:
             bb.utils.unlockfile(self.lock)
 
+def get_keys_with_flags(data, flaglist):
+    dump = {}
+    for k in data.keys():
+        try:
+            expand = True
+            flags = data.getVarFlags(k)
+            if flags and "func" in flags and "python" in flags:
+                expand = False
+            v = data.getVar(k, expand)
+            if not k.startswith("__") and not isinstance(v, bb.data_smart.DataSmart):
+                dump[k] = {
+    'v' : v ,
+    'history' : data.varhistory.variable(k),
+                }
+                for d in flaglist:
+                    if flags and d in flags:
+                        dump[k][d] = flags[d]
+                    else:
+                        dump[k][d] = None
+        except Exception as e:
+            print(e)
+    return dump
+
+class CookerSnapshot(object):
+    """
+    The part of the cooker's state the commands able to run from a snapshot
+    read (see bb.command.Command.runSnapshotCommand()), copied so that they
+    can be served from other threads while the cooker carries on
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def copy(self):
+        """
+        Return a CookerSnapshot of the same configuration for one thread to
+        use, see bb.data_smart.DataSmart.createReader()
+        """
+        return CookerSnapshot(self.data.createReader())
+
+    def getAllKeysWithFlags(self, flaglist):
+        return get_keys_with_flags(self.data, flaglist)
+
 def server_main(cooker, func, *args):
     cooker.pre_serve()
 
@@ -1880,36 +1915,41 @@ class ParsingFailure(Exception):
         self.recipe = recipe
         Exception.__init__(self, realexception, recipe)
 
-class Feeder(multiprocessing.Process):
-    def __init__(self, jobs, to_parsers, quit):
-        self.quit = quit
-        self.jobs = jobs
-        self.to_parsers = to_parsers
-        multiprocessing.Process.__init__(self)
-
-    def run(self):
-        while True:
-            try:
-                quit = self.quit.get_nowait()
-            except Queue.Empty:
-                pass
-            else:
-                if quit == 'cancel':
-                    self.to_parsers.cancel_join_thread()
-                break
-
-            try:
-                job = self.jobs.pop()
-            except IndexError:
-                break
-
-            try:
-                self.to_parsers.put(job, timeout=0.5)
-            except Queue.Full:
-                self.jobs.insert(0, job)
-                continue
+def parse_batches(jobs, costs, num_processes):
+    """
+    Split the parse jobs into batches for the parser processes. Jobs are
+    ordered by their historical parse cost, most expensive first, and
+    batches shrink as the remaining work does (guided self-scheduling) so
+    the parsers which finish early pick up the cheap tail of the work
+    rather than one of them ending up with a long batch at the end.
+    """
+    if costs:
+        default = sum(costs.itervalues()) / len(costs)
+    else:
+        default = 1.0
+    jobs = sorted(jobs, key=lambda job: costs.get(job[0], default), reverse=True)
+
+    remaining = sum(costs.get(job[0], default) for job in jobs)
+    batches = []
+    batch = []
+    batchcost = 0
+    for job in jobs:
+        cost = costs.get(job[0], default)
+        batch.append(job)
+        batchcost += cost
+        if batchcost >= remaining / (2 * num_processes):
+            batches.append(batch)
+            remaining -= batchcost
+            batch = []
+            batchcost = 0
+    if batch:
+        batches.append(batch)
+    return batches
 
 class Parser(multiprocessing.Process):
+    # Number of parse results sent back to the server in one message
+    resultbatch = 16
+
     def __init__(self, jobs, results, quit, init, profile):
         self.jobs = jobs
         self.results = results
@@ -1941,32 +1981,49 @@ class Parser(multiprocessing.Process):
         if self.init:
             self.init()
 
-        pending = []
+        start = time.time()
+        busy = 0.0
+        count = 0
+        results = []
+        lastflush = start
         while True:
-            try:
-                self.quit.get_nowait()
-            except Queue.Empty:
-                pass
-            else:
-                self.results.cancel_join_thread()
+            batch = self.jobs.get()
+            if batch is None:
                 break
 
-            if pending:
-                result = pending.pop()
-            else:
+            for job in batch:
                 try:
-                    job = self.jobs.get(timeout=0.25)
+                    self.quit.get_nowait()
                 except Queue.Empty:
-                    continue
+                    pass
+                else:
+                    self.results.cancel_join_thread()
+                    return
 
-                if job is None:
-                    break
+                before = time.time()
                 result = self.parse(*job)
-
-            try:
-                self.results.put(result, timeout=0.25)
-            except Queue.Full:
-                pending.append(result)
+                after = time.time()
+                busy += after - before
+                count += 1
+                results.append((job[0], after - before, result))
+
+                # Stream results back in groups rather than one at a time,
+                # but don't sit on them long enough to stall progress
+                if len(results) >= self.resultbatch or after - lastflush > 0.1:
+                    self.results.put((self.name, busy, count, bb.data_smart.expansioncache.stats(), results))
+                    results = []
+                    lastflush = after
+
+            if results:
+                self.results.put((self.name, busy, count, bb.data_smart.expansioncache.stats(), results))
+                results = []
+                lastflush = time.time()
+
+            # Share new codeparser, expansion and file checksum cache entries
+            # with the other parser processes and pick up theirs
+            bb.codeparser.parser_cache_save()
+            bb.data_smart.expansion_cache_save()
+            bb.fetch.fetcher_parse_save()
 
     def parse(self, filename, appends, caches_array):
         try:
@@ -2012,6 +2069,7 @@ class CookerParser(object):
 
         self.current = 0
         self.process_names = []
+        self.worker_stats = {}
 
         self.bb_cache = bb.cache.Cache(self.cfgdata, self.cfghash, cooker.caches_array)
         self.fromcache = []
@@ -2036,18 +2094,23 @@ class CookerParser(object):
         self.processes = []
         if self.toparse:
             bb.event.fire(bb.event.ParseStarted(self.toparse), self.cfgdata)
+            bb.codeparser.parser_cache_prewarm(self.cfgdata)
             def init():
                 Parser.cfg = self.cfgdata
                 bb.utils.set_process_name(multiprocessing.current_process().name)
                 multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, exitpriority=1)
+                multiprocessing.util.Finalize(None, bb.data_smart.expansion_cache_save, exitpriority=1)
                 multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, exitpriority=1)
 
-            self.feeder_quit = multiprocessing.Queue(maxsize=1)
             self.parser_quit = multiprocessing.Queue(maxsize=self.num_processes)
-            self.jobs = multiprocessing.Queue(maxsize=self.num_processes)
+            self.jobs = multiprocessing.Queue()
             self.result_queue = multiprocessing.Queue()
-            self.feeder = Feeder(self.willparse, self.jobs, self.feeder_quit)
-            self.feeder.start()
+            for batch in parse_batches(self.willparse, self.bb_cache.parse_times, self.num_processes):
+                self.jobs.put(batch)
+            for i in range(0, self.num_processes):
+                self.jobs.put(None)
+            self.parse_start = time.time()
+            self.parse_end = self.parse_start
             for i in range(0, self.num_processes):
                 parser = Parser(self.jobs, self.result_queue, self.parser_quit, init, self.cooker.configuration.profile)
                 parser.start()
@@ -2070,12 +2133,8 @@ class CookerParser(object):
                                             self.total)
 
             bb.event.fire(event, self.cfgdata)
-            self.feeder_quit.put(None)
-            for process in self.processes:
-                self.parser_quit.put(None)
+            self.log_worker_stats()
         else:
-            self.feeder_quit.put('cancel')
-
             self.parser_quit.cancel_join_thread()
             for process in self.processes:
                 self.parser_quit.put(None)
@@ -2088,12 +2147,12 @@ class CookerParser(object):
                 process.terminate()
             else:
                 process.join()
-        self.feeder.join()
 
         sync = threading.Thread(target=self.bb_cache.sync)
         sync.start()
         multiprocessing.util.Finalize(None, sync.join, exitpriority=-100)
         bb.codeparser.parser_cache_savemerge()
+        bb.data_smart.expansion_cache_savemerge()
         bb.fetch.fetcher_parse_done()
         if self.cooker.configuration.profile:
             profiles = []
@@ -2106,6 +2165,33 @@ class CookerParser(object):
             bb.utils.process_profilelog(profiles, pout = pout)
             print("Processed parsing statistics saved to %s" % (pout))
 
+    def log_worker_stats(self):
+        elapsed = self.parse_end - self.parse_start
+        if not elapsed or not self.worker_stats:
+            return
+        totalbusy = 0
+        expansions = [0, 0, 0, 0]
+        for name in sorted(self.worker_stats):
+            busy, count, expandstats = self.worker_stats[name]
+            totalbusy += busy
+            expansions = map(sum, zip(expansions, expandstats))
+            logger.debug(1, "%s parsed %d recipes, %.1fs busy (%.0f%% utilization)",
+                         name, count, busy, 100 * busy / elapsed)
+        logger.debug(1, "Parsing took %.1fs with %d processes, %.0f%% overall utilization",
+                     elapsed, len(self.processes), 100 * totalbusy / (elapsed * len(self.processes)))
+
+        hits, stale, misses, uncacheable = expansions
+        lookups = hits + stale + misses
+        if lookups:
+            msg = ("Python expression expansions: %d cached of %d (%.0f%%), %d stale, %d not cacheable" %
+                   (hits, lookups, 100.0 * hits / lookups, stale, uncacheable))
+            # Shown with the parsing profile as it's what to look at when
+            # python expressions show up high in it
+            if self.cooker.configuration.profile:
+                logger.info(msg)
+            else:
+                logger.debug(1, msg)
+
     def load_cached(self):
         for filename, appends in self.fromcache:
             cached, infos = self.bb_cache.load(filename, appends, self.cfgdata)
@@ -2117,15 +2203,18 @@ class CookerParser(object):
                 break
 
             try:
-                result = self.result_queue.get(timeout=0.25)
+                name, busy, count, expandstats, results = self.result_queue.get(timeout=0.25)
             except Queue.Empty:
-                pass
-            else:
+                continue
+
+            self.worker_stats[name] = (busy, count, expandstats)
+            self.parse_end = time.time()
+            for filename, elapsed, result in results:
                 value = result[1]
                 if isinstance(value, BaseException):
                     raise value
-                else:
-                    yield result
+                self.bb_cache.parse_times[filename] = elapsed
+                yield result
 
     def parse_next(self):
         result = []
@@ -329,6 +329,7 @@ class CookerDataBuilder(object):
         if data.getVar("BB_WORKERCONTEXT", False) is None:
             bb.fetch.fetcher_init(data)
         bb.codeparser.parser_cache_init(data)
+        bb.data_smart.expansion_cache_init(data)
         bb.event.fire(bb.event.ConfigParsed(), data)
 
         if data.getVar("BB_INVALIDCONF", False) is True:
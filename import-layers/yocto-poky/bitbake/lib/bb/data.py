@@ -372,7 +372,7 @@ def build_dependencies(key, keys, shelldeps, varflagsexcl, d):
             else:
                 parsedvar = d.expandWithRefs(value, key)
                 parser = bb.codeparser.ShellParser(key, logger)
-                parser.parse_shell(parsedvar.value)
+                parser.parse_shell(parsedvar.value, value, d)
                 deps = deps | shelldeps
                 deps = deps | parsedvar.references
                 deps = deps | (keys & parser.execs) | (keys & parsedvar.execs)
@@ -423,21 +423,46 @@ def generate_dependencies(d):
     values = {}
 
     tasklist = d.getVar('__BBTASKS', False) or []
+    todo = set()
     for task in tasklist:
         deps[task], values[task] = build_dependencies(task, keys, shelldeps, varflagsexcl, d)
-        newdeps = deps[task]
+        todo |= deps[task]
+    while todo:
+        dep = todo.pop()
+        if dep in deps:
+            continue
+        deps[dep], values[dep] = build_dependencies(dep, keys, shelldeps, varflagsexcl, d)
+        todo |= deps[dep]
+    return tasklist, deps, values
+
+def dependency_closures(roots, deps, exclude):
+    """
+    Return a dict giving each of roots the sorted list of variables it
+    depends on directly or indirectly through deps, leaving out and not
+    following those in exclude, which is also removed from the sets in deps.
+    """
+    reachable = set(roots)
+    todo = list(roots)
+    while todo:
+        var = todo.pop()
+        deps[var] -= exclude
+        for dep in deps[var]:
+            if dep not in reachable:
+                reachable.add(dep)
+                todo.append(dep)
+
+    closures = {}
+    for root in roots:
         seen = set()
+        newdeps = deps[root]
         while newdeps:
-            nextdeps = newdeps
-            seen |= nextdeps
-            newdeps = set()
-            for dep in nextdeps:
-                if dep not in deps:
-                    deps[dep], values[dep] = build_dependencies(dep, keys, shelldeps, varflagsexcl, d)
-                newdeps |=  deps[dep]
-            newdeps -= seen
-        #print "For %s: %s" % (task, str(deps[task]))
-    return tasklist, deps, values
+            seen |= newdeps
+            nextdeps = set()
+            for dep in newdeps:
+                nextdeps |= deps[dep]
+            newdeps = nextdeps - seen
+        closures[root] = sorted(seen)
+    return closures
 
 def inherits_class(klass, d):
     val = d.getVar('__inherit_cache', False) or []
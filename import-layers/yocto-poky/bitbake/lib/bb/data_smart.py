@@ -28,13 +28,14 @@ BitBake build tools.
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 # Based on functions from the base bb module, Copyright 2003 Holger Schurig
 
-import copy, re, sys, traceback
+import copy, itertools, re, sys, threading, traceback, types, weakref
 from collections import MutableMapping
 import logging
 import hashlib
 import bb, bb.codeparser
 from bb   import utils
 from bb.COW  import COWDictBase
+from bb.cache import MultiProcessCache
 
 logger = logging.getLogger("BitBake.Data")
 
@@ -89,6 +90,217 @@ def infer_caller_details(loginfo, parent = False, varval = True):
         if func not in loginfo:
             loginfo['func'] = func
 
+# What python expressions can use and still have their expansion cached by
+# ExpansionCache: the datastore accessors, the contains functions, methods
+# of the values and functions which depend on nothing but their arguments
+# and the datastore. Anything else could depend on more than the datastore.
+# ExpansionCache.calls adds BB_EXPANSION_CACHE_FUNCS to cacheable_calls.
+cacheable_names = set([
+    "d", "getVar", "getVarFlag", "expand",
+    "bb", "utils", "contains", "contains_any", "base_contains",
+    "True", "False", "None",
+    "split", "join", "replace", "strip", "lstrip", "rstrip", "startswith",
+    "endswith", "lower", "upper", "find", "format",
+])
+cacheable_calls = set([
+    "bb.utils.filter", "bb.utils.to_boolean", "bb.data.inherits_class",
+    "bb.parse.BBHandler.vars_from_file",
+    "os.path.basename", "os.path.dirname", "os.path.join", "os.path.normpath",
+    "os.path.splitext",
+    "str", "int", "len", "bool", "set", "list", "sorted", "min", "max",
+    "any", "all",
+])
+
+def code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= code_names(const)
+    return names
+
+def cacheable_code(code, execs, calls):
+    """
+    Whether the expansion of python code which calls execs can be cached,
+    given the functions in calls may be called
+    """
+    names = set(cacheable_names)
+    for call in execs:
+        if call not in calls:
+            return False
+        names.update(call.split("."))
+    return code_names(code) <= names
+
+def value_digest(value):
+    if value is not None and not isinstance(value, (basestring, bool, int)):
+        return None
+    return hashlib.md5(repr(value)).digest()
+
+class ExpansionReads(object):
+    """
+    The datastore reads made while expanding an expression and digests of
+    what they returned
+    """
+    def __init__(self):
+        self.reads = []
+        self.values = []
+        self.cacheable = True
+
+    def add(self, read, value):
+        digest = value_digest(value)
+        if digest is None:
+            self.cacheable = False
+        self.reads.append(read)
+        self.values.append(digest)
+
+class ExpansionCache(MultiProcessCache):
+    """
+    Results of expanding python expressions (${@...}), shared between
+    recipes and parser processes
+
+    Each result is stored with the datastore reads the expansion made and
+    digests of what they returned; it's reused for the same expression in any
+    datastore where the same reads return the same values. Expressions using
+    names outside cacheable_names, or changing the datastore, aren't cached.
+    The expressions used during a parse are noted when it is merged, and
+    the ones left unused by max_unused_runs parses in a row dropped. A
+    parse only expands the recipes which changed, so one run not using an
+    expression says little.
+    """
+    cache_file_name = "bb_expansion.dat"
+    CACHE_VERSION = 3
+
+    # Results kept per expression, for the ones which vary between recipes
+    max_candidates = 16
+
+    # Parses which use the cache but not an expression before it's dropped
+    max_unused_runs = 20
+
+    def __init__(self):
+        MultiProcessCache.__init__(self)
+        self.enabled = False
+        self.calls = cacheable_calls
+        # Expansions of configuration snapshots can run in several threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+    def create_cachedata(self):
+        # key -> results, key -> True for the keys used during this parse
+        # and key -> the number of parses in a row which didn't use it
+        data = [{}, {}, {}]
+        return data
+
+    def init_cache(self, d):
+        self.enabled = True
+        # Rebuilt for each configuration, so functions removed from the
+        # variable stop being trusted
+        self.calls = cacheable_calls | set((d.getVar("BB_EXPANSION_CACHE_FUNCS", True) or "").split())
+        # Check if we already have the cache
+        if self.cachedata[0]:
+            return
+        MultiProcessCache.init_cache(self, d)
+
+    def key(self, varname, s):
+        return hashlib.md5("%s\0%s" % (varname, s)).digest()
+
+    def lookup(self, key, d):
+        """
+        Return the cached VariableParse for key if it's valid in d
+        """
+        candidates = self.cachedata[0].get(key, []) + self.cachedata_extras[0].get(key, [])
+        if not candidates:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # The reads are repeated in order and only as long as they return
+        # what they did before, which is what the expansion itself would do
+        current = {}
+        for reads, values, value, references, execs, contains in candidates:
+            if not execs <= self.calls:
+                continue
+            for read, expected in itertools.izip(reads, values):
+                if read not in current:
+                    current[read] = value_digest(d.getVarFlag(*read))
+                if current[read] != expected:
+                    break
+            else:
+                with self.lock:
+                    self.hits += 1
+                    self.used(key)
+                varparse = VariableParse(None, d, value)
+                varparse.references = set(references)
+                varparse.execs = set(execs)
+                for k in contains:
+                    varparse.contains[k] = set(contains[k])
+                return varparse
+
+        with self.lock:
+            self.stale += 1
+        return None
+
+    def add(self, key, reads, varparse):
+        if not reads.cacheable:
+            with self.lock:
+                self.uncacheable += 1
+            return
+        contains = {}
+        for k in varparse.contains:
+            contains[k] = frozenset(varparse.contains[k])
+        candidate = (tuple(reads.reads), tuple(reads.values), varparse.value,
+                     frozenset(varparse.references), frozenset(varparse.execs), contains)
+        with self.lock:
+            self.cachedata_extras[0].setdefault(key, []).append(candidate)
+            self.used(key)
+
+    def used(self, key):
+        # Called with lock held
+        if key not in self.cachedata[1]:
+            self.cachedata_extras[1][key] = True
+
+    def merge_data(self, source, dest):
+        for key, candidates in source[0].iteritems():
+            known = dest[0].setdefault(key, [])
+            for candidate in candidates:
+                if len(known) >= self.max_candidates:
+                    break
+                if candidate not in known:
+                    known.append(candidate)
+        dest[1].update(source[1])
+
+    def prune_data(self, data):
+        used = set(data[1]) | set(self.cachedata_extras[1])
+        if not used:
+            # Nothing was parsed, so nothing is known to be unused
+            return False
+        unused = data[2]
+        for key in data[0].keys():
+            if key in used:
+                unused.pop(key, None)
+                continue
+            unused[key] = unused.get(key, 0) + 1
+            if unused[key] > self.max_unused_runs:
+                del data[0][key]
+                del unused[key]
+        data[1].clear()
+        return True
+
+    def stats(self):
+        return (self.hits, self.stale, self.misses, self.uncacheable)
+
+expansioncache = ExpansionCache()
+
+def expansion_cache_init(d):
+    expansioncache.init_cache(d)
+
+def expansion_cache_save():
+    expansioncache.save_extras()
+
+def expansion_cache_savemerge():
+    expansioncache.save_merge()
+
 class VariableParse:
     def __init__(self, varname, d, val = None):
         self.varname = varname
@@ -107,6 +319,8 @@ class VariableParse:
             if key in self.d.expand_cache:
                 varparse = self.d.expand_cache[key]
                 var = varparse.value
+                if self.d._expandreads is not None:
+                    self.d._expandreads.add((key, "_content", True), var)
             else:
                 var = self.d.getVarFlag(key, "_content", True)
             self.references.add(key)
@@ -129,6 +343,8 @@ class VariableParse:
                 parser.log.flush()
             self.references |= parser.references
             self.execs |= parser.execs
+            if self.d._expandreads is not None and not cacheable_code(codeobj, parser.execs, expansioncache.calls):
+                self.d._expandreads.cacheable = False
 
             for k in parser.contains:
                 if k not in self.contains:
@@ -345,21 +561,63 @@ class VariableHistory(object):
             else:
                 self.variables[var] = []
 
+class VariableReadTracker(object):
+    """
+    Records which variables of a datastore (and its parents) are looked up
+    through copies of it, e.g. the configuration variables a recipe parse
+    depended upon
+    """
+    def __init__(self, d):
+        self.levels = set()
+        while d is not None:
+            self.levels.add(id(d.dict))
+            d = d._parent
+        self.reads = set()
+
 class DataSmart(MutableMapping):
     def __init__(self):
         self.dict = {}
+        # A copy keeps its own variables in dict and finds the rest through
+        # _parent, remembering what it found in _flat so lookups don't get
+        # slower as copies of copies pile up. The remembered entries are the
+        # parents' own variable dicts so changes to those are seen straight
+        # away; adding, replacing or removing one is passed on to _children.
+        self._parent = None
+        self._children = weakref.WeakValueDictionary()
+        self._flat = {}
+        # Bumped on any change to dict, see _visible_keys()
+        self._version = 0
+        self._keys = None
+        self.readtracker = None
 
         self.inchistory = IncludeHistory()
         self.varhistory = VariableHistory(self)
         self._tracking = False
 
         self.expand_cache = {}
+        # Reads made by the expansion being recorded for expansioncache
+        self._expandreads = None
+        # Digest of each variable's dict as of the last get_hash() and
+        # their combination, the combination of the digests of their names
+        # and the python methods among them; variables written since are in
+        # _hashdirty
+        self._hashdigests = None
+        self._hashtotal = 0
+        self._hashnames = 0
+        self._hashdefs = None
+        self._hashdirty = None
+        self._hashparents = None
+        # The last createSnapshot() result and the versions it was taken at,
+        # and the variables written since
+        self._snapshot = None
+        self._snapshotdirty = None
 
         # cookie monster tribute
         # Need to be careful about writes to overridedata as
         # its only a shallow copy, could influence other data store
         # copies!
         self.overridedata = {}
+        self._overridedata_shared = False
         self.overrides = None
         self.overridevars = set(["OVERRIDES", "FILE"])
         self.inoverride = False
@@ -378,6 +636,32 @@ class DataSmart(MutableMapping):
         if varname and varname in self.expand_cache:
             return self.expand_cache[varname]
 
+        # Python expressions are expensive so look for the result of an
+        # earlier expansion, here or in another datastore. Expressions
+        # expanded from within one are recorded as part of it instead.
+        if not expansioncache.enabled or self._expandreads is not None or "${@" not in s:
+            return self._expandWithRefs(s, varname)
+
+        key = expansioncache.key(varname, s)
+        varparse = expansioncache.lookup(key, self)
+        if varparse:
+            varparse.varname = varname
+            if varname:
+                self.expand_cache[varname] = varparse
+            return varparse
+
+        reads = self._expandreads = ExpansionReads()
+        version = self._version
+        try:
+            varparse = self._expandWithRefs(s, varname)
+        finally:
+            self._expandreads = None
+        if self._version != version:
+            reads.cacheable = False
+        expansioncache.add(key, reads, varparse)
+        return varparse
+
+    def _expandWithRefs(self, s, varname):
         varparse = VariableParse(varname, self)
 
         while s.find('${') != -1:
@@ -439,20 +723,71 @@ class DataSmart(MutableMapping):
         else:
             bb.fatal("Overrides could not be expanded into a stable state after 5 iterations, overrides must be being referenced by other overridden variables in some recursive fashion. Please provide your configuration to bitbake-devel so we can laugh, er, I mean try and understand how to make it work.")
 
+    def _changed(self, var = None):
+        """
+        Note a change to the variables in dict; var is given when its
+        variable dict was added, replaced or removed rather than modified
+        """
+        self._version += 1
+        if var is not None and self._children:
+            for child in self._children.values():
+                child._forget(var)
+
+    def _forget(self, var):
+        self._flat.pop(var, None)
+        if var not in self.dict and self._children:
+            for child in self._children.values():
+                child._forget(var)
+
+    def _var_changed(self, var):
+        if self._hashdirty is not None:
+            self._hashdirty.add(var)
+        if self._snapshotdirty is not None:
+            self._snapshotdirty.add(var)
+
+    def _own_overridedata(self):
+        if self._overridedata_shared:
+            self.overridedata = copy.copy(self.overridedata)
+            self._overridedata_shared = False
+
     def initVar(self, var):
         self.expand_cache = {}
         if not var in self.dict:
             self.dict[var] = {}
+            self._changed(var)
+            self._var_changed(var)
 
-    def _findVar(self, var):
-        dest = self.dict
-        while dest:
+    def _lookup(self, var):
+        """
+        Return the variable dict for var and the id of the datastore dict
+        it was found in, or (None, None)
+        """
+        d = self
+        while d is not None:
+            dest = d.dict
             if var in dest:
-                return dest[var]
+                return dest[var], id(dest)
+            found = d._flat.get(var)
+            if found is not None:
+                return found
+            d = d._parent
+        return None, None
 
-            if "_data" not in dest:
-                break
-            dest = dest["_data"]
+    def _findVar(self, var):
+        dest = self.dict
+        if var in dest:
+            level = id(dest)
+            value = dest[var]
+        elif self._parent is None:
+            return None
+        else:
+            found = self._flat.get(var)
+            if found is None:
+                found = self._flat[var] = self._parent._lookup(var)
+            value, level = found
+        if self.readtracker is not None and level in self.readtracker.levels:
+            self.readtracker.reads.add(var)
+        return value
 
     def _makeShadowCopy(self, var):
         if var in self.dict:
@@ -462,6 +797,7 @@ class DataSmart(MutableMapping):
 
         if local_var:
             self.dict[var] = copy.copy(local_var)
+            self._changed(var)
         else:
             self.initVar(var)
 
@@ -475,6 +811,8 @@ class DataSmart(MutableMapping):
         if 'op' not in loginfo:
             loginfo['op'] = "set"
         self.expand_cache = {}
+        self._changed()
+        self._var_changed(var)
         match  = __setvar_regexp__.match(var)
         if match and match.group("keyword") in __setvar_keyword__:
             base = match.group('base')
@@ -521,6 +859,7 @@ class DataSmart(MutableMapping):
                             active.append(r)
                 for a in active:
                     self.delVar(a)
+                self._own_overridedata()
                 del self.overridedata[var]
 
         # more cookies for the cookie monster
@@ -554,9 +893,11 @@ class DataSmart(MutableMapping):
         shortvar = var[:var.rfind('_')]
         while override and override.islower():
             if shortvar not in self.overridedata:
+                self._own_overridedata()
                 self.overridedata[shortvar] = []
             if [var, override] not in self.overridedata[shortvar]:
                 # Force CoW by recreating the list first
+                self._own_overridedata()
                 self.overridedata[shortvar] = list(self.overridedata[shortvar])
                 self.overridedata[shortvar].append([var, override])
             override = None
@@ -591,6 +932,7 @@ class DataSmart(MutableMapping):
             self.setVarFlag(newkey, i, dest, ignore=True)
 
         if key in self.overridedata:
+            self._own_overridedata()
             self.overridedata[newkey] = []
             for (v, o) in self.overridedata[key]:
                 self.overridedata[newkey].append([v.replace(key, newkey), o])
@@ -621,6 +963,9 @@ class DataSmart(MutableMapping):
         self.varhistory.record(**loginfo)
         self.expand_cache = {}
         self.dict[var] = {}
+        self._changed(var)
+        self._var_changed(var)
+        self._own_overridedata()
         if var in self.overridedata:
             del self.overridedata[var]
         if '_' in var:
@@ -643,6 +988,8 @@ class DataSmart(MutableMapping):
 
     def setVarFlag(self, var, flag, value, **loginfo):
         self.expand_cache = {}
+        self._changed()
+        self._var_changed(var)
         if 'op' not in loginfo:
             loginfo['op'] = "set"
         loginfo['flag'] = flag
@@ -664,6 +1011,17 @@ class DataSmart(MutableMapping):
             self.dict["__exportlist"]["_content"].add(var)
 
     def getVarFlag(self, var, flag, expand, noweakdefault=False, parsing=False):
+        if self._expandreads is not None:
+            # Record the read and not the ones it makes itself
+            reads = self._expandreads
+            self._expandreads = None
+            try:
+                value = self.getVarFlag(var, flag, expand, noweakdefault, parsing)
+            finally:
+                self._expandreads = reads
+            reads.add((var, flag, expand, noweakdefault, parsing), value)
+            return value
+
         local_var = self._findVar(var)
         value = None
         if flag == "_content" and var in self.overridedata and not parsing:
@@ -760,6 +1118,8 @@ class DataSmart(MutableMapping):
 
     def delVarFlag(self, var, flag, **loginfo):
         self.expand_cache = {}
+        self._changed()
+        self._var_changed(var)
         local_var = self._findVar(var)
         if not local_var:
             return
@@ -790,6 +1150,8 @@ class DataSmart(MutableMapping):
 
     def setVarFlags(self, var, flags, **loginfo):
         self.expand_cache = {}
+        self._changed()
+        self._var_changed(var)
         infer_caller_details(loginfo)
         if not var in self.dict:
             self._makeShadowCopy(var)
@@ -803,6 +1165,9 @@ class DataSmart(MutableMapping):
             self.dict[var][i] = flags[i]
 
     def getVarFlags(self, var, expand = False, internalflags=False):
+        if self._expandreads is not None:
+            # Not recorded, but functions in BB_EXPANSION_CACHE_FUNCS may use it
+            self._expandreads.cacheable = False
         local_var = self._findVar(var)
         flags = {}
 
@@ -836,25 +1201,99 @@ class DataSmart(MutableMapping):
                 self.dict[var]["_content"] = content
             else:
                 del self.dict[var]
+            self._changed(var)
+            self._var_changed(var)
 
     def createCopy(self):
         """
-        Create a copy of self by setting _data to self
+        Create a copy of self by making self its parent
         """
         # we really want this to be a DataSmart...
         data = DataSmart()
-        data.dict["_data"] = self.dict
+        data._parent = self
+        self._children[id(data)] = data
         data.varhistory = self.varhistory.copy()
         data.varhistory.datasmart = data
         data.inchistory = self.inchistory.copy()
 
         data._tracking = self._tracking
+        data.readtracker = self.readtracker
 
         data.overrides = None
         data.overridevars = copy.copy(self.overridevars)
         # Should really be a deepcopy but has heavy overhead.
-        # Instead, we're careful with writes.
+        # Instead, we're careful with writes, and neither side copies
+        # the dict until it writes to it.
+        data.overridedata = self.overridedata
+        data._overridedata_shared = self._overridedata_shared = True
+
+        return data
+
+    def createSnapshot(self):
+        """
+        Create a copy of self sharing nothing that changes with self or its
+        parents, so it can be read while they are written to, e.g. from
+        another thread. The same copy is returned until something changes
+        and it mustn't be written to.
+        """
+        versions = []
+        d = self
+        while d is not None:
+            versions.append(d._version)
+            d = d._parent
+        previous = self._snapshot
+        if previous is not None and previous[0] == versions:
+            return previous[1]
+
+        data = DataSmart()
+        if previous is not None and previous[0][1:] == versions[1:]:
+            # Only variables of self were written, the others' dicts can be
+            # shared with the previous copy as neither changes them
+            data.dict = dict(previous[1].dict)
+            for var in self._snapshotdirty:
+                vardict = self._lookup(var)[0]
+                if vardict:
+                    data.dict[var] = dict((flag, copy.copy(value)) for flag, value in vardict.iteritems())
+                else:
+                    data.dict.pop(var, None)
+        else:
+            for var in self._visible_keys():
+                vardict = self._lookup(var)[0]
+                data.dict[var] = dict((flag, copy.copy(value)) for flag, value in vardict.iteritems())
+        self._snapshotdirty = set()
+        data.varhistory = self.varhistory.copy()
+        data.varhistory.datasmart = data
+        data.inchistory = self.inchistory.copy()
+        data._tracking = self._tracking
+
+        data.overridevars = copy.copy(self.overridevars)
+        # The lists in it are replaced rather than modified
         data.overridedata = copy.copy(self.overridedata)
+        # Work the overrides out now rather than on the first read, which
+        # could be one of several made at once
+        data.need_overrides()
+
+        self._snapshot = (versions, data)
+        return data
+
+    def createReader(self):
+        """
+        Create a copy of a createSnapshot() result for a single thread to read
+        from, so threads reading the same snapshot don't share the state
+        expansions keep. Unlike createCopy() nothing of self is changed, as
+        several threads can be doing it at once.
+        """
+        data = DataSmart()
+        data._parent = self
+        data.varhistory = self.varhistory
+        data.inchistory = self.inchistory
+        data._tracking = self._tracking
+
+        data.overridevars = self.overridevars
+        data.overridedata = self.overridedata
+        data._overridedata_shared = True
+        data.overrides = self.overrides
+        data.overridesset = self.overridesset
 
         return data
 
@@ -875,31 +1314,36 @@ class DataSmart(MutableMapping):
                 self.setVar(key, referrervalue.replace(ref, value))
 
     def localkeys(self):
+        if self._expandreads is not None:
+            self._expandreads.cacheable = False
         for key in self.dict:
-            if key != '_data':
-                yield key
+            yield key
+
+    def _visible_keys(self):
+        """
+        Return the set of variables set in self or its parents and not
+        deleted since. The set is reused until something changes so it
+        mustn't be modified.
+        """
+        parentkeys = None
+        if self._parent is not None:
+            parentkeys = self._parent._visible_keys()
+        if self._keys is not None and self._keys[0] is parentkeys and self._keys[1] == self._version:
+            return self._keys[2]
+
+        keys = set(parentkeys or ())
+        for key, value in self.dict.iteritems():
+            if value:
+                keys.add(key)
+            else:
+                keys.discard(key)
+        self._keys = (parentkeys, self._version, keys)
+        return keys
 
     def __iter__(self):
-        deleted = set()
+        if self._expandreads is not None:
+            self._expandreads.cacheable = False
         overrides = set()
-        def keylist(d):        
-            klist = set()
-            for key in d:
-                if key == "_data":
-                    continue
-                if key in deleted:
-                    continue
-                if key in overrides:
-                    continue
-                if not d[key]:
-                    deleted.add(key)
-                    continue
-                klist.add(key)
-
-            if "_data" in d:
-                klist |= keylist(d["_data"])
-
-            return klist
 
         self.need_overrides()
         for var in self.overridedata:
@@ -910,8 +1354,9 @@ class DataSmart(MutableMapping):
                     if set(o.split("_")).issubset(self.overridesset):
                         overrides.add(var)
 
-        for k in keylist(self.dict):
-             yield k
+        for k in self._visible_keys():
+             if k not in overrides:
+                 yield k
 
         for k in overrides:
              yield k
@@ -932,7 +1377,7 @@ class DataSmart(MutableMapping):
     def __delitem__(self, var):
         self.delVar(var)
 
-    def get_hash(self):
+    def _get_hash_data(self):
         data = {}
         d = self.createCopy()
         bb.data.expandKeys(d)
@@ -965,5 +1410,121 @@ class DataSmart(MutableMapping):
                     value = d.getVar(i, False) or ""
                     data.update({i:value})
 
-        data_str = str([(k, data[k]) for k in sorted(data.keys())])
-        return hashlib.md5(data_str).hexdigest()
+        return d, keys, data
+
+    def _hash_digest(self, var):
+        vardict = self._lookup(var)[0]
+        if not vardict:
+            return 0, False
+        digest = int(hashlib.md5(str((var, sorted(vardict.items())))).hexdigest(), 16)
+        content = vardict.get("_content")
+        return digest, bool(vardict.get("python") and isinstance(content, basestring) and content.startswith("def "))
+
+    @staticmethod
+    def _hash_name(var):
+        return int(hashlib.md5(var).hexdigest(), 16)
+
+    def _update_hash_digests(self):
+        parents = []
+        d = self._parent
+        while d is not None:
+            parents.append(d._version)
+            d = d._parent
+
+        if self._hashdigests is None or self._hashparents != parents:
+            # Variables written in a parent aren't tracked here
+            digests = {}
+            total = 0
+            names = 0
+            defs = set()
+            for var in self._visible_keys():
+                if var.startswith("__"):
+                    continue
+                digest, method = self._hash_digest(var)
+                if digest:
+                    digests[var] = digest
+                    total ^= digest
+                    names ^= self._hash_name(var)
+                    if method:
+                        defs.add(var)
+            self._hashdigests = digests
+            self._hashtotal = total
+            self._hashnames = names
+            self._hashdefs = defs
+            self._hashparents = parents
+        else:
+            digests = self._hashdigests
+            for var in self._hashdirty:
+                if var.startswith("__"):
+                    continue
+                old = digests.pop(var, 0)
+                if old:
+                    self._hashtotal ^= old
+                    self._hashnames ^= self._hash_name(var)
+                    self._hashdefs.discard(var)
+                digest, method = self._hash_digest(var)
+                if digest:
+                    digests[var] = digest
+                    self._hashtotal ^= digest
+                    self._hashnames ^= self._hash_name(var)
+                    if method:
+                        self._hashdefs.add(var)
+        self._hashdirty = set()
+
+    def get_hash(self):
+        """
+        Return a hash of the configuration, changing whenever the value or
+        flags of a variable not in BB_HASHCONFIG_WHITELIST change. Rather
+        than the variables' final values it covers what they are computed
+        from: each variable's own value, flags, overrides and appends are
+        kept as a digest which is only recomputed after the variable has
+        been written to. As a result it may change for writes which end up
+        making no difference, but never misses one which does. Values must
+        be replaced through the setters and not modified in place.
+        """
+        self._update_hash_digests()
+
+        total = self._hashtotal
+        config_whitelist = set((self.getVar("BB_HASHCONFIG_WHITELIST", True) or "").split())
+        for var in config_whitelist:
+            total ^= self._hashdigests.get(var, 0)
+
+        data = [total]
+        for key in ["__BBTASKS", "__BBANONFUNCS", "__BBHANDLERS"]:
+            bb_list = sorted(self.getVar(key, False) or [])
+            data.append((key, bb_list))
+
+            if key == "__BBANONFUNCS":
+                for i in bb_list:
+                    data.append((i, self.getVar(i, False) or ""))
+
+        return hashlib.md5(str(data)).hexdigest()
+
+    def get_hash_components(self):
+        """
+        Split the information get_hash() covers into a structural hash and
+        a digest per variable. The structural hash covers the set of
+        variable names and anything which can influence a parse other than
+        through reading a variable (event handlers, python methods and the
+        task/anonymous function lists), so a change confined to the digests
+        only affects data which actually read the changed variables. Both
+        come from the digests get_hash() keeps, so only the variables
+        written to since the last call are hashed again.
+        """
+        self._update_hash_digests()
+
+        config_whitelist = set((self.getVar("BB_HASHCONFIG_WHITELIST", True) or "").split())
+        digests = dict(self._hashdigests)
+        names = self._hashnames
+        for var in config_whitelist:
+            if digests.pop(var, 0):
+                names ^= self._hash_name(var)
+
+        structure = [names]
+        handlers = set(self.getVar("__BBHANDLERS", False) or [])
+        for var in sorted((handlers | self._hashdefs) - config_whitelist):
+            structure.append((var, digests.pop(var, 0)))
+        for key in ["__BBTASKS", "__BBANONFUNCS", "__BBHANDLERS"]:
+            structure.append((key, sorted(self.getVar(key, False) or [])))
+
+        return hashlib.md5(str(structure)).hexdigest(), digests
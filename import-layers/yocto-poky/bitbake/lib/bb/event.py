@@ -58,6 +58,7 @@ def get_class_handlers():
 def set_class_handlers(h):
     global _handlers
     _handlers = h
+    _handler_table.clear()
 
 def clean_class_handlers():
     return bb.compat.OrderedDict()
@@ -69,6 +70,9 @@ _ui_logfilters = {}
 _ui_handler_seq = 0
 _event_handler_map = {}
 _catchall_handlers = {}
+# The (name, handler) pairs to run for each event class, worked out from the
+# above when such an event is first fired after handlers were changed
+_handler_table = {}
 _eventfilter = None
 _uiready = False
 
@@ -96,18 +100,26 @@ def execute_handler(name, handler, event, d):
         if addedd:
             del __builtins__['d']
 
+def _class_handlers(eventclass):
+    """Return the (name, handler) pairs of the handlers of eventclass"""
+    handlers = _handler_table.get(eventclass)
+    if handlers is None:
+        eid = str(eventclass)[8:-2]
+        evt_hmap = _event_handler_map.get(eid, {})
+        handlers = tuple((name, handler) for name, handler in _handlers.iteritems()
+                         if name in _catchall_handlers or name in evt_hmap)
+        _handler_table[eventclass] = handlers
+    return handlers
+
 def fire_class_handlers(event, d):
     if isinstance(event, logging.LogRecord):
         return
 
-    eid = str(event.__class__)[8:-2]
-    evt_hmap = _event_handler_map.get(eid, {})
-    for name, handler in _handlers.iteritems():
-        if name in _catchall_handlers or name in evt_hmap:
-            if _eventfilter:
-                if not _eventfilter(name, handler, event, d):
-                    continue
-            execute_handler(name, handler, event, d)
+    for name, handler in _class_handlers(event.__class__):
+        if _eventfilter:
+            if not _eventfilter(name, handler, event, d):
+                continue
+        execute_handler(name, handler, event, d)
 
 ui_queue = []
 @atexit.register
@@ -186,6 +198,7 @@ def register(name, handler, mask=None, filename=None, lineno=None):
         return AlreadyRegistered
 
     if handler is not None:
+        _handler_table.clear()
         # handle string containing python code
         if isinstance(handler, basestring):
             tmp = "def %s(e):\n%s" % (name, handler)
@@ -224,6 +237,7 @@ def register(name, handler, mask=None, filename=None, lineno=None):
 def remove(name, handler):
     """Remove an Event handler"""
     _handlers.pop(name)
+    _handler_table.clear()
 
 def set_eventfilter(func):
     global _eventfilter
@@ -272,9 +286,17 @@ def set_UIHmask(handlerNum, level, debug_domains, mask):
     if '*' in mask:
         _ui_logfilters[handlerNum].update(None, level, debug_domains)
     else:
-        _ui_logfilters[handlerNum].update(mask, level, debug_domains)
+        _ui_logfilters[handlerNum].update(set(mask), level, debug_domains)
     return True
 
+def get_UIHstats(handlerNum):
+    if not handlerNum in _ui_handlers:
+        return None
+    stats = getattr(_ui_handlers[handlerNum].event, "stats", None)
+    if stats is None:
+        return None
+    return stats()
+
 def getName(e):
     """Returns the name of a class or class instance"""
     if getattr(e, "__name__", None) == None:
@@ -28,10 +28,14 @@ BitBake build tools.
 from __future__ import absolute_import
 from __future__ import print_function
 import os, re
+import errno
+import shutil
 import signal
 import logging
 import urllib
 import urlparse
+import threading
+import Queue
 import bb.persist_data, bb.utils
 import bb.checksum
 from bb import data
@@ -715,6 +719,96 @@ def update_stamp(ud, d):
             bb.utils.remove(ud.donestamp)
             raise
 
+def content_store_path(d, sha256):
+    """
+    Return where the file with the given sha256 is kept in the content store,
+    BB_FETCH_CONTENT_STORE, or None if there isn't one
+    """
+    store = d.getVar("BB_FETCH_CONTENT_STORE", True)
+    if not store or not sha256:
+        return None
+    return os.path.join(store, "sha256", sha256[:2], sha256)
+
+def read_checksums(stamp):
+    try:
+        with open(stamp, "rb") as cachefile:
+            return pickle.Unpickler(cachefile).load()
+    except Exception:
+        return {}
+
+def link_file(src, dest):
+    """
+    Replace dest with a hard link to src, or a symbolic link if src can't be
+    linked to from there
+    """
+    tmp = "%s.%d.tmp" % (dest, os.getpid())
+    bb.utils.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        os.symlink(os.path.abspath(src), tmp)
+    os.rename(tmp, dest)
+
+def fetch_from_store(ud, d):
+    """
+    If the content store has a file with the sha256 ud expects, make
+    ud.localpath that file and return True. The checksums of a file are
+    verified when it's added, so the done stamp is written from the ones
+    recorded then.
+    """
+    if not ud.needdonestamp or not ud.sha256_expected or not ud.method.supports_checksum(ud):
+        return False
+    path = content_store_path(d, ud.sha256_expected)
+    if not path or not os.path.exists(path):
+        return False
+    checksums = read_checksums(path + ".done")
+    if checksums.get("sha256") != ud.sha256_expected:
+        return False
+    if ud.md5_expected and checksums.get("md5") != ud.md5_expected:
+        return False
+
+    logger.debug(1, "Using %s from the content store for %s" % (path, ud.url))
+    bb.utils.mkdirhier(os.path.dirname(ud.localpath))
+    link_file(path, ud.localpath)
+    with open(ud.donestamp, "wb") as cachefile:
+        p = pickle.Pickler(cachefile, pickle.HIGHEST_PROTOCOL)
+        p.dump(checksums)
+    return True
+
+def add_to_store(ud, d):
+    """
+    Add the file fetched for ud to the content store under its sha256, or if
+    the store has that content already, make ud.localpath a link to it so
+    the two share their space
+    """
+    if not ud.needdonestamp or not ud.localpath or not ud.method.supports_checksum(ud):
+        return
+    sha256 = read_checksums(ud.donestamp).get("sha256")
+    path = content_store_path(d, sha256)
+    if not path:
+        return
+
+    if os.path.exists(path):
+        if not os.path.islink(ud.localpath) and not os.path.samefile(path, ud.localpath):
+            link_file(path, ud.localpath)
+        return
+
+    bb.utils.mkdirhier(os.path.dirname(path))
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    bb.utils.remove(tmp)
+    try:
+        os.link(os.path.realpath(ud.localpath), tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(ud.localpath, tmp)
+    os.rename(tmp, path)
+    # Written last as it's what marks the file as complete
+    shutil.copyfile(ud.donestamp, tmp)
+    os.rename(tmp, path + ".done")
+
 def subprocess_setup():
     # Python installs a SIGPIPE handler by default. This is usually not what
     # non-Python subprocesses expect.
@@ -1010,6 +1104,16 @@ def try_mirrors(fetch, d, origud, mirrors, check = False):
     uri is the original uri we're trying to download
     mirrors is the list of mirrors we're going to try
     """
+    if check:
+        prober = StatusProber(d)
+        try:
+            ret, errors = prober.run([mirror_checks(origud, mirrors, d)])[0]
+        finally:
+            prober.close()
+        if not ret and errors:
+            raise errors[0][1]
+        return ret
+
     ld = d.createCopy()
 
     uris, uds = build_mirroruris(origud, mirrors, ld)
@@ -1020,6 +1124,18 @@ def try_mirrors(fetch, d, origud, mirrors, check = False):
             return ret
     return None
 
+def mirror_checks(origud, mirrors, d):
+    """
+    Return the checks of the mirror urls of origud for StatusProber.run(),
+    in the order try_mirrors() would try them
+    """
+    ld = d.createCopy()
+
+    uris, uds = build_mirroruris(origud, mirrors, ld)
+
+    # Each check reads its own copy of the datastore as they run in parallel
+    return [(ud.host, try_mirror_url, (origud, ud, ld.createCopy(), True)) for ud in uds]
+
 def trusted_network(d, url):
     """
     Use a trusted url during download if networking is enabled and
@@ -1564,6 +1680,8 @@ class Fetch(object):
  
                 if verify_donestamp(ud, self.d) and not m.need_update(ud, self.d):
                     localpath = ud.localpath
+                elif fetch_from_store(ud, self.d):
+                    localpath = ud.localpath
                 elif m.try_premirror(ud, self.d):
                     logger.debug(1, "Trying PREMIRRORS")
                     mirrors = mirror_from_string(self.d.getVar('PREMIRRORS', True))
@@ -1618,6 +1736,11 @@ class Fetch(object):
 
                 update_stamp(ud, self.d)
 
+                try:
+                    add_to_store(ud, self.d)
+                except (OSError, IOError) as e:
+                    logger.warn("Couldn't add %s to the content store: %s" % (ud.localpath, e))
+
             except BBFetchException as e:
                 if isinstance(e, ChecksumError):
                     logger.error("Checksum failure fetching %s" % u)
@@ -1635,23 +1758,43 @@ class Fetch(object):
         if not urls:
             urls = self.urls
 
-        for u in urls:
-            ud = self.ud[u]
-            ud.setup_localpath(self.d)
-            m = ud.method
-            logger.debug(1, "Testing URL %s", u)
-            # First try checking uri, u, from PREMIRRORS
-            mirrors = mirror_from_string(self.d.getVar('PREMIRRORS', True))
-            ret = try_mirrors(self, self.d, ud, mirrors, True)
-            if not ret:
-                # Next try checking from the original uri, u
-                try:
-                    ret = m.checkstatus(self, ud, self.d)
-                except:
-                    # Finally, try checking uri, u, from MIRRORS
-                    mirrors = mirror_from_string(self.d.getVar('MIRRORS', True))
-                    ret = try_mirrors(self, self.d, ud, mirrors, True)
-
+        prober = StatusProber(self.d)
+        try:
+            # First try checking each uri, u, from PREMIRRORS and from the
+            # original uri, all of them at once
+            premirrors = mirror_from_string(self.d.getVar('PREMIRRORS', True))
+            groups = []
+            for u in urls:
+                ud = self.ud[u]
+                ud.setup_localpath(self.d)
+                logger.debug(1, "Testing URL %s", u)
+                checks = mirror_checks(ud, premirrors, self.d)
+                checks.append((ud.host, ud.method.checkstatus, (ud, self.d.createCopy())))
+                groups.append(checks)
+            results = prober.run(groups)
+
+            # Finally, try checking the ones whose original uri failed with an
+            # exception from MIRRORS
+            mirrors = mirror_from_string(self.d.getVar('MIRRORS', True))
+            retry = []
+            for u, checks, (ret, errors) in zip(urls, groups, results):
+                if ret:
+                    continue
+                for index, e in errors:
+                    if index != len(checks) - 1:
+                        raise e
+                if errors:
+                    retry.append(u)
+            retried = prober.run([mirror_checks(self.ud[u], mirrors, self.d) for u in retry])
+        finally:
+            prober.close()
+
+        retried = dict(zip(retry, retried))
+        for u, (ret, errors) in zip(urls, results):
+            if not ret and u in retried:
+                ret, errors = retried[u]
+                if not ret and errors:
+                    raise errors[0][1]
             if not ret:
                 raise FetchError("URL %s doesn't work" % u, u)
 
@@ -1738,6 +1881,141 @@ class FetchConnectionCache(object):
             self.cache[cn].close()
             del self.cache[cn]
 
+class StatusProbeWorker(threading.Thread):
+    """
+    A thread of a StatusProber. It's what the checks it runs get as the
+    fetch argument of checkstatus(), providing the thread's connection_cache.
+    """
+    def __init__(self, prober):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.prober = prober
+        self.connection_cache = FetchConnectionCache()
+        # The host whose checks this thread is running
+        self.host = None
+
+    def run(self):
+        try:
+            while True:
+                check = self.prober.next_check(self)
+                if check is None:
+                    break
+                key, index, host, function, args, results = check
+                ret = None
+                error = None
+                try:
+                    ret = function(self, *args)
+                except Exception as e:
+                    error = e
+                self.prober.check_done(key, ret and error is None)
+                results.put(((key[1], index), ret, error))
+        finally:
+            self.connection_cache.close_connections()
+
+class StatusProber(object):
+    """
+    Runs checks of whether urls exist in parallel, in up to
+    BB_FETCH_CHECK_THREADS threads with at most BB_FETCH_CHECK_HOST_THREADS
+    of them checking the same host at once. Each thread keeps its own
+    connection cache and goes on with checks on the same host while there
+    are any, so these reuse its connection.
+    """
+    def __init__(self, d):
+        self.threads = int(d.getVar("BB_FETCH_CHECK_THREADS", True) or 8)
+        self.hostthreads = int(d.getVar("BB_FETCH_CHECK_HOST_THREADS", True) or 4)
+        self.cond = threading.Condition()
+        # Checks waiting, threads on each host and the groups already found
+        self.pending = []
+        self.running = {}
+        self.found = set()
+        self.workers = []
+        self.closing = False
+
+    def run(self, groups):
+        """
+        Run groups of checks, each a (host, function, args) tuple calling
+        function(fetch, *args). The first true value a check of a group
+        returns is the group's result and its checks still waiting are
+        dropped then. Returns a list of the groups' results (None where
+        there was none) and the (index, exception) of their checks which
+        raised one, in the order they were given.
+        """
+        results = Queue.Queue()
+        rets = [None] * len(groups)
+        errors = [[] for _ in groups]
+        waiting = []
+        with self.cond:
+            for group, checks in enumerate(groups):
+                key = (id(results), group)
+                for index, (host, function, args) in enumerate(checks):
+                    self.pending.append((key, index, host, function, args, results))
+                    waiting.append(key)
+            while len(self.workers) < min(self.threads, len(self.pending)):
+                worker = StatusProbeWorker(self)
+                worker.start()
+                self.workers.append(worker)
+            self.cond.notify_all()
+
+        for _ in waiting:
+            (group, index), ret, error = results.get()
+            if error is not None:
+                errors[group].append((index, error))
+            elif ret and not rets[group]:
+                rets[group] = ret
+        with self.cond:
+            self.found.difference_update(waiting)
+
+        return [(ret, sorted(raised)) for ret, raised in zip(rets, errors)]
+
+    def next_check(self, worker):
+        """
+        Return the next check worker should run, or None once closing
+        """
+        with self.cond:
+            while not self.closing:
+                for check in self.pending:
+                    if check[0] in self.found:
+                        # Its group's result is known
+                        self.pending.remove(check)
+                        check[5].put(((check[0][1], check[1]), None, None))
+                        break
+                else:
+                    for check in self.pending:
+                        if check[2] == worker.host:
+                            self.pending.remove(check)
+                            return check
+                    self.leave_host(worker)
+                    for check in self.pending:
+                        host = check[2]
+                        if self.running.get(host, 0) < self.hostthreads:
+                            self.pending.remove(check)
+                            self.running[host] = self.running.get(host, 0) + 1
+                            worker.host = host
+                            return check
+                    self.cond.wait()
+            self.leave_host(worker)
+            return None
+
+    def leave_host(self, worker):
+        if worker.host is not None:
+            self.running[worker.host] -= 1
+            worker.host = None
+            self.cond.notify_all()
+
+    def check_done(self, key, found):
+        if found:
+            with self.cond:
+                self.found.add(key)
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
 from . import cvs
 from . import git
 from . import gitsm
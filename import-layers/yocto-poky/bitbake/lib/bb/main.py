@@ -216,6 +216,10 @@ class BitBakeConfigParameters(cookerdata.ConfigParameters):
         parser.add_option("-B", "--bind", help = "The name/address for the bitbake server to bind to.",
                    action = "store", dest = "bind", default = False)
 
+        parser.add_option("", "--async-server", help = "Handle each request to the server in a thread of its own, serving commands "
+                   "which only read the configuration from a snapshot of it while others run (xmlrpc server only).",
+                   action = "store_true", dest = "async_server", default = False)
+
         parser.add_option("", "--no-setscene", help = "Do not run any setscene tasks. sstate will be ignored and everything needed, built.",
                    action = "store_true", dest = "nosetscene", default = False)
 
@@ -285,8 +289,14 @@ def start_server(servermodule, configParams, configuration, features):
     single_use = not configParams.server_only
     if configParams.bind:
         (host, port) = configParams.bind.split(':')
-        server.initServer((host, int(port)), single_use)
+        if configParams.async_server:
+            server.initServer((host, int(port)), single_use, concurrent=True)
+        else:
+            server.initServer((host, int(port)), single_use)
         configuration.interface = [ server.serverImpl.host, server.serverImpl.port ]
+    elif configParams.async_server:
+        server.initServer(single_use=single_use, concurrent=True)
+        configuration.interface = []
     else:
         server.initServer(single_use=single_use)
         configuration.interface = []
@@ -354,6 +364,10 @@ def bitbake_main(configParams, configuration):
         raise BBMainException("FATAL: If '-B' or '--bind' is defined, we must "
                               "set the servertype as 'xmlrpc'.\n")
 
+    if configParams.async_server and configParams.servertype != "xmlrpc":
+        raise BBMainException("FATAL: If '--async-server' is defined, we must "
+                              "set the servertype as 'xmlrpc'.\n")
+
     if configParams.remote_server and configParams.servertype != "xmlrpc":
         raise BBMainException("FATAL: If '--remote-server' is defined, we must "
                               "set the servertype as 'xmlrpc'.\n")
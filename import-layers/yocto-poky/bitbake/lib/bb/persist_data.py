@@ -25,6 +25,7 @@ import collections
 import logging
 import os.path
 import sys
+import threading
 import warnings
 from bb.compat import total_ordering
 from collections import Mapping
@@ -40,56 +41,107 @@ if sqlversion[0] < 3 or (sqlversion[0] == 3 and sqlversion[1] < 3):
 
 
 logger = logging.getLogger("BitBake.PersistData")
-if hasattr(sqlite3, 'enable_shared_cache'):
-    try:
-        sqlite3.enable_shared_cache(True)
-    except sqlite3.OperationalError:
-        pass
+
+
+class SQLConnection(sqlite3.Connection):
+    """
+    Connection shared by the tables of a database in a thread, see connect().
+    Keeps track of the transaction scopes open on it and of the values read
+    and written through it.
+    """
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.pid = os.getpid()
+        self.depth = 0
+        self.tables = set()
+        self.cache = {}
+        self.data_version = None
+
+    def check_cache(self):
+        """Forget the values cached if another connection changed the database since"""
+        row = self.execute("PRAGMA data_version;").fetchone()
+        # sqlite before 3.8.4 can't tell, nothing is cached then
+        if row is None or row[0] != self.data_version:
+            self.cache.clear()
+            self.data_version = row and row[0]
 
 
 @total_ordering
 class SQLTable(collections.MutableMapping):
-    """Object representing a table/domain in the database"""
-    def __init__(self, cachefile, table):
+    """
+    Object representing a table/domain in the database
+
+    Used as a context manager, groups the changes made to the database from
+    the current thread in a single transaction, committed when the outermost
+    scope is left and rolled back if it is left through an exception.
+    """
+    def __init__(self, cachefile, table, wal=False):
         self.cachefile = cachefile
         self.table = table
-        self.cursor = connect(self.cachefile)
+        self.connection = connect(self.cachefile, wal)
 
-        self._execute("CREATE TABLE IF NOT EXISTS %s(key TEXT, value TEXT);"
-                      % table)
+        if table not in self.connection.tables:
+            self._execute("CREATE TABLE IF NOT EXISTS %s(key TEXT, value TEXT);"
+                          % table)
+            self._execute("CREATE INDEX IF NOT EXISTS %s_key ON %s(key);"
+                          % (table, table))
+            self.connection.tables.add(table)
 
     def _execute(self, *query):
         """Execute a query, waiting to acquire a lock if necessary"""
         count = 0
         while True:
             try:
-                return self.cursor.execute(*query)
+                return self.connection.execute(*query)
             except sqlite3.OperationalError as exc:
-                if 'database is locked' in str(exc) and count < 500:
+                # Within a transaction, the statements before this one
+                # would have to be run again too
+                if 'database is locked' in str(exc) and count < 500 and not self.connection.depth:
                     count = count + 1
-                    self.cursor.close()
-                    self.cursor = connect(self.cachefile)
                     continue
                 raise
 
+    def _cache(self):
+        """The values of the table known from this connection"""
+        if not self.connection.depth:
+            self.connection.check_cache()
+        return self.connection.cache.setdefault(self.table, {})
+
     def __enter__(self):
-        self.cursor.__enter__()
+        if not self.connection.depth:
+            # Take the write lock now rather than at the first change, when
+            # waiting for it would mean running the transaction again
+            self._execute("BEGIN IMMEDIATE;")
+            self.connection.check_cache()
+        self.connection.depth += 1
         return self
 
-    def __exit__(self, *excinfo):
-        self.cursor.__exit__(*excinfo)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.depth -= 1
+        if not self.connection.depth:
+            if exc_type is None:
+                self.connection.execute("COMMIT;")
+            else:
+                self.connection.execute("ROLLBACK;")
+                self.connection.cache.clear()
 
     def __getitem__(self, key):
-        data = self._execute("SELECT * from %s where key=?;" %
-                             self.table, [key])
-        for row in data:
-            return row[1]
-        raise KeyError(key)
+        cache = self._cache()
+        if key in cache:
+            return cache[key]
+        row = self._execute("SELECT * from %s where key=?;" %
+                            self.table, [key]).fetchone()
+        if row is None:
+            raise KeyError(key)
+        cache[key] = row[1]
+        return row[1]
 
     def __delitem__(self, key):
-        if key not in self:
-            raise KeyError(key)
-        self._execute("DELETE from %s where key=?;" % self.table, [key])
+        with self:
+            if key not in self:
+                raise KeyError(key)
+            self._execute("DELETE from %s where key=?;" % self.table, [key])
+            self._cache().pop(key, None)
 
     def __setitem__(self, key, value):
         if not isinstance(key, basestring):
@@ -97,18 +149,20 @@ class SQLTable(collections.MutableMapping):
         elif not isinstance(value, basestring):
             raise TypeError('Only string values are supported')
 
-        data = self._execute("SELECT * from %s where key=?;" %
-                                   self.table, [key])
-        exists = len(list(data))
-        if exists:
-            self._execute("UPDATE %s SET value=? WHERE key=?;" % self.table,
-                          [value, key])
-        else:
-            self._execute("INSERT into %s(key, value) values (?, ?);" %
-                          self.table, [key, value])
+        with self:
+            data = self._execute("UPDATE %s SET value=? WHERE key=?;" % self.table,
+                                 [value, key])
+            if not data.rowcount:
+                self._execute("INSERT into %s(key, value) values (?, ?);" %
+                              self.table, [key, value])
+            self._cache()[key] = value
 
     def __contains__(self, key):
-        return key in set(self)
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
 
     def __len__(self):
         data = self._execute("SELECT COUNT(key) FROM %s;" % self.table)
@@ -144,7 +198,14 @@ class SQLTable(collections.MutableMapping):
         return self._execute("SELECT * FROM %s;" % self.table)
 
     def clear(self):
-        self._execute("DELETE FROM %s;" % self.table)
+        with self:
+            self._execute("DELETE FROM %s;" % self.table)
+            self._cache().clear()
+
+    def update(self, *args, **kwargs):
+        """Same as for any mapping, in a single transaction"""
+        with self:
+            collections.MutableMapping.update(self, *args, **kwargs)
 
     def has_key(self, key):
         return key in self
@@ -198,10 +259,34 @@ class PersistData(object):
         """
         del self.data[domain][key]
 
-def connect(database):
-    connection = sqlite3.connect(database, timeout=5, isolation_level=None)
-    connection.execute("pragma synchronous = off;")
-    connection.text_factory = str
+_connections = threading.local()
+
+def connect(database, wal=False):
+    """
+    Return the connection to database of the current thread, opening it
+    the first time. Connections are not carried over to forked processes.
+    With wal, the database is switched to WAL journaling if it can be.
+    """
+    connections = getattr(_connections, "connections", None)
+    if connections is None:
+        connections = _connections.connections = {}
+    connection = connections.get(database)
+    if connection is None or connection.pid != os.getpid():
+        connection = sqlite3.connect(database, timeout=5, isolation_level=None,
+                                     factory=SQLConnection)
+        connection.execute("pragma synchronous = off;")
+        if wal:
+            # Readers and a writer don't block each other in WAL mode, but
+            # it needs the directory to be writable and doesn't work on
+            # network filesystems, the default journal is kept then
+            try:
+                mode = connection.execute("pragma journal_mode = WAL;").fetchone()[0]
+            except sqlite3.DatabaseError as exc:
+                mode = str(exc)
+            if mode.lower() != "wal":
+                logger.debug(1, "Not using WAL mode for %s: %s", database, mode)
+        connection.text_factory = str
+        connections[database] = connection
     return connection
 
 def persist(domain, d):
@@ -215,4 +300,5 @@ def persist(domain, d):
 
     bb.utils.mkdirhier(cachedir)
     cachefile = os.path.join(cachedir, "bb_persist_data.sqlite3")
-    return SQLTable(cachefile, domain)
+    wal = bb.utils.to_boolean(d.getVar("BB_PERSIST_WAL", True), False)
+    return SQLTable(cachefile, domain, wal)
@@ -94,29 +94,47 @@ def _logged_communicate(pipe, log, input, extrafiles):
                 if data is not None:
                     func(data)
 
+    def readpipes(selected):
+        for fobj, output in ((pipe.stdout, outdata), (pipe.stderr, errdata)):
+            if fobj is not None and fobj in selected:
+                try:
+                    data = fobj.read()
+                except IOError as err:
+                    if err.errno != errno.EAGAIN and err.errno != errno.EWOULDBLOCK:
+                        raise
+                    data = None
+                if data:
+                    output.append(data)
+                    log.write(data)
+
+    if pipe.stdout is None and pipe.stderr is None:
+        # The output goes elsewhere, so nothing here ends when the command
+        # exits: check for that often at first, then less and less often
+        timeout, maxtimeout = 0.01, 0.1
+    else:
+        timeout, maxtimeout = 1, 1
+
     try:
         while pipe.poll() is None:
             rlist = rin
+            r = []
             try:
-                r,w,e = select.select (rlist, [], [], 1)
+                r,w,e = select.select (rlist, [], [], timeout)
             except OSError as e:
                 if e.errno != errno.EINTR:
                     raise
 
-            if pipe.stdout in r:
-                data = pipe.stdout.read()
-                if data is not None:
-                    outdata.append(data)
-                    log.write(data)
-
-            if pipe.stderr in r:
-                data = pipe.stderr.read()
-                if data is not None:
-                    errdata.append(data)
-                    log.write(data)
-
+            readpipes(r)
             readextras(r)
 
+            if not r:
+                # Let the log pass on anything it holds back while the
+                # command is quiet
+                log.flush()
+                timeout = min(timeout * 2, maxtimeout)
+
+        # What the command wrote just before exiting
+        readpipes([pipe.stdout, pipe.stderr])
     finally:    
         log.flush()
 
@@ -0,0 +1,494 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# pyshscan.py - fast path through shell scripts for dependency analysis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Scan a shell script for the commands it runs and the functions it defines.
+
+bb.codeparser only needs the words of the simple commands of a script and
+the names of its functions, loops and case patterns, which is a small part
+of what pyshlex and pyshyacc build. parse() splits the script with regular
+expressions rather than character by character, follows the grammar with a
+small recursive descent parser and returns the commands in the shapes
+pyshyacc.parse() uses, leaving out pipelines, lists, conditions, loops and
+redirections but keeping what is inside them.
+
+It is meant to agree exactly with pyshyacc, quirks included, on the scripts
+it accepts: anything it does not handle the same way (arithmetic expansion,
+here-documents it cannot delimit, syntax errors...) raises Unsupported and
+the caller should use pyshyacc.parse() instead, which also reports the
+errors.
+"""
+
+import re
+
+import pyshlex
+from sherrors import ShellSyntaxError
+from pyshyacc import SimpleCommand, ForLoop, FunDef, BraceGroup, Case
+
+class Unsupported(Exception):
+    """The script needs the full parser"""
+
+_blanks = re.compile(r"[ \t]*")
+_operator = re.compile(r"<<-|<<|>>|<&|>&|<>|>\||&&|\|\||;;|[&|;<>()]")
+_unquoted = re.compile(r"[^ \t\n&|;<>()\\'\"`$]*")
+_name = re.compile(r"[0-9a-zA-Z_]*")
+_heredoc_line = re.compile(r"(?:[^\\\n]|\\.)*\\?", re.S)
+
+# Characters which matter inside each kind of quoted or expansion sequence,
+# keyed by the character closing it
+_specials = {
+    '"': re.compile(r"[$\\`\"]"),
+    '`': re.compile(r"[$\\`\"']"),
+    ')': re.compile(r"[$\\`\"')]"),
+    '}': re.compile(r"[$\\`\"'}]"),
+}
+
+def _skip(s, i, cuts):
+    """Return the end of the quoted or expansion sequence starting at s[i],
+    noting the line continuations removed from it in cuts"""
+    c = s[i]
+    if c == "'":
+        end = s.find("'", i + 1)
+        if end < 0:
+            raise Unsupported
+        return end + 1
+    if c == '\\':
+        if i + 1 == len(s):
+            raise Unsupported
+        if s[i + 1] == '\n':
+            cuts.append(i)
+        return i + 2
+    if c == '$':
+        i += 1
+        c = s[i:i + 1]
+        if not c:
+            raise Unsupported
+        if c == '(':
+            if s[i + 1:i + 2] in ('(', ''):
+                raise Unsupported
+            c = ')'
+        elif c == '{':
+            c = '}'
+        elif c in '@*#?-$!0':
+            return i + 1
+        else:
+            return _name.match(s, i).end()
+
+    specials = _specials[c]
+    i += 1
+    while True:
+        match = specials.search(s, i)
+        if match is None:
+            raise Unsupported
+        i = match.start()
+        if s[i] == c:
+            return i + 1
+        i = _skip(s, i, cuts)
+
+def _heredoc(s, i, op, name):
+    """Skip the here-document starting at s[i], return where the script
+    resumes"""
+    content = []
+    while True:
+        end = _heredoc_line.match(s, i).end()
+        line = s[i:end]
+        if op == '<<-':
+            line = line.lstrip('\t')
+        if end == len(s):
+            if line != name:
+                content.append(line)
+            i = end
+            break
+        i = end + 1
+        if line == name:
+            break
+        content.append(line + '\n')
+
+    # An empty document or one being a reserved word does not make it to
+    # the parser as a TOKEN
+    content = ''.join(content)
+    if not content or pyshlex.get_reserved(content):
+        raise Unsupported
+    return i
+
+_FOR = ('For', 'Case')
+
+def tokenize(s):
+    """Split s the way pyshlex.PLYLexer does, but with the here-documents
+    left out, and return a list of (type, text) tuples"""
+    tokens = []
+    push = tokens.append
+    n = len(s)
+    i = 0
+    # [operator, name] from a here-document operator to the end of its line
+    heredoc = None
+    while True:
+        i = _blanks.match(s, i).end()
+        if i == n:
+            break
+
+        c = s[i]
+        if c == '\n':
+            if heredoc is not None:
+                if heredoc[1] is None:
+                    raise Unsupported
+                push(('NEWLINE', c))
+                i = _heredoc(s, i + 1, heredoc[0], heredoc[1])
+                heredoc = None
+            else:
+                push(('NEWLINE', c))
+                i += 1
+            continue
+        if c == '#':
+            if heredoc is not None and heredoc[1] is None:
+                raise Unsupported
+            # pyshlex wants a newline after a comment
+            i = s.find('\n', i)
+            if i < 0:
+                raise Unsupported
+            continue
+        if c == '\\' and s[i + 1:i + 2] == '\n':
+            i += 2
+            continue
+
+        match = _operator.match(s, i)
+        if match is not None:
+            if heredoc is not None and heredoc[1] is None:
+                raise Unsupported
+            text = match.group()
+            i = match.end()
+            if text == '|':
+                push(('PIPE', text))
+            else:
+                type = pyshlex.is_op(text)
+                if type in ('DLESS', 'DLESSDASH'):
+                    # pyshlex would take a second one on the same line, but
+                    # they are not worth the trouble
+                    if heredoc is not None:
+                        raise Unsupported
+                    heredoc = [text, None]
+                push((type, text))
+            continue
+
+        start = i
+        cuts = []
+        while True:
+            i = _unquoted.match(s, i).end()
+            if i == n or s[i] not in "\\'\"`$":
+                break
+            i = _skip(s, i, cuts)
+        if cuts:
+            pieces = []
+            for cut in cuts:
+                pieces.append(s[start:cut])
+                start = cut + 2
+            pieces.append(s[start:i])
+            text = ''.join(pieces)
+        else:
+            text = s[start:i]
+        delim = s[i:i + 1]
+
+        if heredoc is not None and heredoc[1] is None:
+            try:
+                name = pyshlex.unquote_wordtree(pyshlex.make_wordtree(text))
+            except ShellSyntaxError:
+                raise Unsupported
+            if name in ('', '<', '>'):
+                raise Unsupported
+            heredoc[1] = name
+            push(('HERENAME', text))
+            continue
+
+        if '=' in text and not delim:
+            type = 'TOKEN'
+            if not text.startswith('=') and pyshlex.is_name(text[:text.find('=')]):
+                type = 'ASSIGNMENT_WORD'
+        else:
+            type = pyshlex.get_reserved(text)
+            if type is None:
+                type = 'TOKEN'
+                if delim in ('<', '>') and pyshlex.are_digits(text):
+                    type = 'IO_NUMBER'
+            elif type == 'In':
+                # Only the third token of a for loop or a case is reserved
+                if len(tokens) < 2 or tokens[-2][0] not in _FOR or tokens[-1][0] in _FOR:
+                    type = 'TOKEN'
+        push((type, text))
+
+    if heredoc is not None:
+        raise Unsupported
+    return tokens
+
+_REDIRECTS = frozenset(['LESS', 'LESSAND', 'GREATER', 'GREATAND', 'DGREAT', 'LESSGREAT',
+                        'CLOBBER', 'DLESS', 'DLESSDASH', 'IO_NUMBER'])
+_COMPOUNDS = frozenset(['Lbrace', 'LPARENS', 'For', 'Case', 'If', 'While', 'Until'])
+# What may start a command
+_START = frozenset(['TOKEN', 'ASSIGNMENT_WORD', 'Bang']) | _REDIRECTS | _COMPOUNDS
+# What pyshyacc turns into arguments after a command name rather than
+# reading as reserved words
+_SUFFIX = frozenset(['TOKEN', 'ASSIGNMENT_WORD', 'Fi', 'For', 'Done', 'Do', 'Until', 'If',
+                     'Then', 'Bang'])
+_TOKEN = ('TOKEN', 'Fi')
+
+class _Parser(object):
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.tokens.append(('EOF', None))
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0]
+
+    def expect(self, type):
+        if self.tokens[self.pos][0] != type:
+            raise Unsupported
+        self.pos += 1
+
+    def newlines(self):
+        while self.tokens[self.pos][0] == 'NEWLINE':
+            self.pos += 1
+
+    def script(self):
+        cmds = []
+        self.newlines()
+        while self.peek() != 'EOF':
+            # Unlike in compound lists, commands do not need a separator
+            # between them here
+            self.and_or(cmds)
+            type = self.peek()
+            if type == 'COMMA':
+                self.pos += 1
+                self.newlines()
+            elif type == 'AMP':
+                # pyshyacc returns an asynchronous list ending a line in a
+                # shape bb.codeparser cannot process
+                self.pos += 1
+                if self.peek() not in _START:
+                    raise Unsupported
+            else:
+                self.newlines()
+        return cmds
+
+    def compound_list(self, cmds):
+        self.newlines()
+        self.and_or(cmds)
+        while True:
+            type = self.peek()
+            if type == 'COMMA':
+                self.pos += 1
+                self.newlines()
+                if self.peek() not in _START:
+                    return
+            elif type == 'AMP':
+                # Either not implemented by pyshyacc or returned in a shape
+                # bb.codeparser cannot process
+                raise Unsupported
+            elif type == 'NEWLINE':
+                self.newlines()
+                if self.peek() not in _START:
+                    return
+            else:
+                return
+            self.and_or(cmds)
+
+    def and_or(self, cmds):
+        self.pipeline(cmds)
+        while self.peek() in ('AND_IF', 'OR_IF'):
+            self.pos += 1
+            self.newlines()
+            self.pipeline(cmds)
+
+    def pipeline(self, cmds):
+        if self.peek() == 'Bang':
+            self.pos += 1
+        self.command(cmds)
+        while self.peek() == 'PIPE':
+            self.pos += 1
+            self.newlines()
+            self.command(cmds)
+
+    def command(self, cmds):
+        type, text = self.tokens[self.pos]
+        if type in _COMPOUNDS:
+            self.compound(cmds)
+            while self.peek() in _REDIRECTS:
+                self.redirect()
+        elif type == 'TOKEN' and self.tokens[self.pos + 1][0] == 'LPARENS':
+            self.pos += 2
+            self.expect('RPARENS')
+            self.newlines()
+            if self.peek() not in _COMPOUNDS:
+                raise Unsupported
+            body = []
+            self.compound(body)
+            # Not implemented by pyshyacc
+            if self.peek() in _REDIRECTS:
+                raise Unsupported
+            cmds.append(('function_definition', FunDef(text, ('brace_group', BraceGroup(body)))))
+        else:
+            self.simple_command(cmds)
+
+    def compound(self, cmds):
+        type = self.peek()
+        self.pos += 1
+        if type == 'Lbrace':
+            self.compound_list(cmds)
+            self.expect('Rbrace')
+        elif type == 'LPARENS':
+            self.compound_list(cmds)
+            self.expect('RPARENS')
+        elif type == 'If':
+            while True:
+                self.compound_list(cmds)
+                self.expect('Then')
+                self.compound_list(cmds)
+                type = self.peek()
+                self.pos += 1
+                if type == 'Elif':
+                    continue
+                if type == 'Else':
+                    self.compound_list(cmds)
+                    self.expect('Fi')
+                elif type != 'Fi':
+                    raise Unsupported
+                break
+        elif type in ('While', 'Until'):
+            self.compound_list(cmds)
+            self.do_group(cmds)
+        elif type == 'For':
+            type, name = self.tokens[self.pos]
+            if type not in _TOKEN:
+                raise Unsupported
+            self.pos += 1
+            # Leaving "in" out is not implemented by pyshyacc
+            self.expect('In')
+            items = []
+            while self.peek() in _TOKEN:
+                items.append(('TOKEN', self.tokens[self.pos][1]))
+                self.pos += 1
+            if self.peek() == 'COMMA':
+                self.pos += 1
+            elif self.peek() != 'NEWLINE':
+                raise Unsupported
+            self.newlines()
+            body = []
+            self.do_group(body)
+            cmds.append(('for_clause', ForLoop(name, items, body)))
+        else:
+            self.case(cmds)
+
+    def case(self, cmds):
+        type, name = self.tokens[self.pos]
+        if type not in _TOKEN:
+            raise Unsupported
+        self.pos += 1
+        self.expect('In')
+        self.newlines()
+        items = []
+        while self.peek() != 'Esac':
+            bracket = self.peek() == 'LPARENS'
+            if bracket:
+                self.pos += 1
+            # pyshyacc keeps the first pattern of an item and then a '|'
+            # for each of the others
+            type, pattern = self.tokens[self.pos]
+            patterns = [('TOKEN', pattern)]
+            while True:
+                if type not in _TOKEN:
+                    raise Unsupported
+                self.pos += 1
+                if self.peek() != 'PIPE':
+                    break
+                patterns.append(('TOKEN', '|'))
+                self.pos += 1
+                type = self.peek()
+            self.expect('RPARENS')
+            self.newlines()
+            body = []
+            if self.peek() not in ('DSEMI', 'Esac'):
+                self.compound_list(body)
+            if self.peek() == 'DSEMI':
+                self.pos += 1
+                self.newlines()
+            elif self.peek() == 'Esac':
+                # pyshyacc loses the patterns of a last item without ';;'
+                # written with an opening parenthesis
+                if bracket:
+                    patterns = []
+            else:
+                raise Unsupported
+            items.append((patterns, body))
+        self.pos += 1
+        cmds.append(('case_clause', Case(name, items)))
+
+    def do_group(self, cmds):
+        self.expect('Do')
+        self.compound_list(cmds)
+        self.expect('Done')
+
+    def redirect(self):
+        type = self.peek()
+        if type == 'IO_NUMBER':
+            self.pos += 1
+            type = self.peek()
+        self.pos += 1
+        if type in ('DLESS', 'DLESSDASH'):
+            self.expect('HERENAME')
+        else:
+            self.expect('TOKEN')
+
+    def simple_command(self, cmds):
+        words = []
+        assigns = []
+        tokens = self.tokens
+        start = self.pos
+        while True:
+            type, text = tokens[self.pos]
+            if type == 'ASSIGNMENT_WORD':
+                assigns.append(('ASSIGNMENT_WORD', text.split('=', 1)))
+                self.pos += 1
+            elif type in _REDIRECTS:
+                self.redirect()
+            else:
+                break
+
+        if self.pos == start:
+            if type != 'TOKEN':
+                raise Unsupported
+            words.append(('cmd_name', text))
+        elif type in _TOKEN:
+            words.append(('cmd_word', text))
+        else:
+            cmds.append(('simple_command', SimpleCommand(words, [], assigns)))
+            return
+        self.pos += 1
+
+        while True:
+            type, text = tokens[self.pos]
+            if type in _SUFFIX:
+                words.append(('TOKEN', text))
+                self.pos += 1
+            elif type in _REDIRECTS:
+                self.redirect()
+            else:
+                break
+        cmds.append(('simple_command', SimpleCommand(words, [], assigns)))
+
+def parse(input):
+    """Return the commands of the script input in the shape pyshyacc.parse()
+    would, or raise Unsupported"""
+    return [_Parser(tokenize(input)).script()]
@@ -23,6 +23,8 @@ Handles preparation and execution of a queue of tasks
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import copy
+import heapq
+import collections
 import os
 import sys
 import signal
@@ -31,6 +33,7 @@ import fcntl
 import errno
 import logging
 import re
+import struct
 import bb
 from bb import msg, data, event
 from bb import monitordisk
@@ -88,11 +91,121 @@ runQueueFailed = 7
 runQueueCleanUp = 8
 runQueueComplete = 9
 
+# Resources used by one run of a task: wall clock and cpu seconds, peak
+# resident memory in kB and bytes read and written
+TaskResources = collections.namedtuple("TaskResources", "wall cpu rss io")
+
+class TaskResourceHistory(object):
+    """
+    Resources used by tasks in earlier builds, keyed by (PN, taskname) and
+    kept in PERSISTENT_DIR (or CACHE)
+    """
+    CACHE_VERSION = "2"
+    FILENAME = "bb_task_resources.dat"
+
+    def __init__(self, d):
+        self.filename = None
+        self.history = {}
+        self.updated = {}
+        self.tasknames = None
+
+        cachedir = (d.getVar("PERSISTENT_DIR", True) or
+                    d.getVar("CACHE", True))
+        if cachedir:
+            self.filename = os.path.join(cachedir, self.FILENAME)
+            self.history = self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, "rb") as f:
+                version, history = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return {}
+        if version != self.CACHE_VERSION:
+            return {}
+        return dict((key, TaskResources(*res)) for key, res in history.iteritems())
+
+    def estimate(self, pn, taskname):
+        """
+        Return the expected TaskResources for a task, falling back to the
+        average over all recipes for tasks of that name, or None
+        """
+        if (pn, taskname) in self.history:
+            return self.history[(pn, taskname)]
+
+        if self.tasknames is None:
+            totals = {}
+            for (_, name), res in self.history.iteritems():
+                if name not in totals:
+                    totals[name] = [0, [0.0] * len(res)]
+                totals[name][0] += 1
+                totals[name][1] = [a + b for a, b in zip(totals[name][1], res)]
+            self.tasknames = dict((name, TaskResources(*[v / count for v in total]))
+                                  for name, (count, total) in totals.iteritems())
+        return self.tasknames.get(taskname)
+
+    def task_durations(self, rqdata):
+        """
+        Return the expected wall clock time of every task in the runqueue,
+        using the average of the known tasks for the ones never seen, or
+        None if there is no history for any of them
+        """
+        durations = []
+        for taskid in xrange(len(rqdata.runq_fnid)):
+            fn = rqdata.taskData.fn_index[rqdata.runq_fnid[taskid]]
+            res = self.estimate(rqdata.dataCache.pkg_fn[fn], rqdata.runq_task[taskid])
+            durations.append(res.wall if res else None)
+
+        known = [wall for wall in durations if wall is not None]
+        if not known:
+            return None
+        average = sum(known) / len(known)
+        return [average if wall is None else wall for wall in durations]
+
+    def record(self, pn, taskname, resources):
+        """
+        Fold a new measurement into the history. Peak memory decays slowly so
+        a single lean run doesn't hide a task which sometimes needs a lot.
+        """
+        old = self.history.get((pn, taskname))
+        if old:
+            resources = TaskResources((old.wall + resources.wall) / 2,
+                                      (old.cpu + resources.cpu) / 2,
+                                      max(resources.rss, (old.rss + resources.rss) / 2),
+                                      (old.io + resources.io) / 2)
+        self.history[(pn, taskname)] = resources
+        self.updated[(pn, taskname)] = resources
+        self.tasknames = None
+
+    def save(self):
+        if not self.filename or not self.updated:
+            return
+
+        bb.utils.mkdirhier(os.path.dirname(self.filename))
+        lf = bb.utils.lockfile(self.filename + ".lock")
+        try:
+            # Another build may have saved its own results since we loaded
+            history = self.load()
+            history.update(self.updated)
+            history = dict((key, tuple(res)) for key, res in history.iteritems())
+            tmpfile = self.filename + ".tmp.%s" % os.getpid()
+            with open(tmpfile, "wb") as f:
+                pickle.dump((self.CACHE_VERSION, history), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpfile, self.filename)
+        except (IOError, OSError) as e:
+            logger.warning("Unable to save task resource history to %s: %s" % (self.filename, e))
+        finally:
+            bb.utils.unlockfile(lf)
+        self.updated = {}
+
 class RunQueueScheduler(object):
     """
     Control the order tasks are scheduled in.
     """
     name = "basic"
+    # Whether the scheduler uses the TaskResourceHistory, which is only
+    # kept, and what tasks use only measured, for the ones which do
+    uses_history = False
 
     def __init__(self, runqueue, rqdata):
         """
@@ -117,34 +230,43 @@ class RunQueueScheduler(object):
 
         self.rev_prio_map = None
 
+    def init_ready_queue(self):
+        """
+        Turn the buildable list into a heap of (priority, taskid) once the
+        subclass has settled on its priority map
+        """
+        self.rev_prio_map = range(self.numTasks)
+        for taskid in xrange(self.numTasks):
+            self.rev_prio_map[self.prio_map[taskid]] = taskid
+
+        self.buildable = [(self.rev_prio_map[taskid], taskid) for taskid in self.buildable]
+        heapq.heapify(self.buildable)
+
     def next_buildable_task(self):
         """
-        Return the id of the first task we find that is buildable
+        Return the id of the highest priority buildable task whose stamp
+        isn't already being built
         """
-        self.buildable = [x for x in self.buildable if not self.rq.runq_running[x] == 1]
-        if not self.buildable:
-            return None
-        if len(self.buildable) == 1:
-            taskid = self.buildable[0]
-            stamp = self.stamps[taskid]
-            if stamp not in self.rq.build_stamps.itervalues():
-                return taskid
-
-        if not self.rev_prio_map:
-            self.rev_prio_map = range(self.numTasks)
-            for taskid in xrange(self.numTasks):
-                self.rev_prio_map[self.prio_map[taskid]] = taskid
+        if self.rev_prio_map is None:
+            self.init_ready_queue()
 
+        # Tasks which started running are dropped from the heap lazily;
+        # tasks whose stamp is in flight are set aside and put back
         best = None
-        bestprio = None
-        for taskid in self.buildable:
-            prio = self.rev_prio_map[taskid]
-            if bestprio is None or bestprio > prio:
-                stamp = self.stamps[taskid]
-                if stamp in self.rq.build_stamps.itervalues():
-                    continue
-                bestprio = prio
-                best = taskid
+        blocked = []
+        while self.buildable:
+            prio, taskid = self.buildable[0]
+            if self.rq.runq_running[taskid] == 1:
+                heapq.heappop(self.buildable)
+                continue
+            if self.stamps[taskid] in self.rq.build_stamps2:
+                blocked.append(heapq.heappop(self.buildable))
+                continue
+            best = taskid
+            break
+
+        for entry in blocked:
+            heapq.heappush(self.buildable, entry)
 
         return best
 
@@ -156,7 +278,10 @@ class RunQueueScheduler(object):
             return self.next_buildable_task()
 
     def newbuilable(self, task):
-        self.buildable.append(task)
+        if self.rev_prio_map is None:
+            self.buildable.append(task)
+        else:
+            heapq.heappush(self.buildable, (self.rev_prio_map[task], task))
 
 class RunQueueSchedulerSpeed(RunQueueScheduler):
     """
@@ -171,16 +296,9 @@ class RunQueueSchedulerSpeed(RunQueueScheduler):
         """
         RunQueueScheduler.__init__(self, runqueue, rqdata)
 
-        sortweight = sorted(copy.deepcopy(self.rqdata.runq_weight))
-        copyweight = copy.deepcopy(self.rqdata.runq_weight)
-        self.prio_map = []
-
-        for weight in sortweight:
-            idx = copyweight.index(weight)
-            self.prio_map.append(idx)
-            copyweight[idx] = -1
-
-        self.prio_map.reverse()
+        weight = self.rqdata.runq_weight
+        self.prio_map = sorted(xrange(self.numTasks), key=lambda taskid: (weight[taskid], taskid),
+                               reverse=True)
 
 class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
     """
@@ -198,21 +316,164 @@ class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
         #FIXME - whilst this groups all fnids together it does not reorder the
         #fnid groups optimally.
 
-        basemap = copy.deepcopy(self.prio_map)
-        self.prio_map = []
-        while (len(basemap) > 0):
-            entry = basemap.pop(0)
-            self.prio_map.append(entry)
+        groups = {}
+        order = []
+        for entry in self.prio_map:
             fnid = self.rqdata.runq_fnid[entry]
-            todel = []
-            for entry in basemap:
-                entry_fnid = self.rqdata.runq_fnid[entry]
-                if entry_fnid == fnid:
-                    todel.append(basemap.index(entry))
-                    self.prio_map.append(entry)
-            todel.reverse()
-            for idx in todel:
-                del basemap[idx]
+            if fnid not in groups:
+                groups[fnid] = []
+                order.append(fnid)
+            groups[fnid].append(entry)
+        self.prio_map = []
+        for fnid in order:
+            self.prio_map.extend(groups[fnid])
+
+class RunQueueSchedulerResources(RunQueueSchedulerSpeed):
+    """
+    The speed scheduler, but using the cpu time and peak memory (of the
+    task's whole process tree, as bitbake-worker samples it) each task
+    needed in earlier builds. Tasks which would push the expected memory use
+    of the running tasks over BB_SCHEDULER_MEMORY_LIMIT (MiB, default 90% of
+    physical memory) wait, and once the running tasks are expected to keep
+    every cpu busy, IO bound tasks are preferred over cpu bound ones.
+    """
+    name = "resources"
+    uses_history = True
+
+    # How many of the highest priority buildable tasks to consider
+    lookahead = 16
+
+    def __init__(self, runqueue, rqdata):
+        RunQueueSchedulerSpeed.__init__(self, runqueue, rqdata)
+
+        self.cpus = bb.utils.cpu_count()
+        limit = self.rq.cfgData.getVar("BB_SCHEDULER_MEMORY_LIMIT", True)
+        if limit:
+            self.memlimit = int(limit) * 1024
+        else:
+            self.memlimit = os.sysconf("SC_PAGE_SIZE") / 1024 * os.sysconf("SC_PHYS_PAGES") * 9 / 10
+
+        # Tasks we know nothing about are assumed to keep one cpu busy
+        self.task_cpus = [1.0] * self.numTasks
+        self.task_rss = [0] * self.numTasks
+        history = self.rq.taskhistory
+        if history:
+            for taskid in xrange(self.numTasks):
+                fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[taskid]]
+                res = history.estimate(self.rqdata.dataCache.pkg_fn[fn], self.rqdata.runq_task[taskid])
+                if res:
+                    self.task_cpus[taskid] = res.cpu / max(res.wall, 0.01)
+                    self.task_rss[taskid] = res.rss
+        self.have_iobound = min(self.task_cpus or [1.0]) < 1.0
+
+    def next(self):
+        """
+        Return the id of the task we should build next
+        """
+        if self.rq.stats.active >= self.rq.number_tasks:
+            return None
+        if self.rev_prio_map is None:
+            self.init_ready_queue()
+
+        running = self.rq.build_stamps.keys()
+        cpus = sum(self.task_cpus[taskid] for taskid in running)
+        rss = sum(self.task_rss[taskid] for taskid in running)
+        cpubound = self.have_iobound and cpus >= self.cpus
+
+        # The highest priority task which fits, or when the cpus are busy,
+        # the highest priority IO bound task which fits if there is one
+        best = None
+        candidates = []
+        while self.buildable and len(candidates) < self.lookahead:
+            entry = heapq.heappop(self.buildable)
+            taskid = entry[1]
+            if self.rq.runq_running[taskid] == 1:
+                continue
+            candidates.append(entry)
+            if self.stamps[taskid] in self.rq.build_stamps2:
+                continue
+            if running and rss + self.task_rss[taskid] > self.memlimit:
+                continue
+            if not cpubound or self.task_cpus[taskid] < 1.0:
+                best = taskid
+                break
+            if best is None:
+                best = taskid
+
+        for entry in candidates:
+            heapq.heappush(self.buildable, entry)
+
+        return best
+
+class RunQueueSchedulerCriticalPath(RunQueueSchedulerSpeed):
+    """
+    A scheduler which starts the tasks on the longest remaining path through
+    the task graph first, measuring the paths with how long each task took
+    in earlier builds. Ties, and builds with no recorded history at all, are
+    ordered by task weight as in the speed scheduler.
+    """
+    name = "criticalpath"
+    uses_history = True
+
+    def __init__(self, runqueue, rqdata):
+        RunQueueSchedulerSpeed.__init__(self, runqueue, rqdata)
+
+        if not self.rq.taskhistory:
+            return
+        durations = self.rq.taskhistory.task_durations(self.rqdata)
+        if not durations:
+            return
+
+        length = self.remaining_path_length(durations)
+        weight = self.rqdata.runq_weight
+        self.prio_map = sorted(xrange(self.numTasks), key=lambda taskid: (length[taskid], weight[taskid], taskid),
+                               reverse=True)
+
+    def remaining_path_length(self, durations):
+        """
+        Return the time from starting each task until the last task which
+        depends on it can finish, given unlimited parallelism
+        """
+        depends = self.rqdata.runq_depends
+        revdeps = self.rqdata.runq_revdeps
+
+        length = [0.0] * self.numTasks
+        pending = [len(revdeps[taskid]) for taskid in xrange(self.numTasks)]
+        ready = [taskid for taskid in xrange(self.numTasks) if not pending[taskid]]
+        while ready:
+            taskid = ready.pop()
+            length[taskid] = durations[taskid] + max([length[revdep] for revdep in revdeps[taskid]] or [0.0])
+            for dep in depends[taskid]:
+                pending[dep] -= 1
+                if not pending[dep]:
+                    ready.append(dep)
+        return length
+
+def get_schedulers(d):
+    """
+    Return the scheduler classes, the ones in this module and the ones
+    BB_SCHEDULERS names
+    """
+    schedulers = set(obj for obj in globals().values()
+                         if type(obj) is type and
+                            issubclass(obj, RunQueueScheduler))
+
+    user_schedulers = d.getVar("BB_SCHEDULERS", True)
+    if user_schedulers:
+        for sched in user_schedulers.split():
+            if not "." in sched:
+                bb.note("Ignoring scheduler '%s' from BB_SCHEDULERS: not an import" % sched)
+                continue
+
+            modname, name = sched.rsplit(".", 1)
+            try:
+                module = __import__(modname, fromlist=(name,))
+            except ImportError as exc:
+                logger.critical("Unable to import scheduler '%s' from '%s': %s" % (name, modname, exc))
+                raise SystemExit(1)
+            else:
+                schedulers.add(getattr(module, name))
+    return schedulers
 
 class RunQueueData:
     """
@@ -884,18 +1145,29 @@ class RunQueueData:
         if hasattr(bb.parse.siggen, "tasks_resolved"):
             bb.parse.siggen.tasks_resolved(virtmap, virtpnmap, self.dataCache)
 
-        # Iterate over the task list and call into the siggen code
-        dealtwith = set()
-        todeal = set(range(len(self.runq_fnid)))
-        while len(todeal) > 0:
-            for task in todeal.copy():
-                if len(self.runq_depends[task] - dealtwith) == 0:
-                    dealtwith.add(task)
-                    todeal.remove(task)
-                    procdep = []
-                    for dep in self.runq_depends[task]:
-                        procdep.append(self.taskData.fn_index[self.runq_fnid[dep]] + "." + self.runq_task[dep])
-                    self.runq_hash[task] = bb.parse.siggen.get_taskhash(self.taskData.fn_index[self.runq_fnid[task]], self.runq_task[task], procdep, self.dataCache)
+        # Hand the task list to the siggen code with each task after the
+        # ones it depends on
+        taskkeys = []
+        depsleft = []
+        order = []
+        for task in xrange(len(self.runq_fnid)):
+            taskkeys.append(self.taskData.fn_index[self.runq_fnid[task]] + "." + self.runq_task[task])
+            depsleft.append(len(self.runq_depends[task]))
+            if not self.runq_depends[task]:
+                order.append(task)
+        for task in order:
+            for revdep in self.runq_revdeps[task]:
+                depsleft[revdep] -= 1
+                if not depsleft[revdep]:
+                    order.append(revdep)
+
+        tasks = []
+        for task in order:
+            deps = [taskkeys[dep] for dep in self.runq_depends[task]]
+            tasks.append((self.taskData.fn_index[self.runq_fnid[task]], self.runq_task[task], deps))
+        hashes = bb.parse.siggen.get_taskhashes(tasks, self.dataCache)
+        for task, taskhash in zip(order, hashes):
+            self.runq_hash[task] = taskhash
 
         bb.parse.siggen.writeout_file_checksum_cache()
         return len(self.runq_fnid)
@@ -924,12 +1196,68 @@ class RunQueueData:
                            self.rqdata.runq_depends[task],
                            self.rqdata.runq_revdeps[task])
 
+class RunQueueStamps(object):
+    """
+    Stamp file names and timestamps for the tasks of a prepared runqueue.
+    The first lookup in a stamps directory lists it so missing stamps cost
+    nothing more; existing stamps are stat'd once. The entries for a task
+    have to be refreshed with invalidate() once it has run.
+    """
+    def __init__(self, rqdata):
+        self.rqdata = rqdata
+        self.stampfiles = {}
+        self.dirs = {}
+        self.mtimes = {}
+
+    def stampfile(self, task, taskname):
+        key = (task, taskname)
+        if key not in self.stampfiles:
+            fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+            self.stampfiles[key] = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
+        return self.stampfiles[key]
+
+    def mtime(self, stampfile):
+        """
+        Return the modification time of a stamp, or None if it doesn't exist
+        """
+        if stampfile in self.mtimes:
+            return self.mtimes[stampfile]
+
+        dirname, basename = os.path.split(stampfile)
+        if dirname not in self.dirs:
+            try:
+                self.dirs[dirname] = set(os.listdir(dirname))
+            except OSError:
+                self.dirs[dirname] = set()
+
+        mtime = None
+        if basename in self.dirs[dirname]:
+            mtime = self.stat(stampfile)
+        self.mtimes[stampfile] = mtime
+        return mtime
+
+    def stat(self, stampfile):
+        try:
+            return os.stat(stampfile)[stat.ST_MTIME]
+        except OSError:
+            return None
+
+    def invalidate(self, task):
+        """
+        Re-read the stamps of a task after it has run or been skipped
+        """
+        taskname = self.rqdata.runq_task[task]
+        for name in (taskname, taskname + "_setscene"):
+            stampfile = self.stampfile(task, name)
+            self.mtimes[stampfile] = self.stat(stampfile)
+
 class RunQueue:
     def __init__(self, cooker, cfgData, dataCache, taskData, targets):
 
         self.cooker = cooker
         self.cfgData = cfgData
         self.rqdata = RunQueueData(self, cooker, cfgData, dataCache, taskData, targets)
+        self.stampindex = RunQueueStamps(self.rqdata)
 
         self.stamppolicy = cfgData.getVar("BB_STAMP_POLICY", True) or "perfile"
         self.hashvalidate = cfgData.getVar("BB_HASHCHECK_FUNCTION", True) or None
@@ -946,6 +1274,18 @@ class RunQueue:
         self.workerpipe = None
         self.fakeworker = None
         self.fakeworkerpipe = None
+        self._uses_history = None
+
+    def uses_history(self):
+        """
+        Whether the BB_SCHEDULER selected needs the resources used by tasks
+        to be measured and kept
+        """
+        if self._uses_history is None:
+            name = self.cfgData.getVar("BB_SCHEDULER", True) or "speed"
+            self._uses_history = any(getattr(scheduler, "uses_history", False) for scheduler in get_schedulers(self.cfgData)
+                                     if scheduler.name == name)
+        return self._uses_history
 
     def _start_worker(self, fakeroot = False, rqexec = None):
         logger.debug(1, "Starting bitbake-worker")
@@ -980,6 +1320,7 @@ class RunQueue:
             "buildname" : self.cfgData.getVar("BUILDNAME", True),
             "date" : self.cfgData.getVar("DATE", True),
             "time" : self.cfgData.getVar("TIME", True),
+            "measureresources" : self.uses_history(),
         }
 
         worker.stdin.write("<cookerconfig>" + pickle.dumps(self.cooker.configuration) + "</cookerconfig>")
@@ -1037,13 +1378,7 @@ class RunQueue:
         return fds
 
     def check_stamp_task(self, task, taskname = None, recurse = False, cache = None):
-        def get_timestamp(f):
-            try:
-                if not os.access(f, os.F_OK):
-                    return None
-                return os.stat(f)[stat.ST_MTIME]
-            except:
-                return None
+        stamps = self.stampindex
 
         if self.stamppolicy == "perfile":
             fulldeptree = False
@@ -1057,10 +1392,11 @@ class RunQueue:
         if taskname is None:
             taskname = self.rqdata.runq_task[task]
 
-        stampfile = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
+        stampfile = stamps.stampfile(task, taskname)
 
         # If the stamp is missing, it's not current
-        if not os.access(stampfile, os.F_OK):
+        t1 = stamps.mtime(stampfile)
+        if t1 is None:
             logger.debug(2, "Stampfile %s not available", stampfile)
             return False
         # If it's a 'nostamp' task, it's not current
@@ -1076,15 +1412,14 @@ class RunQueue:
             cache = {}
 
         iscurrent = True
-        t1 = get_timestamp(stampfile)
         for dep in self.rqdata.runq_depends[task]:
             if iscurrent:
                 fn2 = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[dep]]
                 taskname2 = self.rqdata.runq_task[dep]
-                stampfile2 = bb.build.stampfile(taskname2, self.rqdata.dataCache, fn2)
-                stampfile3 = bb.build.stampfile(taskname2 + "_setscene", self.rqdata.dataCache, fn2)
-                t2 = get_timestamp(stampfile2)
-                t3 = get_timestamp(stampfile3)
+                stampfile2 = stamps.stampfile(dep, taskname2)
+                stampfile3 = stamps.stampfile(dep, taskname2 + "_setscene")
+                t2 = stamps.mtime(stampfile2)
+                t3 = stamps.mtime(stampfile3)
                 if t3 and t3 > t2:
                    continue
                 if fn == fn2 or (fulldeptree and fn2 not in stampwhitelist):
@@ -1117,6 +1452,7 @@ class RunQueue:
 
         if self.state is runQueuePrepare:
             self.rqexe = RunQueueExecuteDummy(self)
+            self.stampindex = RunQueueStamps(self.rqdata)
             if self.rqdata.prepare() == 0:
                 self.state = runQueueComplete
             else:
@@ -1162,6 +1498,8 @@ class RunQueue:
 
         if (self.state is runQueueComplete or self.state is runQueueFailed) and self.rqexe:
             self.teardown_workers()
+            if self.rqexe.taskhistory:
+                self.rqexe.taskhistory.save()
             if self.rqexe.stats.failed:
                 logger.info("Tasks Summary: Attempted %d tasks of which %d didn't need to be rerun and %d failed.", self.rqexe.stats.completed + self.rqexe.stats.failed, self.rqexe.stats.skipped, self.rqexe.stats.failed)
             else:
@@ -1350,6 +1688,7 @@ class RunQueue:
                 bb.plain("\nTask %s:%s couldn't be used from the cache because:\n  We need hash %s, closest matching task was %s\n  " % (pn, taskname, h, prevh) + '\n  '.join(output))
 
 class RunQueueExecute:
+    taskhistory = None
 
     def __init__(self, rq):
         self.rq = rq
@@ -1365,7 +1704,8 @@ class RunQueueExecute:
         self.runq_complete = []
 
         self.build_stamps = {}
-        self.build_stamps2 = []
+        # Stamps of the tasks currently executing
+        self.build_stamps2 = set()
         self.failed_fnids = []
 
         self.stampcache = {}
@@ -1377,13 +1717,18 @@ class RunQueueExecute:
         if self.number_tasks <= 0:
              bb.fatal("Invalid BB_NUMBER_THREADS %s" % self.number_tasks)
 
-    def runqueue_process_waitpid(self, task, status):
+    def runqueue_process_waitpid(self, task, status, resources=None):
 
         # self.build_stamps[pid] may not exist when use shared work directory.
         if task in self.build_stamps:
             self.build_stamps2.remove(self.build_stamps[task])
             del self.build_stamps[task]
 
+        if self.taskhistory and resources and status == 0:
+            fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+            self.taskhistory.record(self.rqdata.dataCache.pkg_fn[fn], self.rqdata.runq_task[task],
+                                    TaskResources(*resources))
+
         if status != 0:
             self.task_fail(task, status)
         else:
@@ -1457,6 +1802,9 @@ class RunQueueExecuteTasks(RunQueueExecute):
     def __init__(self, rq):
         RunQueueExecute.__init__(self, rq)
 
+        if self.rq.uses_history():
+            self.taskhistory = TaskResourceHistory(self.cfgData)
+
         self.stats = RunQueueStats(len(self.rqdata.runq_fnid))
 
         self.stampcache = {}
@@ -1520,6 +1868,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
             fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
             taskname = self.rqdata.runq_task[task] + '_setscene'
             bb.build.del_stamp(taskname, self.rqdata.dataCache, fn)
+            self.rq.stampindex.invalidate(task)
             self.rq.scenequeue_covered.remove(task)
 
         toremove = covered_remove
@@ -1553,26 +1902,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
                      (self.scheduler, ", ".join(obj.name for obj in schedulers)))
 
     def get_schedulers(self):
-        schedulers = set(obj for obj in globals().values()
-                             if type(obj) is type and
-                                issubclass(obj, RunQueueScheduler))
-
-        user_schedulers = self.cfgData.getVar("BB_SCHEDULERS", True)
-        if user_schedulers:
-            for sched in user_schedulers.split():
-                if not "." in sched:
-                    bb.note("Ignoring scheduler '%s' from BB_SCHEDULERS: not an import" % sched)
-                    continue
-
-                modname, name = sched.rsplit(".", 1)
-                try:
-                    module = __import__(modname, fromlist=(name,))
-                except ImportError as exc:
-                    logger.critical("Unable to import scheduler '%s' from '%s': %s" % (name, modname, exc))
-                    raise SystemExit(1)
-                else:
-                    schedulers.add(getattr(module, name))
-        return schedulers
+        return get_schedulers(self.cfgData)
 
     def setbuildable(self, task):
         self.runq_buildable[task] = 1
@@ -1602,6 +1932,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
 
     def task_complete(self, task):
         self.stats.taskCompleted()
+        self.rq.stampindex.invalidate(task)
         bb.event.fire(runQueueTaskCompleted(task, self.stats, self.rq), self.cfgData)
         self.task_completeoutright(task)
 
@@ -1611,6 +1942,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
         Updates the state engine with the failure
         """
         self.stats.taskFailed()
+        self.rq.stampindex.invalidate(task)
         fnid = self.rqdata.runq_fnid[task]
         self.failed_fnids.append(fnid)
         bb.event.fire(runQueueTaskFailed(task, self.stats, exitcode, self.rq), self.cfgData)
@@ -1687,7 +2019,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
                 self.rq.worker.stdin.flush()
 
             self.build_stamps[task] = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
-            self.build_stamps2.append(self.build_stamps[task]) 
+            self.build_stamps2.add(self.build_stamps[task])
             self.runq_running[task] = 1
             self.stats.taskActive()
             if self.stats.active < self.number_tasks:
@@ -1916,6 +2248,7 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
                     noexec.append(task)
                     self.task_skip(task)
                     bb.build.make_stamp(taskname + "_setscene", self.rqdata.dataCache, fn)
+                    self.rq.stampindex.invalidate(realtask)
                     continue
 
                 if self.rq.check_stamp_task(realtask, taskname + "_setscene", cache=self.stampcache):
@@ -1985,11 +2318,13 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
 
     def task_complete(self, task):
         self.stats.taskCompleted()
+        self.rq.stampindex.invalidate(self.rqdata.runq_setscene[task])
         bb.event.fire(sceneQueueTaskCompleted(task, self.stats, self.rq), self.cfgData)
         self.task_completeoutright(task)
 
     def task_fail(self, task, result):
         self.stats.taskFailed()
+        self.rq.stampindex.invalidate(self.rqdata.runq_setscene[task])
         bb.event.fire(sceneQueueTaskFailed(task, self.stats, result, self), self.cfgData)
         self.scenequeue_notcovered.add(task)
         self.scenequeue_updatecounters(task, True)
@@ -2108,10 +2443,10 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
 
         return True
 
-    def runqueue_process_waitpid(self, task, status):
+    def runqueue_process_waitpid(self, task, status, resources=None):
         task = self.rq.rqdata.runq_setscene.index(task)
 
-        RunQueueExecute.runqueue_process_waitpid(self, task, status)
+        RunQueueExecute.runqueue_process_waitpid(self, task, status, resources)
 
 class TaskFailure(Exception):
     """
@@ -2214,6 +2549,49 @@ class runQueueTaskSkipped(runQueueEvent):
         runQueueEvent.__init__(self, task, stats, rq)
         self.reason = reason
 
+# Messages from the tasks to bitbake-worker and from bitbake-worker to the
+# server are a one byte kind and a four byte length followed by a pickle
+WORKER_EVENT = "e"
+WORKER_EXITCODE = "x"
+_workerframe_header = struct.Struct(">cI")
+
+def workerframe(kind, data):
+    """
+    Frame the pickled data of a message for the worker pipes
+    """
+    return _workerframe_header.pack(kind, len(data)) + data
+
+def workerframes_length(buf):
+    """
+    Return the length of the complete messages at the start of buf
+    """
+    offset = 0
+    headersize = _workerframe_header.size
+    while len(buf) - offset >= headersize:
+        _, length = _workerframe_header.unpack_from(buf, offset)
+        if len(buf) - offset - headersize < length:
+            break
+        offset += headersize + length
+    return offset
+
+def split_workerframes(buf):
+    """
+    Remove the complete messages from the start of the bytearray buf and
+    return them as a list of (kind, data)
+    """
+    frames = []
+    offset = 0
+    headersize = _workerframe_header.size
+    while len(buf) - offset >= headersize:
+        kind, length = _workerframe_header.unpack_from(buf, offset)
+        start = offset + headersize
+        if len(buf) - start < length:
+            break
+        frames.append((kind, str(buf[start:start + length])))
+        offset = start + length
+    del buf[:offset]
+    return frames
+
 class runQueuePipe():
     """
     Abstraction for a pipe between a worker thread and the server
@@ -2223,7 +2601,7 @@ class runQueuePipe():
         if pipeout:
             pipeout.close()
         bb.utils.nonblockingfd(self.input)
-        self.queue = ""
+        self.queue = bytearray()
         self.d = d
         self.rq = rq
         self.rqexec = rqexec
@@ -2247,39 +2625,27 @@ class runQueuePipe():
 
         start = len(self.queue)
         try:
-            self.queue = self.queue + self.input.read(102400)
+            self.queue.extend(self.input.read(102400))
         except (OSError, IOError) as e:
             if e.errno != errno.EAGAIN:
                 raise
         end = len(self.queue)
-        found = True
-        while found and len(self.queue):
-            found = False
-            index = self.queue.find("</event>")
-            while index != -1 and self.queue.startswith("<event>"):
-                try:
-                    event = pickle.loads(self.queue[7:index])
-                except ValueError as e:
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[7:index]))
-                bb.event.fire_from_worker(event, self.d)
-                found = True
-                self.queue = self.queue[index+8:]
-                index = self.queue.find("</event>")
-            index = self.queue.find("</exitcode>")
-            while index != -1 and self.queue.startswith("<exitcode>"):
-                try:
-                    task, status = pickle.loads(self.queue[10:index])
-                except ValueError as e:
-                    bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[10:index]))
-                self.rqexec.runqueue_process_waitpid(task, status)
-                found = True
-                self.queue = self.queue[index+11:]
-                index = self.queue.find("</exitcode>")
+        for kind, data in split_workerframes(self.queue):
+            try:
+                message = pickle.loads(data)
+            except ValueError as e:
+                bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, data))
+            if kind == WORKER_EVENT:
+                bb.event.fire_from_worker(message, self.d)
+            elif kind == WORKER_EXITCODE:
+                self.rqexec.runqueue_process_waitpid(*message)
+            else:
+                bb.msg.fatal("RunQueue", "unknown message '%s' from worker" % kind)
         return (end > start)
 
     def close(self):
         while self.read():
             continue
         if len(self.queue) > 0:
-            print("Warning, worker left partial message: %s" % self.queue)
+            print("Warning, worker left partial message: %s" % str(self.queue))
         self.input.close()
@@ -30,6 +30,7 @@ import signal
 import sys
 import time
 import select
+import threading
 from Queue import Empty
 from multiprocessing import Event, Process, util, Queue, Pipe, queues, Manager
 
@@ -69,15 +70,99 @@ class EventAdapter():
     """
     Adapter to wrap our event queue since the caller (bb.event) expects to
     call a send() method, but our actual queue only has put()
+
+    Once started, events are collected and put on the queue as one list
+    when batchsize of them are waiting or the oldest has waited latency
+    seconds, so busy builds don't pickle and pass each one separately.
+    Processes forked from the server put their events on the queue as they
+    come as the thread sending the batches only runs in the server.
+
+    Signal handlers in the server fire events, so send() can be entered
+    again by the thread already in it. The lock is reentrant for that, and
+    an event sent while a batch is being put on the queue waits for the
+    next flush rather than putting one from within the put.
     """
+    batchsize = 256
+    latency = 0.05
+
     def __init__(self, queue):
         self.queue = queue
+        self.pending = []
+        self.lock = threading.RLock()
+        self.flushing = False
+        self.pid = None
+        self.running = False
+        self.events = 0
+        self.batches = 0
+        self.dropped = 0
+        self.maxpending = 0
+
+    def start(self):
+        self.pid = os.getpid()
+        self.running = True
+        thread = threading.Thread(target=self.flusher, name="EventAdapter")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+        self.flush()
+
+    def flusher(self):
+        while self.running:
+            time.sleep(self.latency)
+            self.flush()
 
     def send(self, event):
+        if self.pid != os.getpid():
+            self.sendbatch(event, 1)
+            return
+        with self.lock:
+            self.pending.append(event)
+            if len(self.pending) > self.maxpending:
+                self.maxpending = len(self.pending)
+            if len(self.pending) >= self.batchsize and not self.flushing:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            if self.pending and not self.flushing:
+                self._flush()
+
+    def _flush(self):
+        batch = self.pending
+        self.pending = []
+        self.flushing = True
         try:
-            self.queue.put(event)
+            self.sendbatch(batch, len(batch))
+        finally:
+            self.flushing = False
+
+    def sendbatch(self, item, count):
+        try:
+            self.queue.put(item)
         except Exception as err:
             print("EventAdapter puked: %s" % str(err))
+            self.dropped += count
+            return
+        self.batches += 1
+        self.events += count
+
+    def stats(self):
+        """
+        Return the number of events sent, the number of batches they were
+        sent in, how many went in a batch with others, how many were lost,
+        how many are waiting to be sent and on the queue now and the most
+        that have been waiting to be sent
+        """
+        try:
+            queued = self.queue.qsize()
+        except NotImplementedError:
+            queued = None
+        return {"events": self.events, "batches": self.batches,
+                "coalesced": self.events - self.batches, "dropped": self.dropped,
+                "pending": len(self.pending), "queued": queued,
+                "maxpending": self.maxpending}
 
 
 class ProcessServer(Process, BaseImplServer):
@@ -99,6 +184,7 @@ class ProcessServer(Process, BaseImplServer):
     def run(self):
         for event in bb.event.ui_queue:
             self.event_queue.put(event)
+        self.event.start()
         self.event_handle.value = bb.event.register_UIHhandler(self, True)
 
         bb.cooker.server_main(self.cooker, self.main)
@@ -126,6 +212,9 @@ class ProcessServer(Process, BaseImplServer):
             except Exception:
                 logger.exception('Running command %s', command)
 
+        logger.debug(1, "UI events: %(events)d sent in %(batches)d batches, %(dropped)d dropped, "
+                        "at most %(maxpending)d waiting" % self.event.stats())
+        self.event.stop()
         self.event_queue.close()
         bb.event.unregister_UIHhandler(self.event_handle.value)
         self.command_channel.close()
@@ -193,7 +282,7 @@ class BitBakeProcessServerConnection(BitBakeBaseServerConnection):
         def flushevents():
             while True:
                 try:
-                    event = self.event_queue.get(block=False)
+                    event = self.event_queue.receive(False)
                 except (Empty, IOError):
                     break
                 if isinstance(event, logging.LogRecord):
@@ -215,11 +304,23 @@ class ProcessEventQueue(multiprocessing.queues.Queue):
     def __init__(self, maxsize):
         multiprocessing.queues.Queue.__init__(self, maxsize)
         self.exit = False
+        # Events from the last batch received which haven't been asked for yet
+        self.received = []
         bb.utils.set_process_name("ProcessEQueue")
 
     def setexit(self):
         self.exit = True
 
+    def receive(self, block, timeout=None):
+        if self.received:
+            return self.received.pop()
+        event = self.get(block, timeout)
+        if isinstance(event, list):
+            event.reverse()
+            self.received = event
+            return self.received.pop()
+        return event
+
     def waitEvent(self, timeout):
         if self.exit:
             sys.exit(1)
@@ -227,7 +328,7 @@ class ProcessEventQueue(multiprocessing.queues.Queue):
             if not self.server.is_alive():
                 self.setexit()
                 return None
-            return self.get(True, timeout)
+            return self.receive(True, timeout)
         except Empty:
             return None
 
@@ -236,7 +337,7 @@ class ProcessEventQueue(multiprocessing.queues.Queue):
             if not self.server.is_alive():
                 self.setexit()
                 return None
-            return self.get(False)
+            return self.receive(False)
         except Empty:
             return None
 
@@ -29,6 +29,11 @@
     calls from within server_forever when no requests are pending. Make sure
     that those functions are non-blocking or else you will introduce latency
     in the server's main loop.
+
+    In concurrent mode each request is handled in a thread of its own.
+    Commands which only read the configuration are run there from a snapshot
+    of it, anything else is passed to the main loop and run there one at a
+    time as in the default mode.
 """
 
 import bb
@@ -39,6 +44,7 @@ import hashlib, time
 import socket
 import os, signal
 import threading
+import Queue
 try:
     import cPickle as pickle
 except ImportError:
@@ -159,12 +165,14 @@ class BitBakeXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
         if remote_token != self.server.connection_token and remote_token != "observer":
             self.report_503()
         else:
-            if remote_token == "observer":
-                self.server.readonly = True
-            else:
-                self.server.readonly = False
+            self.readonly = (remote_token == "observer")
+            if not self.server.concurrent:
+                self.server.readonly = self.readonly
             SimpleXMLRPCRequestHandler.do_POST(self)
 
+    def _dispatch(self, method, params):
+        return self.server.dispatch_request(method, params, self.readonly)
+
     def report_503(self):
         self.send_response(503)
         response = 'No more client allowed'
@@ -186,15 +194,26 @@ class XMLRPCServer(SimpleXMLRPCServer, BaseImplServer):
     # remove this when you're done with debugging
     # allow_reuse_address = True
 
-    def __init__(self, interface, single_use=False):
+    def __init__(self, interface, single_use=False, concurrent=False):
         """
         Constructor
         """
         BaseImplServer.__init__(self)
         self.single_use = single_use
+        self.concurrent = concurrent
+        self.readonly = False
+        # Calls passed to the main loop by the request threads, with a pipe
+        # to wake it up, and the snapshot the others are run from
+        self.calls = Queue.Queue()
+        self.wakeup = None
+        self.snapshot = None
         # Use auto port configuration
         if (interface[1] == -1):
             interface = (interface[0], 0)
+        if concurrent:
+            # Many clients may connect at once and are only accepted between
+            # the idle functions
+            self.request_queue_size = 64
         SimpleXMLRPCServer.__init__(self, interface,
                                     requestHandler=BitBakeXMLRPCRequestHandler,
                                     logRequests=False, allow_none=True)
@@ -220,6 +239,69 @@ class XMLRPCServer(SimpleXMLRPCServer, BaseImplServer):
                 self.register_function(method, name[len(prefix):])
 
 
+    def process_request(self, request, client_address):
+        if not self.concurrent:
+            return SimpleXMLRPCServer.process_request(self, request, client_address)
+        # As SocketServer.ThreadingMixIn does
+        t = threading.Thread(target = self.process_request_thread, args = (request, client_address))
+        t.daemon = True
+        t.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def dispatch_request(self, method, params, readonly):
+        """
+        Run a call, from the thread handling its request in concurrent mode
+        """
+        if not self.concurrent:
+            return self._dispatch(method, params)
+
+        snapshot = self.snapshot
+        if method == "runCommand" and snapshot is not None:
+            # Each request reads a copy of its own so they can run together
+            result = self.cooker.command.runSnapshotCommand(list(params[0]), snapshot.copy(), readonly)
+            if result is not None:
+                return result
+
+        call = [method, params, readonly, threading.Event(), None, None]
+        self.calls.put(call)
+        os.write(self.wakeup[1], "x")
+        call[3].wait()
+        if call[5] is not None:
+            raise call[5][0], call[5][1], call[5][2]
+        return call[4]
+
+    def run_calls(self):
+        """
+        Run the calls passed to the main loop, in the order they came
+        """
+        try:
+            os.read(self.wakeup[0], 4096)
+        except OSError:
+            pass
+        while True:
+            try:
+                call = self.calls.get_nowait()
+            except Queue.Empty:
+                break
+            method, params, readonly, done = call[:4]
+            try:
+                self.readonly = readonly
+                call[4] = self._dispatch(method, params)
+            except:
+                call[5] = sys.exc_info()
+            done.set()
+            self.update_snapshot()
+
+    def update_snapshot(self):
+        self.snapshot = self.cooker.getSnapshot(self.snapshot)
+
     def serve_forever(self):
         # Start the actual XMLRPC server
         bb.cooker.server_main(self.cooker, self._serve_forever)
@@ -229,8 +311,13 @@ class XMLRPCServer(SimpleXMLRPCServer, BaseImplServer):
         Serve Requests. Overloaded to honor a quit command
         """
         self.quit = False
+        if self.concurrent:
+            self.wakeup = os.pipe()
+            self.update_snapshot()
         while not self.quit:
             fds = [self]
+            if self.concurrent:
+                fds.append(self.wakeup[0])
             nextsleep = 0.1
             for function, data in self._idlefuns.items():
                 retval = None
@@ -255,6 +342,9 @@ class XMLRPCServer(SimpleXMLRPCServer, BaseImplServer):
                         del self._idlefuns[function]
                     pass
 
+            if self.concurrent:
+                self.update_snapshot()
+
             socktimeout = self.socket.gettimeout() or nextsleep
             socktimeout = min(socktimeout, nextsleep)
             # Mirror what BaseServer handle_request would do
@@ -262,6 +352,8 @@ class XMLRPCServer(SimpleXMLRPCServer, BaseImplServer):
                 fd_sets = select.select(fds, [], [], socktimeout)
                 if fd_sets[0] and self in fd_sets[0]:
                     self._handle_request_noblock()
+                if self.concurrent and self.wakeup[0] in fd_sets[0]:
+                    self.run_calls()
             except IOError:
                 # we ignore interrupted calls
                 pass
@@ -272,6 +364,16 @@ class XMLRPCServer(SimpleXMLRPCServer, BaseImplServer):
                 retval = function(self, data, True)
             except:
                 pass
+        if self.concurrent:
+            self.snapshot = None
+            # Don't leave the request threads waiting on calls
+            while True:
+                try:
+                    call = self.calls.get_nowait()
+                except Queue.Empty:
+                    break
+                call[5] = (Exception, Exception("Server exiting"), None)
+                call[3].set()
         self.server_close()
         return
 
@@ -332,9 +434,9 @@ class BitBakeXMLRPCServerConnection(BitBakeBaseServerConnection):
             pass
 
 class BitBakeServer(BitBakeBaseServer):
-    def initServer(self, interface = ("localhost", 0), single_use = False):
+    def initServer(self, interface = ("localhost", 0), single_use = False, concurrent = False):
         self.interface = interface
-        self.serverImpl = XMLRPCServer(interface, single_use)
+        self.serverImpl = XMLRPCServer(interface, single_use, concurrent)
 
     def detach(self):
         daemonize.createDaemon(self.serverImpl.serve_forever, "bitbake-cookerdaemon.log")
@@ -46,6 +46,13 @@ class SignatureGenerator(object):
     def get_taskhash(self, fn, task, deps, dataCache):
         return "0"
 
+    def get_taskhashes(self, tasks, dataCache):
+        """
+        Return the hashes of tasks, a list of (fn, task, deps) tuples in
+        which every task comes after the tasks in its deps
+        """
+        return [self.get_taskhash(fn, task, deps, dataCache) for (fn, task, deps) in tasks]
+
     def writeout_file_checksum_cache(self):
         """Write/update the file checksum cache onto disk"""
         return
@@ -87,6 +94,9 @@ class SignatureGeneratorBasic(SignatureGenerator):
         self.gendeps = {}
         self.lookupcache = {}
         self.pkgnameextract = re.compile("(?P<fn>.*)\..*")
+        # Sort key and recipe file of each task seen as a dependency
+        self.depkeys = {}
+        self.depfns = {}
         self.basewhitelist = set((data.getVar("BB_HASHBASE_WHITELIST", True) or "").split())
         self.taskwhitelist = None
         self.init_rundepcheck(data)
@@ -107,9 +117,10 @@ class SignatureGeneratorBasic(SignatureGenerator):
     def _build_data(self, fn, d):
 
         tasklist, gendeps, lookupcache = bb.data.generate_dependencies(d)
+        closures = bb.data.dependency_closures(tasklist, gendeps, self.basewhitelist)
 
         taskdeps = {}
-        basehash = {}
+        depdata = {}
 
         for task in tasklist:
             data = lookupcache[task]
@@ -118,26 +129,15 @@ class SignatureGeneratorBasic(SignatureGenerator):
                 bb.error("Task %s from %s seems to be empty?!" % (task, fn))
                 data = ''
 
-            gendeps[task] -= self.basewhitelist
-            newdeps = gendeps[task]
-            seen = set()
-            while newdeps:
-                nextdeps = newdeps
-                seen |= nextdeps
-                newdeps = set()
-                for dep in nextdeps:
-                    if dep in self.basewhitelist:
-                        continue
-                    gendeps[dep] -= self.basewhitelist
-                    newdeps |= gendeps[dep]
-                newdeps -= seen
-
-            alldeps = sorted(seen)
+            alldeps = closures[task]
             for dep in alldeps:
-                data = data + dep
-                var = lookupcache[dep]
-                if var is not None:
-                    data = data + str(var)
+                if dep not in depdata:
+                    var = lookupcache[dep]
+                    if var is not None:
+                        depdata[dep] = dep + str(var)
+                    else:
+                        depdata[dep] = dep
+            data = data + "".join([depdata[dep] for dep in alldeps])
             self.basehash[fn + "." + task] = hashlib.md5(data).hexdigest()
             taskdeps[task] = alldeps
 
@@ -185,18 +185,23 @@ class SignatureGeneratorBasic(SignatureGenerator):
 
     def get_taskhash(self, fn, task, deps, dataCache):
         k = fn + "." + task
-        data = dataCache.basetaskhash[k]
+        data = hashlib.md5(dataCache.basetaskhash[k])
         self.runtaskdeps[k] = []
         self.file_checksum_values[k] = []
         recipename = dataCache.pkg_fn[fn]
 
-        for dep in sorted(deps, key=clean_basepath):
-            depname = dataCache.pkg_fn[self.pkgnameextract.search(dep).group('fn')]
+        for dep in deps:
+            if dep not in self.depkeys:
+                self.depkeys[dep] = clean_basepath(dep)
+                self.depfns[dep] = self.pkgnameextract.search(dep).group('fn')
+
+        for dep in sorted(deps, key=self.depkeys.__getitem__):
+            depname = dataCache.pkg_fn[self.depfns[dep]]
             if not self.rundep_check(fn, recipename, task, dep, depname, dataCache):
                 continue
             if dep not in self.taskhash:
                 bb.fatal("%s is not in taskhash, caller isn't calling in dependency order?", dep)
-            data = data + self.taskhash[dep]
+            data.update(self.taskhash[dep])
             self.runtaskdeps[k].append(dep)
 
         if task in dataCache.file_checksums[fn]:
@@ -207,23 +212,23 @@ class SignatureGeneratorBasic(SignatureGenerator):
             for (f,cs) in checksums:
                 self.file_checksum_values[k].append((f,cs))
                 if cs:
-                    data = data + cs
+                    data.update(cs)
 
         taskdep = dataCache.task_deps[fn]
         if 'nostamp' in taskdep and task in taskdep['nostamp']:
             # Nostamp tasks need an implicit taint so that they force any dependent tasks to run
             import uuid
             taint = str(uuid.uuid4())
-            data = data + taint
+            data.update(taint)
             self.taints[k] = "nostamp:" + taint
 
         taint = self.read_taint(fn, task, dataCache.stamp[fn])
         if taint:
-            data = data + taint
+            data.update(taint)
             self.taints[k] = taint
             logger.warn("%s is tainted from a forced run" % k)
 
-        h = hashlib.md5(data).hexdigest()
+        h = data.hexdigest()
         self.taskhash[k] = h
         #d.setVar("BB_TASKHASH_task-%s" % task, taskhash[task])
         return h
@@ -0,0 +1,93 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for build.py
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import time
+import bb
+import bb.build
+import bb.process
+
+class RecordingLogger(object):
+    def __init__(self):
+        self.records = []
+
+    def plain(self, msg):
+        self.records.append(msg)
+
+class LogTeeTest(unittest.TestCase):
+    def setUp(self):
+        self.outfile = tempfile.NamedTemporaryFile()
+        self.logger = RecordingLogger()
+        self.tee = bb.build.LogTee(self.logger, self.outfile)
+
+    def tearDown(self):
+        self.outfile.close()
+
+    def contents(self):
+        self.outfile.flush()
+        with open(self.outfile.name) as f:
+            return f.read()
+
+    def test_whole_lines(self):
+        self.tee.write("one\ntw")
+        self.assertEqual(self.logger.records, ["one"])
+        self.tee.write("o\nthree\n")
+        self.assertEqual(self.logger.records, ["one"])
+        self.tee.flush()
+        self.assertEqual(self.logger.records, ["one", "two\nthree"])
+        self.assertEqual(self.contents(), "one\ntwo\nthree\n")
+
+    def test_interval(self):
+        self.tee.write("one\n")
+        self.tee.sent = time.time() - self.tee.interval
+        self.tee.write("two\nthr")
+        self.assertEqual(self.logger.records, ["one", "two"])
+        self.tee.flush()
+        self.assertEqual(self.logger.records, ["one", "two", "thr"])
+
+    def test_maxsize(self):
+        line = "x" * 99 + "\n"
+        self.tee.write(line)
+        for i in range(self.tee.maxsize // len(line) + 1):
+            self.tee.write(line)
+        self.assertEqual(len(self.logger.records), 2)
+        self.tee.flush()
+        self.assertEqual("\n".join(self.logger.records) + "\n", self.contents())
+
+class ProcessTest(unittest.TestCase):
+    def test_output_to_file(self):
+        with tempfile.TemporaryFile() as f:
+            start = time.time()
+            bb.process.run("echo one; echo two >&2", stdout=f, log=f)
+            self.assertLess(time.time() - start, 0.5)
+            f.seek(0)
+            self.assertEqual(f.read(), "one\ntwo\n")
+
+    def test_logged_output(self):
+        class Log(object):
+            data = ""
+            def write(self, data):
+                self.data += data
+            def flush(self):
+                pass
+        log = Log()
+        stdout, stderr = bb.process.run("seq 1 10000; echo last", log=log)
+        self.assertEqual(stdout.splitlines()[-2:], ["10000", "last"])
+        self.assertEqual(log.data, stdout)
@@ -0,0 +1,172 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for checksum.py
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import hashlib
+import tempfile
+import shutil
+import os
+import bb
+import bb.checksum
+
+class FileChecksumCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filesdir = os.path.join(self.tempdir, "files")
+        os.makedirs(os.path.join(self.filesdir, "sub"))
+        self.contents = {}
+        for name in ["a", "b", "sub/c", "sub/d"]:
+            self.contents[name] = "content of %s\n" % name * 1000
+            with open(os.path.join(self.filesdir, name), "w") as f:
+                f.write(self.contents[name])
+
+        self.d = bb.data.init()
+        self.d.setVar("PERSISTENT_DIR", os.path.join(self.tempdir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def expected(self, names):
+        return sorted(((os.path.join(self.filesdir, name), hashlib.md5(self.contents[name]).hexdigest())
+                       for name in names), key=lambda entry: entry[1])
+
+    def test_checksums(self):
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.d)
+        filelist = "%s:True %s:True %s:False" % (os.path.join(self.filesdir, "a"),
+                                                 os.path.join(self.filesdir, "sub"),
+                                                 os.path.join(self.filesdir, "missing"))
+        checksums = cache.get_checksums(filelist, "test")
+        self.assertEqual(checksums, self.expected(["a", "sub/c", "sub/d"]))
+        self.assertEqual((cache.hits, cache.reused, cache.misses), (0, 0, 3))
+
+        checksums = cache.get_checksums(filelist, "test")
+        self.assertEqual(checksums, self.expected(["a", "sub/c", "sub/d"]))
+        self.assertEqual((cache.hits, cache.reused, cache.misses), (3, 0, 3))
+
+    def test_persistent(self):
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.d)
+        filelist = "%s:True" % self.filesdir
+        cache.get_checksums(filelist, "test")
+        cache.save_extras()
+        cache.save_merge()
+
+        # A changed file is checksummed again, the rest come from the cache
+        with open(os.path.join(self.filesdir, "b"), "w") as f:
+            f.write("changed\n")
+        self.contents["b"] = "changed\n"
+        os.utime(os.path.join(self.filesdir, "b"), (0, 0))
+
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.d)
+        checksums = cache.get_checksums(filelist, "test")
+        self.assertEqual(checksums, self.expected(["a", "b", "sub/c", "sub/d"]))
+        self.assertEqual((cache.hits, cache.reused, cache.misses), (3, 0, 1))
+
+    def test_hardlinks(self):
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.d)
+        cache.get_checksums("%s:True" % self.filesdir, "test")
+
+        # A copy of the tree made of hardlinks isn't read again
+        copydir = os.path.join(self.tempdir, "copy")
+        os.makedirs(copydir)
+        for name in ["a", "b"]:
+            os.link(os.path.join(self.filesdir, name), os.path.join(copydir, name))
+        checksums = cache.get_checksums("%s:True" % copydir, "test")
+        self.assertEqual([checksum for _, checksum in checksums],
+                         [checksum for _, checksum in self.expected(["a", "b"])])
+        self.assertEqual((cache.hits, cache.reused, cache.misses), (0, 2, 4))
+
+    def test_other_device(self):
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.d)
+
+        # A file on another filesystem with the same inode, size and mtime
+        # doesn't lend its checksum
+        path = os.path.join(self.filesdir, "a")
+        key = cache.file_key(path)
+        cache.store("/elsewhere/a", key._replace(dev=key.dev + 1), "0" * 32)
+        self.assertEqual(cache.get_checksum(path), hashlib.md5(self.contents["a"]).hexdigest())
+        self.assertEqual((cache.hits, cache.reused, cache.misses), (0, 0, 1))
+
+    def test_shared(self):
+        filelist = "%s:True" % self.filesdir
+        cache1 = bb.checksum.FileChecksumCache()
+        cache1.init_cache(self.d)
+        cache2 = bb.checksum.FileChecksumCache()
+        cache2.init_cache(self.d)
+
+        # Entries saved by one process are seen by another without a merge
+        cache1.get_checksums(filelist, "test")
+        cache1.save_extras()
+        cache2.sync()
+        checksums = cache2.get_checksums(filelist, "test")
+        self.assertEqual(checksums, self.expected(["a", "b", "sub/c", "sub/d"]))
+        self.assertEqual((cache2.hits, cache2.reused, cache2.misses), (4, 0, 0))
+
+        # Compacting the log into the snapshot doesn't lose anything
+        cache1.save_merge()
+        self.assertEqual(os.path.getsize(cache1.logfile), 0)
+        cache2.sync()
+        cache3 = bb.checksum.FileChecksumCache()
+        cache3.init_cache(self.d)
+        for cache in (cache2, cache3):
+            self.assertEqual(sorted(cache.cachedata[0]), sorted(f for f, _ in checksums))
+
+    def test_large_records(self):
+        cache1 = bb.checksum.FileChecksumCache()
+        cache1.init_cache(self.d)
+        cache2 = bb.checksum.FileChecksumCache()
+        cache2.init_cache(self.d)
+
+        # A record bigger than the file buffer doesn't hide what follows it
+        for i in range(2000):
+            cache1.store("/large/%d" % i, bb.checksum.FileKey(0, i, 0, 0), "%032x" % i)
+        cache1.save_extras()
+        cache2.store("/after", bb.checksum.FileKey(0, 0, 0, 0), "0" * 32)
+        cache2.save_extras()
+        cache1.sync()
+        self.assertIn("/after", cache1.cachedata[0])
+
+    def test_merge_newest(self):
+        cache1 = bb.checksum.FileChecksumCache()
+        cache1.init_cache(self.d)
+        cache2 = bb.checksum.FileChecksumCache()
+        cache2.init_cache(self.d)
+
+        # Two processes saw the same path at different times, the later
+        # entry wins whichever file was larger
+        path = os.path.join(self.filesdir, "a")
+        key = cache1.file_key(path)
+        older = key._replace(size=key.size + 100, mtime=key.mtime - 1000000000)
+        cache2.store(path, key, hashlib.md5(self.contents["a"]).hexdigest())
+        cache2.save_extras()
+        cache1.store(path, older, "0" * 32)
+        cache1.save_extras()
+        for cache in (cache1, cache2):
+            cache.save_merge()
+            cache.sync()
+            self.assertEqual(cache.cachedata[0][path][0], key)
+
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.d)
+        self.assertEqual(cache.get_checksum(path), hashlib.md5(self.contents["a"]).hexdigest())
+        self.assertEqual((cache.hits, cache.reused, cache.misses), (1, 0, 0))
@@ -173,6 +173,107 @@ END
         self.assertReferences(set(v))
         self.assertExecs(set(["cat"]))
 
+class ShellTemplateTest(ReferenceTest):
+
+    def parseExpansions(self, body, var, values):
+        """Parse the expansions of body with var set to each of values,
+        checking the commands found against parsing the code itself"""
+        shared = []
+        for value in values:
+            self.d.setVar(var, value)
+            code = self.d.expand(body)
+            parser = bb.codeparser.ShellParser("ParserTest", logger)
+            reference = bb.codeparser.ShellParser("ParserTest", logger)
+            try:
+                reference._parse_shell(code)
+            except bb.pysh.sherrors.ShellSyntaxError:
+                self.assertRaises(bb.pysh.sherrors.ShellSyntaxError, parser.parse_shell, code, body, self.d)
+                shared.append(None)
+                continue
+
+            parser.parse_shell(code, body, self.d)
+            self.assertEqual(parser.execs, reference.allexecs - reference.funcdefs)
+            shared.append(bb.codeparser.codedigest(code) not in bb.codeparser.codeparsercache.shellcacheextras)
+        return shared
+
+    def test_shared(self):
+        shared = self.parseExpansions("install -d ${D}${bindir}\ncp template_shared ${D}${bindir}",
+                                      "D", ["/work/a/image", "/work/b/image", "/work/c/image"])
+        self.assertEqual(shared, [True, True, True])
+
+    def test_command(self):
+        shared = self.parseExpansions("${MAKE} template_command", "MAKE", ["make", "gmake", "make -j2"])
+        self.assertEqual(shared, [False, False, True])
+
+    def test_assignment(self):
+        self.parseExpansions("${NAME}=1 template_assignment", "NAME", ["A", "a.b", "A"])
+        self.parseExpansions("A=${VALUE} template_assignment", "VALUE", ["1", "x=y", "2"])
+
+    def test_heredoc(self):
+        shared = self.parseExpansions("cat <<END\nfoo\n${LINE}\nEND\ntemplate_heredoc", "LINE", ["foo", "END", "bar"])
+        self.assertEqual(shared, [True, False, True])
+
+    def test_reserved(self):
+        shared = self.parseExpansions("for i in ${WORD}; do template_reserved; done", "WORD", ["a", "done", "b"])
+        self.assertEqual(shared, [True, None, True])
+
+class FullShellParser(bb.codeparser.ShellParser):
+    """ShellParser always using the full pysh parser"""
+
+    def _parse_shell(self, value):
+        try:
+            tokens, _ = bb.pysh.pyshyacc.parse(value, eof=True, debug=False)
+        except bb.pysh.pyshlex.NeedMore:
+            raise bb.pysh.sherrors.ShellSyntaxError("Unexpected EOF")
+        for token in tokens:
+            self.process_tokens(token)
+
+class ShellScanTest(unittest.TestCase):
+
+    def parse(self, parserclass, code):
+        parser = parserclass("ParserTest", logger)
+        try:
+            parser._parse_shell(code)
+        except Exception as exc:
+            return exc.__class__
+        return parser.allexecs, parser.funcdefs
+
+    def assertScanned(self, code, scanned=True):
+        """Check code gets the same results with and without the scanner,
+        and whether the scanner handles it itself"""
+        self.assertEqual(self.parse(bb.codeparser.ShellParser, code),
+                         self.parse(FullShellParser, code))
+        if scanned:
+            bb.pysh.pyshscan.parse(code)
+        else:
+            self.assertRaises(bb.pysh.pyshscan.Unsupported, bb.pysh.pyshscan.parse, code)
+
+    def test_commands(self):
+        self.assertScanned("a=b c='d e' f 1 2\ng | h && i || ! j; k & l\n")
+        self.assertScanned("m() {\n\tn $(o \"$(p)\") `q \\`r\\``\n}\ns() ( t )\n")
+        self.assertScanned("u \\\n v; w=${x:-$(y)} z\neval \"aa bb\"\n$cc dd")
+
+    def test_compound(self):
+        self.assertScanned("if a; then b; elif c; then d; else e; fi\nwhile f; do g; done\nuntil h; do i; done")
+        self.assertScanned("for j in k l\ndo\n\tm\ndone\n{ n; } > o\n(p; q) | r")
+        self.assertScanned("case $s in\n\tt|u) v ;;\n\t(w) $(x) ;;\n\t*)\n\t\ty\n\t\t;;\nesac\n")
+
+    def test_redirections(self):
+        self.assertScanned("a 2>&1 >/dev/null <b\n2>c d\n")
+        self.assertScanned("cat <<EOF >e\nf\n${g}\nEOF\nh\ncat <<-'END' | i\n\tj\n\tEND\n")
+
+    def test_pysh_quirks(self):
+        self.assertScanned("{ a }; b done")
+        self.assertScanned("{ a; } b")
+        self.assertScanned("c foo$ bar")
+        self.assertScanned("case d in (e|$(f)) g\nesac")
+
+    def test_unsupported(self):
+        for code in ("a $((1 + 2))", "b &", "{ c & }", "for d; do e; done", "f() { g; } > h",
+                     "cat <<A <<B\na\nA\nb\nB\n", "cat <<EOF\nEOF\n", "i # j", "k 'l", "m $",
+                     "n }", "if o; then p fi", "q {"):
+            self.assertScanned(code, False)
+
 #    def test_incomplete_command_expansion(self):
 #        self.assertRaises(reftracker.ShellSyntaxError, reftracker.execs,
 #                          bbvalue.shparse("cp foo`", self.d), self.d)
@@ -370,6 +471,27 @@ esac
 
         self.assertEquals(deps, set(["oe_libinstall"]))
 
+    def test_closures(self):
+        self.d.setVar("do_install", "oe_runmake install")
+        self.d.setVar("do_compile", "oe_runmake; helper")
+        self.d.setVar("oe_runmake", "${MAKE} ${EXTRA_OEMAKE}")
+        self.d.setVar("helper", "helper2 ${DATE}")
+        self.d.setVar("helper2", "helper")
+        self.d.setVar("MAKE", "make")
+        self.d.setVar("EXTRA_OEMAKE", "")
+        self.d.setVar("DATE", "20161018")
+        for var in ("do_install", "do_compile", "oe_runmake", "helper", "helper2"):
+            self.d.setVarFlag(var, "func", True)
+        self.d.setVar("__BBTASKS", ["do_install", "do_compile"])
+        self.d.setVar("__exportlist", set())
+
+        tasklist, deps, values = bb.data.generate_dependencies(self.d)
+        closures = bb.data.dependency_closures(tasklist, deps, set(["DATE"]))
+
+        self.assertEquals(closures["do_install"], ["EXTRA_OEMAKE", "MAKE", "oe_runmake"])
+        self.assertEquals(closures["do_compile"], ["EXTRA_OEMAKE", "MAKE", "helper", "helper2", "oe_runmake"])
+        self.assertEquals(deps["helper"], set(["helper2"]))
+
     #Currently no wildcard support
     #def test_vardeps_wildcards(self):
     #    self.d.setVar("oe_libinstall", "echo test")
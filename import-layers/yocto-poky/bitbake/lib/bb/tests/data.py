@@ -21,6 +21,9 @@
 #
 
 import unittest
+import hashlib
+import tempfile
+import shutil
 import bb
 import bb.data
 import bb.parse
@@ -407,6 +410,193 @@ class TestFlags(unittest.TestCase):
         self.assertEqual(self.d.getVarFlag("foo", "flag1", False), "value of flag1")
         self.assertEqual(self.d.getVarFlag("foo", "flag2", False), None)
 
+class TestCopies(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("OVERRIDES", "a")
+        self.d.setVar("FOO", "foo")
+        self.child = bb.data.createCopy(self.d)
+        self.grandchild = bb.data.createCopy(self.child)
+
+    def test_parent_changes(self):
+        self.assertEqual(self.grandchild.getVar("FOO", False), "foo")
+        self.assertEqual(self.grandchild.getVar("BAR", False), None)
+        self.d.setVar("FOO", "newfoo")
+        self.d.setVar("BAR", "bar")
+        self.assertEqual(self.grandchild.getVar("FOO", False), "newfoo")
+        self.assertEqual(self.grandchild.getVar("BAR", False), "bar")
+        self.d.delVar("FOO")
+        self.assertEqual(self.grandchild.getVar("FOO", False), None)
+        self.assertEqual(sorted(self.grandchild.keys()), ["BAR", "OVERRIDES"])
+
+    def test_child_changes(self):
+        self.assertEqual(self.grandchild.getVar("FOO", False), "foo")
+        self.child.setVar("FOO", "childfoo")
+        self.assertEqual(self.grandchild.getVar("FOO", False), "childfoo")
+        self.grandchild.setVar("FOO_a", "override")
+        self.grandchild.setVar("BAR", "bar")
+        self.assertEqual(self.grandchild.getVar("FOO", True), "override")
+        self.assertEqual(self.child.getVar("FOO", True), "childfoo")
+        self.assertEqual(self.d.getVar("FOO", True), "foo")
+        self.assertEqual(sorted(self.d.keys()), ["FOO", "OVERRIDES"])
+        self.assertEqual(sorted(self.grandchild.keys()), ["BAR", "FOO", "FOO_a", "OVERRIDES"])
+
+    def test_parent_overrides(self):
+        self.child.setVar("FOO_a", "child")
+        self.d.setVar("FOO_a", "parent")
+        self.assertEqual(self.d.getVar("FOO", True), "parent")
+        self.assertEqual(self.child.getVar("FOO", True), "child")
+
+    def test_snapshot(self):
+        self.child.setVar("FOO_a", "child")
+        self.child.appendVar("BAR", "bar")
+        snapshot = self.child.createSnapshot()
+        self.assertIs(self.child.createSnapshot(), snapshot)
+        self.d.setVar("BAZ", "baz")
+        self.child.setVar("FOO_a", "newchild")
+        self.child.appendVar("BAR", " more")
+        self.assertEqual(snapshot.getVar("FOO", True), "child")
+        self.assertEqual(snapshot.getVar("BAR", True), "bar")
+        self.assertEqual(sorted(snapshot.keys()), ["BAR", "FOO", "FOO_a", "OVERRIDES"])
+
+        newsnapshot = self.child.createSnapshot()
+        self.child.delVar("BAR")
+        self.assertEqual(newsnapshot.getVar("FOO", True), "newchild")
+        self.assertEqual(newsnapshot.getVar("BAR", True), "bar more")
+        self.assertEqual(newsnapshot.getVar("BAZ", True), "baz")
+        self.assertEqual(self.child.createSnapshot().getVar("BAR", True), None)
+        self.assertEqual(snapshot.getVar("BAR", True), "bar")
+
+    def test_snapshot_reader(self):
+        self.child.setVar("FOO_a", "child")
+        self.child.setVar("BAR", "${@'${FOO}'.upper()}")
+        snapshot = self.child.createSnapshot()
+        expanded = sorted(snapshot.expand_cache)
+        reader = snapshot.createReader()
+        other = snapshot.createReader()
+        self.assertEqual(reader.getVar("FOO", True), "child")
+        self.assertEqual(reader.getVar("BAR", True), "CHILD")
+        self.assertEqual(other.getVar("BAR", True), "CHILD")
+        self.assertIsNot(reader.expand_cache["BAR"], other.expand_cache["BAR"])
+        self.assertEqual(sorted(snapshot.expand_cache), expanded)
+        self.assertEqual(len(snapshot._children), 0)
+        self.assertEqual(sorted(reader.keys()), ["BAR", "FOO", "FOO_a", "OVERRIDES"])
+
+
+class TestExpansionCache(unittest.TestCase):
+    def setUp(self):
+        self.origcache = bb.data_smart.expansioncache
+        self.cache = bb.data_smart.expansioncache = bb.data_smart.ExpansionCache()
+        self.cache.enabled = True
+
+    def tearDown(self):
+        bb.data_smart.expansioncache = self.origcache
+
+    def recipe(self, features):
+        d = bb.data.init()
+        d.setVar("FEATURES", features)
+        d.setVar("FOO", "${@bb.utils.contains('FEATURES', 'x', 'yes', 'no', d)}")
+        return d
+
+    def test_reuse(self):
+        self.assertEqual(self.recipe("x y").getVar("FOO", True), "yes")
+        self.assertEqual(self.recipe("x y").getVar("FOO", True), "yes")
+        self.assertEqual(self.cache.stats(), (1, 0, 1, 0))
+
+    def test_changed_input(self):
+        self.assertEqual(self.recipe("x").getVar("FOO", True), "yes")
+        self.assertEqual(self.recipe("y").getVar("FOO", True), "no")
+        self.assertEqual(self.recipe("y").getVar("FOO", True), "no")
+        self.assertEqual(self.cache.stats(), (1, 1, 1, 0))
+
+    def test_references(self):
+        d = self.recipe("x")
+        d.getVar("FOO", True)
+        varparse = self.recipe("x").expandWithRefs(d.getVar("FOO", False), "FOO")
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(varparse.contains, {"FEATURES": set(["x"])})
+
+    def test_uncacheable(self):
+        for i in range(2):
+            d = bb.data.init()
+            d.setVar("FOO", "${@os.getpid()}")
+            d.setVar("BAR", "${@d.setVar('BAZ', 'baz')}")
+            d.getVar("FOO", True)
+            d.getVar("BAR", True)
+            self.assertEqual(d.getVar("BAZ", True), "baz")
+        self.assertEqual(self.cache.stats(), (0, 0, 4, 4))
+
+class TestExpansionCacheFuncs(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.origcache = bb.data_smart.expansioncache
+        self.cache = bb.data_smart.expansioncache = bb.data_smart.ExpansionCache()
+        self.config = bb.data.init()
+        self.config.setVar("PERSISTENT_DIR", self.tempdir)
+
+    def tearDown(self):
+        bb.data_smart.expansioncache = self.origcache
+        shutil.rmtree(self.tempdir)
+
+    def expand(self, expression):
+        d = bb.data.init()
+        d.setVar("FOO", expression)
+        return d.getVar("FOO", True)
+
+    def test_removed_function(self):
+        self.config.setVar("BB_EXPANSION_CACHE_FUNCS", "os.getcwd")
+        self.cache.init_cache(self.config)
+        self.expand("${@os.getcwd()}")
+        self.expand("${@os.getcwd()}")
+        self.assertEqual(self.cache.stats(), (1, 0, 1, 0))
+
+        # Reparsing the configuration without it stops the caching, and
+        # the result cached earlier isn't used any more
+        self.config.delVar("BB_EXPANSION_CACHE_FUNCS")
+        self.cache.init_cache(self.config)
+        self.assertNotIn("os.getcwd", bb.data_smart.cacheable_calls)
+        self.expand("${@os.getcwd()}")
+        self.assertEqual(self.cache.stats(), (1, 1, 1, 1))
+
+    def parse(self, *expressions):
+        cache = bb.data_smart.expansioncache = bb.data_smart.ExpansionCache()
+        cache.max_unused_runs = 2
+        cache.init_cache(self.config)
+        for expression in expressions:
+            self.expand(expression)
+        cache.save_extras()
+        cache.save_merge()
+        return cache
+
+    def test_unused_dropped(self):
+        cache = self.parse("${@'a'.upper()}", "${@'b'.upper()}")
+        self.assertEqual(len(cache.cachedata[0]), 2)
+
+        # Parses which don't use 'a' keep it for a while, in case they
+        # only covered the recipes which changed
+        cache = self.parse("${@'b'.upper()}")
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(len(cache.cachedata[0]), 2)
+        cache = self.parse("${@'b'.upper()}")
+        self.assertEqual(len(cache.cachedata[0]), 2)
+        cache = self.parse("${@'b'.upper()}")
+        self.assertEqual(len(cache.cachedata[0]), 1)
+
+        # Using it resets the count
+        cache = self.parse("${@'a'.upper()}", "${@'b'.upper()}")
+        cache = self.parse("${@'a'.upper()}")
+        cache = self.parse("${@'a'.upper()}")
+        cache = self.parse("${@'b'.upper()}")
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(len(cache.cachedata[0]), 2)
+
+        # One which parses nothing keeps everything
+        cache = bb.data_smart.ExpansionCache()
+        cache.init_cache(self.config)
+        cache.save_merge()
+        cache = bb.data_smart.ExpansionCache()
+        cache.init_cache(self.config)
+        self.assertEqual(len(cache.cachedata[0]), 2)
 
 class Contains(unittest.TestCase):
     def setUp(self):
@@ -444,3 +634,143 @@ class Contains(unittest.TestCase):
 
         self.assertFalse(bb.utils.contains_any("SOMEFLAG", "x", True, False, self.d))
         self.assertFalse(bb.utils.contains_any("SOMEFLAG", "x y z", True, False, self.d))
+
+class TestHashComponents(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("FOO", "foo")
+        self.d.setVar("BAR", "bar")
+        self.d.setVarFlag("BAR", "doc", "some bar")
+
+    def test_value_change(self):
+        structure, digests = self.d.get_hash_components()
+        self.assertEqual(sorted(digests), ["BAR", "FOO"])
+        self.d.setVar("FOO", "foo2")
+        structure2, digests2 = self.d.get_hash_components()
+        self.assertEqual(structure, structure2)
+        self.assertNotEqual(digests["FOO"], digests2["FOO"])
+        self.assertEqual(digests["BAR"], digests2["BAR"])
+
+    def test_flag_change(self):
+        structure, digests = self.d.get_hash_components()
+        self.d.setVarFlag("BAR", "doc", "other bar")
+        structure2, digests2 = self.d.get_hash_components()
+        self.assertEqual(structure, structure2)
+        self.assertNotEqual(digests["BAR"], digests2["BAR"])
+
+    def test_new_variable(self):
+        structure, digests = self.d.get_hash_components()
+        self.d.setVar("BAZ", "baz")
+        structure2, digests2 = self.d.get_hash_components()
+        self.assertNotEqual(structure, structure2)
+
+    def test_python_method(self):
+        self.d.setVar("do_foo", "def do_foo(d):\n    pass")
+        self.d.setVarFlag("do_foo", "python", 1)
+        structure, digests = self.d.get_hash_components()
+        self.assertNotIn("do_foo", digests)
+        self.d.setVar("do_foo", "def do_foo(d):\n    return")
+        structure2, digests2 = self.d.get_hash_components()
+        self.assertNotEqual(structure, structure2)
+
+    def test_whitelist(self):
+        self.d.setVar("BB_HASHCONFIG_WHITELIST", "DATE")
+        self.d.setVar("DATE", "20161018")
+        structure, digests = self.d.get_hash_components()
+        self.assertNotIn("DATE", digests)
+        self.d.setVar("DATE", "20161019")
+        self.d.delVar("DATE")
+        self.assertEqual(self.d.get_hash_components(), (structure, digests))
+
+    def test_incremental(self):
+        self.d.get_hash_components()
+        changes = [
+            lambda d: d.setVar("FOO", "foo2"),
+            lambda d: d.setVar("BAZ", "baz"),
+            lambda d: d.setVar("do_foo", "def do_foo(d):\n    pass"),
+            lambda d: d.setVarFlag("do_foo", "python", 1),
+            lambda d: d.setVar("do_foo", "bb.note('foo')"),
+            lambda d: d.delVar("BAZ"),
+            lambda d: d.renameVar("BAR", "BAR2"),
+            lambda d: d.setVar("__BBHANDLERS", ["FOO"]),
+        ]
+        seen = set()
+        for change in changes:
+            change(self.d)
+            components = self.d.get_hash_components()
+            # A copy works its digests out from scratch
+            self.assertEqual(components, self.d.createCopy().get_hash_components())
+            key = (components[0], tuple(sorted(components[1].items())))
+            self.assertNotIn(key, seen)
+            seen.add(key)
+
+    def test_read_tracking(self):
+        tracker = bb.data_smart.VariableReadTracker(self.d)
+        recipe = self.d.createCopy()
+        recipe.readtracker = tracker
+        recipe.setVar("LOCAL", "local")
+        recipe.setVar("RESULT", "${LOCAL} ${BAR}")
+        self.assertEqual(recipe.getVar("RESULT", True), "local bar")
+        self.assertEqual(tracker.reads, set(["BAR"]))
+
+class TestConfigHash(unittest.TestCase):
+    def full_hash(self, d):
+        # What get_hash() computed before it was made incremental
+        _, _, data = d._get_hash_data()
+        return hashlib.md5(str([(k, data[k]) for k in sorted(data.keys())])).hexdigest()
+
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("BB_HASHCONFIG_WHITELIST", "DATE")
+        self.d.setVar("OVERRIDES", "foo")
+        self.d.setVar("FOO", "foo")
+        self.d.setVar("BAR", "bar")
+        self.d.setVarFlag("BAR", "doc", "some bar")
+
+    def test_equivalence(self):
+        changes = [
+            lambda d: d.setVar("FOO", "foo2"),
+            lambda d: d.setVar("FOO", "foo"),
+            lambda d: d.setVarFlag("BAR", "doc", "other bar"),
+            lambda d: d.setVar("BAZ", "baz"),
+            lambda d: d.setVar("DATE", "20161018"),
+            lambda d: d.appendVar("FOO", " more"),
+            lambda d: d.setVar("FOO_foo", "overridden"),
+            lambda d: d.setVar("BAR_remove", "bar"),
+            lambda d: d.delVarFlag("BAR", "doc"),
+            lambda d: d.delVar("BAZ"),
+            lambda d: d.setVar("OVERRIDES", "bar"),
+            lambda d: d.setVar("__BBTASKS", ["do_build"]),
+            lambda d: d.renameVar("BAR", "BAR2"),
+            lambda d: d.setVarFlags("FOO", {"doc": "foo", "export": "1"}),
+            lambda d: d.delVarFlags("FOO"),
+        ]
+        seen = {}
+        for change in changes:
+            change(self.d)
+            for datastore in (self.d, self.d.createCopy()):
+                fullhash = self.full_hash(datastore)
+                confighash = datastore.get_hash()
+                self.assertEqual(seen.setdefault(fullhash, confighash), confighash)
+        self.assertEqual(len(seen), len(set(seen.values())))
+
+    def test_order(self):
+        d = bb.data.init()
+        d.setVarFlag("BAR", "doc", "some bar")
+        d.setVar("BAR", "bar")
+        d.setVar("FOO", "foo")
+        d.setVar("OVERRIDES", "foo")
+        d.setVar("BB_HASHCONFIG_WHITELIST", "DATE")
+        self.assertEqual(self.d.get_hash(), d.get_hash())
+
+    def test_copy(self):
+        confighash = self.d.get_hash()
+        recipe = self.d.createCopy()
+        self.assertEqual(recipe.get_hash(), confighash)
+        recipe.setVar("FOO", "foo2")
+        self.assertNotEqual(recipe.get_hash(), confighash)
+        self.assertEqual(self.d.get_hash(), confighash)
+        self.d.setVar("FOO", "foo2")
+        self.assertEqual(recipe.get_hash(), self.d.get_hash())
+        self.d.setVar("BAR", "bar2")
+        self.assertEqual(recipe.get_hash(), self.d.get_hash())
@@ -0,0 +1,160 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for event.py
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import unittest
+import threading
+import time
+import bb
+import bb.data
+import bb.event
+import bb.methodpool
+import bb.server.process
+
+class TestEvent(bb.event.Event):
+    pass
+
+class OtherEvent(bb.event.Event):
+    pass
+
+class ClassHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.handlers = bb.event.get_class_handlers()
+        self.catchall = bb.event._catchall_handlers.copy()
+        self.handlermap = bb.event._event_handler_map.copy()
+        bb.event.set_class_handlers(bb.event.clean_class_handlers())
+        self.d = bb.data.init()
+        self.fired = []
+
+    def tearDown(self):
+        bb.event.set_class_handlers(self.handlers)
+        bb.event._catchall_handlers = self.catchall
+        bb.event._event_handler_map = self.handlermap
+
+    def handler(self, name):
+        def handler(e):
+            self.fired.append((name, e.__class__.__name__))
+        return handler
+
+    def fire(self, *events):
+        self.fired = []
+        for event in events:
+            bb.event.fire_class_handlers(event, self.d)
+        return self.fired
+
+    def test_mask(self):
+        testevent = "%s.%s" % (__name__, "TestEvent")
+        bb.event.register("test_all", self.handler("all"))
+        bb.event.register("test_masked", self.handler("masked"), [testevent])
+        self.assertEqual(self.fire(TestEvent(), OtherEvent()),
+                         [("all", "TestEvent"), ("masked", "TestEvent"), ("all", "OtherEvent")])
+
+    def test_changes(self):
+        testevent = "%s.%s" % (__name__, "TestEvent")
+        bb.event.register("test_first", self.handler("first"), [testevent])
+        self.assertEqual(self.fire(TestEvent()), [("first", "TestEvent")])
+
+        bb.event.register("test_second", self.handler("second"), ["*"])
+        self.assertEqual(self.fire(TestEvent()), [("first", "TestEvent"), ("second", "TestEvent")])
+
+        bb.event.remove("test_first", None)
+        self.assertEqual(self.fire(TestEvent()), [("second", "TestEvent")])
+
+        bb.event.set_class_handlers(bb.event.clean_class_handlers())
+        self.assertEqual(self.fire(TestEvent()), [])
+
+    def test_string_handler(self):
+        bb.event.register("test_string", "    e.data.setVar('FIRED', e.__class__.__name__)",
+                          ["%s.%s" % (__name__, "OtherEvent")])
+        self.fire(TestEvent())
+        self.assertEqual(self.d.getVar("FIRED", False), None)
+        self.fire(OtherEvent())
+        self.assertEqual(self.d.getVar("FIRED", False), "OtherEvent")
+
+class ListQueue(list):
+    def put(self, item):
+        self.append(item)
+
+    def qsize(self):
+        return len(self)
+
+class EventAdapterTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = ListQueue()
+        self.adapter = bb.server.process.EventAdapter(self.queue)
+        self.adapter.pid = os.getpid()
+        self.adapter.batchsize = 3
+
+    def test_batches(self):
+        for i in range(7):
+            self.adapter.send(i)
+        self.assertEqual(self.queue, [[0, 1, 2], [3, 4, 5]])
+        self.adapter.flush()
+        self.assertEqual(self.queue, [[0, 1, 2], [3, 4, 5], [6]])
+        stats = self.adapter.stats()
+        self.assertEqual((stats["events"], stats["batches"], stats["pending"]), (7, 3, 0))
+
+    def test_forked(self):
+        # Processes forked from the server don't batch
+        self.adapter.pid = None
+        self.adapter.send(0)
+        self.assertEqual(self.queue, [0])
+
+    def test_latency(self):
+        self.adapter.start()
+        try:
+            self.adapter.send(0)
+            self.assertEqual(self.queue, [])
+            timeout = time.time() + 5
+            while not self.queue and time.time() < timeout:
+                time.sleep(0.01)
+            self.assertEqual(self.queue, [[0]])
+        finally:
+            self.adapter.stop()
+
+    def test_reentrant(self):
+        # As when a signal handler fires an event during a put
+        adapter = self.adapter
+        class ReenteringQueue(ListQueue):
+            def put(self, item):
+                if item == [0, 1, 2]:
+                    for i in range(3, 6):
+                        adapter.send(i)
+                self.append(item)
+        queue = adapter.queue = ReenteringQueue()
+        def send():
+            for i in range(3):
+                adapter.send(i)
+        thread = threading.Thread(target=send)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(queue, [[0, 1, 2]])
+        adapter.flush()
+        self.assertEqual(queue, [[0, 1, 2], [3, 4, 5]])
+
+class ProcessEventQueueTest(unittest.TestCase):
+    def test_receive(self):
+        queue = bb.server.process.ProcessEventQueue(0)
+        queue.put([0, 1, 2])
+        queue.put(3)
+        queue.put([4])
+        self.assertEqual([queue.receive(True, 5) for i in range(5)], [0, 1, 2, 3, 4])
+        self.assertRaises(bb.server.process.Empty, queue.receive, False)
@@ -23,6 +23,12 @@ import unittest
 import tempfile
 import subprocess
 import os
+import time
+import hashlib
+import threading
+import SocketServer
+import BaseHTTPServer
+import SimpleHTTPServer
 from bb.fetch2 import URI
 from bb.fetch2 import FetchMethod
 import bb
@@ -810,3 +816,166 @@ class FetchCheckStatusTest(FetcherTest):
                 self.assertTrue(ret, msg="URI %s, can't check status" % (u))
 
             connection_cache.close_connections()
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An http server for a directory, counting the requests and connections
+    it gets and how many of them it serves at once
+    """
+    daemon_threads = True
+
+    def __init__(self, root, delay = 0):
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+                with server.lock:
+                    server.connections += 1
+
+            def translate_path(self, path):
+                return os.path.join(root, path.split("?")[0].lstrip("/"))
+
+            def do_GET(self):
+                with server.lock:
+                    server.downloads.append(self.path)
+                SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+            def do_HEAD(self):
+                with server.lock:
+                    server.requests.append(self.path)
+                    server.active += 1
+                    server.maxactive = max(server.active, server.maxactive)
+                time.sleep(delay)
+                with server.lock:
+                    server.active -= 1
+                SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = self
+        self.lock = threading.Lock()
+        self.requests = []
+        self.downloads = []
+        self.connections = 0
+        self.active = 0
+        self.maxactive = 0
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d/%s" % (self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class MirrorServerTest(FetcherTest):
+    def setUp(self):
+        FetcherTest.setUp(self)
+        self.noproxy = os.environ.get("no_proxy")
+        os.environ["no_proxy"] = "127.0.0.1"
+        self.root = os.path.join(self.tempdir, "www")
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.stop()
+        if self.noproxy is None:
+            del os.environ["no_proxy"]
+        else:
+            os.environ["no_proxy"] = self.noproxy
+        FetcherTest.tearDown(self)
+
+    def addfile(self, name, content = ""):
+        bb.utils.mkdirhier(os.path.dirname(os.path.join(self.root, name)))
+        with open(os.path.join(self.root, name), "w") as f:
+            f.write(content)
+
+class FetchProbeTest(MirrorServerTest):
+    def setUp(self):
+        MirrorServerTest.setUp(self)
+        for name in ("upstream/a.tar.gz", "mirror1/b.tar.gz", "mirror2/b.tar.gz", "mirror2/c.tar.gz"):
+            self.addfile(name)
+
+    def mirrors(self, *dirs):
+        return "".join("%s %s \\n" % (self.server.url("upstream/.*"), self.server.url(d + "/"))
+                       for d in dirs)
+
+    def test_premirrors(self):
+        self.server = MirrorServer(self.root)
+        self.d.setVar("PREMIRRORS", self.mirrors("mirror1", "mirror2"))
+        urls = [self.server.url("upstream/%s.tar.gz" % name) for name in ("a", "b", "c")]
+        bb.fetch2.Fetch(urls, self.d).checkstatus()
+        with self.assertRaises(bb.fetch2.FetchError):
+            bb.fetch2.Fetch([self.server.url("upstream/d.tar.gz")], self.d).checkstatus()
+
+    def test_first_success(self):
+        # mirror1 has the file, the checks on mirror2 and upstream queued
+        # behind it aren't made
+        self.server = MirrorServer(self.root)
+        self.d.setVar("BB_FETCH_CHECK_HOST_THREADS", "1")
+        self.d.setVar("PREMIRRORS", self.mirrors("mirror1", "mirror2"))
+        bb.fetch2.Fetch([self.server.url("upstream/b.tar.gz")], self.d).checkstatus()
+        self.assertEqual(self.server.requests, ["/mirror1/b.tar.gz"])
+
+    def test_host_threads(self):
+        self.server = MirrorServer(self.root, 0.2)
+        self.d.setVar("BB_FETCH_CHECK_HOST_THREADS", "2")
+        urls = [self.server.url("upstream/a.tar.gz;name=%d" % i) for i in xrange(8)]
+        bb.fetch2.Fetch(urls, self.d).checkstatus()
+        self.assertEqual(len(self.server.requests), 8)
+        self.assertEqual(self.server.maxactive, 2)
+        # Each of the two threads used keeps its connection
+        self.assertEqual(self.server.connections, 2)
+
+class FetchContentStoreTest(MirrorServerTest):
+    def setUp(self):
+        MirrorServerTest.setUp(self)
+        self.addfile("upstream/a.tar.gz", "some content")
+        self.addfile("upstream/b.tar.gz", "some content")
+        self.addfile("upstream/c.tar.gz", "other content")
+        self.sha256 = hashlib.sha256("some content").hexdigest()
+        self.store = os.path.join(self.tempdir, "store")
+        self.d.setVar("BB_FETCH_CONTENT_STORE", self.store)
+        self.server = MirrorServer(self.root)
+
+    def storepath(self, sha256):
+        return os.path.join(self.store, "sha256", sha256[:2], sha256)
+
+    def download(self, name, sha256 = None):
+        url = self.server.url("upstream/" + name)
+        if sha256:
+            url += ";sha256sum=" + sha256
+        fetcher = bb.fetch2.Fetch([url], self.d)
+        fetcher.download()
+        return fetcher.localpath(url)
+
+    def test_store_hit(self):
+        localpath = self.download("a.tar.gz", self.sha256)
+        self.assertTrue(os.path.samefile(localpath, self.storepath(self.sha256)))
+
+        # Found by its checksum under another name without going to the network
+        self.d.setVar("BB_NO_NETWORK", "1")
+        localpath = self.download("renamed.tar.gz", self.sha256)
+        self.assertTrue(os.path.samefile(localpath, self.storepath(self.sha256)))
+        self.assertTrue(os.path.exists(localpath + ".done"))
+        self.assertEqual(self.server.downloads, ["/upstream/a.tar.gz"])
+
+    def test_dedup(self):
+        first = self.download("a.tar.gz")
+        second = self.download("b.tar.gz")
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertTrue(os.path.samefile(first, self.storepath(self.sha256)))
+        third = self.download("c.tar.gz")
+        self.assertFalse(os.path.samefile(first, third))
+
+    def test_store_miss(self):
+        self.download("a.tar.gz", self.sha256)
+        sha256 = hashlib.sha256("other content").hexdigest()
+        localpath = self.download("c.tar.gz", sha256)
+        self.assertTrue(os.path.samefile(localpath, self.storepath(sha256)))
+        self.assertEqual(self.server.downloads, ["/upstream/a.tar.gz", "/upstream/c.tar.gz"])
@@ -0,0 +1,128 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for persist_data.py
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import shutil
+import threading
+import os
+import bb
+import bb.persist_data
+
+class PersistDataTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.d = bb.data.init()
+        self.d.setVar("PERSISTENT_DIR", self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def persist(self):
+        return bb.persist_data.persist("BB_TEST", self.d)
+
+    def in_thread(self, func):
+        """Run func in another thread, which has a connection of its own"""
+        result = []
+        t = threading.Thread(target = lambda: result.append(func()))
+        t.start()
+        t.join()
+        return result[0]
+
+    def test_mapping(self):
+        table = self.persist()
+        table["a"] = "1"
+        table["b"] = "2"
+        table["a"] = "3"
+        self.assertEqual(table["a"], "3")
+        self.assertIn("b", table)
+        self.assertNotIn("c", table)
+        self.assertRaises(KeyError, lambda: table["c"])
+        self.assertRaises(TypeError, table.__setitem__, "c", 1)
+        self.assertEqual(sorted(table.items()), [("a", "3"), ("b", "2")])
+        self.assertEqual(len(table), 2)
+        del table["b"]
+        self.assertRaises(KeyError, table.__delitem__, "b")
+        self.assertEqual(sorted(self.persist().items()), [("a", "3")])
+        table.clear()
+        self.assertEqual(len(table), 0)
+        self.assertRaises(KeyError, lambda: table["a"])
+
+    def test_shared_connection(self):
+        self.assertIs(self.persist().connection, self.persist().connection)
+        self.assertIsNot(self.persist().connection, self.in_thread(lambda: self.persist().connection))
+
+    def journal_mode(self):
+        return self.persist().connection.execute("pragma journal_mode;").fetchone()[0].lower()
+
+    def test_journal_mode(self):
+        self.assertEqual(self.journal_mode(), "delete")
+
+    def test_wal(self):
+        self.d.setVar("BB_PERSIST_WAL", "1")
+        self.assertEqual(self.journal_mode(), "wal")
+
+    def test_wal_unavailable(self):
+        # Databases which can't use it keep their journal
+        connection = bb.persist_data.connect(":memory:", True)
+        self.assertEqual(connection.execute("pragma journal_mode;").fetchone()[0].lower(), "memory")
+
+    def test_transaction(self):
+        table = self.persist()
+        with table:
+            table["a"] = "1"
+            with self.persist() as inner:
+                inner["b"] = "2"
+            self.assertEqual(self.in_thread(lambda: self.persist().items()), [])
+        self.assertEqual(sorted(self.in_thread(lambda: self.persist().items())), [("a", "1"), ("b", "2")])
+
+        try:
+            with table:
+                table["a"] = "3"
+                table["c"] = "4"
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(table["a"], "1")
+        self.assertNotIn("c", table)
+
+        table.update({"c": "5", "d": "6"})
+        self.assertEqual(len(self.in_thread(lambda: self.persist().items())), 4)
+
+    def test_changed_elsewhere(self):
+        table = self.persist()
+        table["a"] = "1"
+        self.assertEqual(table["a"], "1")
+
+        def change():
+            table = self.persist()
+            table["a"] = "2"
+            del table["a"]
+            table["a"] = "3"
+        self.in_thread(change)
+        self.assertEqual(table["a"], "3")
+
+        pid = os.fork()
+        if not pid:
+            try:
+                self.persist()["a"] = "4"
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(table["a"], "4")
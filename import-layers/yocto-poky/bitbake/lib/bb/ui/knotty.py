@@ -194,7 +194,7 @@ class TerminalFilter(object):
         activetasks = self.helper.running_tasks
         failedtasks = self.helper.failed_tasks
         runningpids = self.helper.running_pids
-        if self.footer_present and (self.lastcount == self.helper.tasknumber_current) and (self.lastpids == runningpids):
+        if self.footer_present and (self.lastcount == self.helper.tasknumber_current) and (self.lastpids == runningpids) and not self.helper.needUpdate:
             return
         if self.footer_present:
             self.clearFooter()
@@ -202,7 +202,10 @@ class TerminalFilter(object):
             return
         tasks = []
         for t in runningpids:
-            tasks.append("%s (pid %s)" % (activetasks[t]["title"], t))
+            task = "%s (pid %s)" % (activetasks[t]["title"], t)
+            if activetasks[t].get("progress"):
+                task = "%s: %s" % (task, activetasks[t]["progress"])
+            tasks.append(task)
 
         if self.main.shutdown:
             content = "Waiting for %s running tasks to finish:" % len(activetasks)
@@ -219,12 +222,51 @@ class TerminalFilter(object):
         self.footer_present = lines
         self.lastpids = runningpids[:]
         self.lastcount = self.helper.tasknumber_current
+        self.helper.needUpdate = False
 
     def finish(self):
         if self.stdinbackup:
             fd = sys.stdin.fileno()
             self.termios.tcsetattr(fd, self.termios.TCSADRAIN, self.stdinbackup)
 
+class TaskLogTail(object):
+    """
+    Show what the tasks write to their log files, reading the files rather
+    than having the output passed on to the UI
+    """
+    def __init__(self):
+        self.tails = {}
+
+    def event(self, event):
+        if isinstance(event, bb.build.TaskStarted) and event.logfile:
+            try:
+                self.tails[event.pid] = ["%s %s" % (event._package, event._task), open(event.logfile, 'r'), '']
+            except IOError:
+                # Not on this machine
+                pass
+        elif isinstance(event, (bb.build.TaskSucceeded, bb.build.TaskFailed, bb.build.TaskFailedSilent)):
+            if event.pid in self.tails:
+                self.read(event.pid, True)
+
+    def update(self):
+        for pid in list(self.tails):
+            self.read(pid)
+
+    def read(self, pid, finished = False):
+        tail = self.tails[pid]
+        title, f, partial = tail
+        data = partial + f.read()
+        if finished:
+            end = len(data)
+        else:
+            end = data.rfind('\n') + 1
+        if end:
+            logger.plain('\n'.join('%s: %s' % (title, line) for line in data[:end].splitlines()))
+        tail[2] = data[end:]
+        if finished:
+            f.close()
+            del self.tails[pid]
+
 def _log_settings_from_server(server):
     # Get values of variables which control our output
     includelogs, error = server.runCommand(["getVariable", "BBINCLUDELOGS"])
@@ -248,7 +290,8 @@ _evt_list = [ "bb.runqueue.runQueueExitWait", "bb.event.LogExecTTY", "logging.Lo
               "bb.command.CommandExit", "bb.command.CommandCompleted",  "bb.cooker.CookerExit",
               "bb.event.MultipleProviders", "bb.event.NoProvider", "bb.runqueue.sceneQueueTaskStarted",
               "bb.runqueue.runQueueTaskStarted", "bb.runqueue.runQueueTaskFailed", "bb.runqueue.sceneQueueTaskFailed",
-              "bb.event.BuildBase", "bb.build.TaskStarted", "bb.build.TaskSucceeded", "bb.build.TaskFailedSilent"]
+              "bb.event.BuildBase", "bb.build.TaskStarted", "bb.build.TaskSucceeded", "bb.build.TaskFailedSilent",
+              "bb.build.TaskProgress"]
 
 def main(server, eventHandler, params, tf = TerminalFilter):
 
@@ -289,6 +332,12 @@ def main(server, eventHandler, params, tf = TerminalFilter):
     llevel, debug_domains = bb.msg.constructLogOptions()
     server.runCommand(["setEventMask", server.getEventHandle(), llevel, debug_domains, _evt_list])
 
+    taskoutput, error = server.runCommand(["getVariable", "BB_TASK_OUTPUT"])
+    if taskoutput == "tail":
+        logtail = TaskLogTail()
+    else:
+        logtail = None
+
     universe = False
     if not params.observe_only:
         params.updateFromServer(server)
@@ -330,11 +379,15 @@ def main(server, eventHandler, params, tf = TerminalFilter):
             if event is None:
                 if main.shutdown > 1:
                     break
+                if logtail:
+                    logtail.update()
                 termfilter.updateFooter()
                 event = eventHandler.waitEvent(0.25)
                 if event is None:
                     continue
             helper.eventHandler(event)
+            if logtail:
+                logtail.event(event)
             if isinstance(event, bb.runqueue.runQueueExitWait):
                 if not main.shutdown:
                     main.shutdown = 1
@@ -516,6 +569,9 @@ def main(server, eventHandler, params, tf = TerminalFilter):
             if isinstance(event, bb.event.DepTreeGenerated):
                 continue
 
+            if isinstance(event, bb.build.TaskProgress):
+                continue
+
             # ignore
             if isinstance(event, (bb.event.BuildBase,
                                   bb.event.MetadataEvent,
@@ -514,8 +514,8 @@ def md5_file(filename):
         m = md5.new()
 
     with open(filename, "rb") as f:
-        for line in f:
-            m.update(line)
+        for block in iter(lambda: f.read(65536), ""):
+            m.update(block)
     return m.hexdigest()
 
 def sha256_file(filename):
@@ -1,5 +1,5 @@
 import os,sys,logging
-import signal, time
+import signal, time, select
 from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 import threading
 import Queue
@@ -23,9 +23,30 @@ if sys.hexversion < 0x020600F0:
     sys.exit(1)
 
 class Handler(SimpleXMLRPCRequestHandler):
+    # Let clients keep their connection for several calls
+    protocol_version = "HTTP/1.1"
+    # Don't let a client stalling in the middle of a request hold up a
+    # handler thread for good
+    timeout = 30
+
+    def handle(self):
+        # Handle requests as long as the client sends them one after the
+        # other and no other client waits for a handler thread. The server
+        # waits for the next request on the connection otherwise, without
+        # holding up a handler thread
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self.server.requestqueue.empty() and \
+                select.select([self.connection], [], [], self.server.keepalive_wait)[0]:
+            self.handle_one_request()
+
     def _dispatch(self,method,params):
         try:
-            value=self.server.funcs[method](*params)
+            # Calls are serialized on the database, and anything they
+            # changed is committed before the client gets the result
+            with self.server.dblock:
+                value=self.server.funcs[method](*params)
+                self.server.table.sync_if_dirty()
         except:
             import traceback
             traceback.print_exc()
@@ -37,10 +58,13 @@ singleton = None
 
 
 class PRServer(SimpleXMLRPCServer):
+    # Many tasks may connect at once
+    request_queue_size = 64
+
     def __init__(self, dbfile, logfile, interface, daemon=True):
         ''' constructor '''
         try:
-            SimpleXMLRPCServer.__init__(self, interface,
+            SimpleXMLRPCServer.__init__(self, interface, requestHandler=Handler,
                                         logRequests=False, allow_none=True)
         except socket.error:
             ip=socket.gethostbyname(interface[0])
@@ -57,6 +81,7 @@ class PRServer(SimpleXMLRPCServer):
         self.pidfile=PIDPREFIX % (self.host, self.port)
 
         self.register_function(self.getPR, "getPR")
+        self.register_function(self.getPRs, "getPRs")
         self.register_function(self.quit, "quit")
         self.register_function(self.ping, "ping")
         self.register_function(self.export, "export")
@@ -64,39 +89,88 @@ class PRServer(SimpleXMLRPCServer):
         self.register_function(self.importone, "importone")
         self.register_introspection_functions()
 
+        # Requests are read and answered by a pool of handler threads while
+        # the main loop accepts connections and waits for the next request
+        # on the idle ones
         self.requestqueue = Queue.Queue()
-        self.handlerthread = threading.Thread(target = self.process_request_thread)
-        self.handlerthread.daemon = False
+        self.idlequeue = Queue.Queue()
+        self.idle = {}
+        self.dblock = threading.Lock()
+        self.handlerthreads = []
+        for i in range(self.handler_threads):
+            t = threading.Thread(target = self.process_request_thread)
+            t.daemon = False
+            self.handlerthreads.append(t)
+
+    # Number of threads handling requests
+    handler_threads = 4
+    # Seconds a handler thread waits for the next request on a connection
+    # before leaving it to the main loop
+    keepalive_wait = 0.05
+    # Seconds a client connection may stay idle before the server closes it
+    idle_timeout = 60
 
     def process_request_thread(self):
         """Same as in BaseServer but as a thread.
 
-        In addition, exception handling is done here.
+        In addition, exception handling is done here, and the connection
+        is handed back to the main loop if the client keeps it alive.
 
         """
-        iter_count = 1
-        # 60 iterations between syncs or sync if dirty every ~30 seconds
-        iterations_between_sync = 60
-
         bb.utils.set_process_name("PRServ Handler")
 
         while not self.quit:
             try:
-                (request, client_address) = self.requestqueue.get(True, 30)
+                (request, client_address) = self.requestqueue.get(True, 0.5)
             except Queue.Empty:
-                self.table.sync_if_dirty()
                 continue
             try:
-                self.finish_request(request, client_address)
-                self.shutdown_request(request)
-                iter_count = (iter_count + 1) % iterations_between_sync
-                if iter_count == 0:
-                    self.table.sync_if_dirty()
+                if self.finish_request(request, client_address):
+                    self.idlequeue.put((request, client_address))
+                    os.write(self.wakeup[1], "1")
+                else:
+                    self.shutdown_request(request)
             except:
                 self.handle_error(request, client_address)
                 self.shutdown_request(request)
-                self.table.sync()
-            self.table.sync_if_dirty()
+                with self.dblock:
+                    self.table.sync()
+
+    def finish_request(self, request, client_address):
+        """Handle a request, returning whether the connection is kept alive"""
+        return not self.RequestHandlerClass(request, client_address, self).close_connection
+
+    def wait_for_requests(self):
+        """Accept connections and queue the idle ones on which the next
+        request arrived for the handler threads"""
+        while True:
+            try:
+                request, client_address = self.idlequeue.get(False)
+            except Queue.Empty:
+                break
+            self.idle[request] = (client_address, time.time())
+
+        try:
+            readable, _, _ = select.select([self.socket, self.wakeup[0]] + self.idle.keys(), [], [], self.timeout)
+        except select.error as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            return
+
+        for r in readable:
+            if r is self.socket:
+                self._handle_request_noblock()
+            elif r is self.wakeup[0]:
+                os.read(self.wakeup[0], 4096)
+            else:
+                client_address, _ = self.idle.pop(r)
+                self.process_request(r, client_address)
+
+        expired = time.time() - self.idle_timeout
+        for request, (client_address, idlesince) in self.idle.items():
+            if idlesince < expired:
+                del self.idle[request]
+                self.shutdown_request(request)
 
     def sigint_handler(self, signum, stack):
         if self.table:
@@ -156,6 +230,13 @@ class PRServer(SimpleXMLRPCServer):
             logger.error(str(exc))
             return None
 
+    def getPRs(self, queries):
+        """
+        Same as getPR for each (version, pkgarch, checksum) in queries, in
+        a single call and committed together
+        """
+        return [self.getPR(version, pkgarch, checksum) for version, pkgarch, checksum in queries]
+
     def quit(self):
         self.quit=True
         return
@@ -173,10 +254,15 @@ class PRServer(SimpleXMLRPCServer):
         logger.info("Started PRServer with DBfile: %s, IP: %s, PORT: %s, PID: %s" %
                      (self.dbfile, self.host, self.port, str(os.getpid())))
 
-        self.handlerthread.start()
+        self.wakeup = os.pipe()
+        for t in self.handlerthreads:
+            t.start()
         while not self.quit:
-            self.handle_request()
-        self.handlerthread.join()
+            self.wait_for_requests()
+        for t in self.handlerthreads:
+            t.join()
+        for request in self.idle:
+            self.shutdown_request(request)
         self.db.disconnect()
         logger.info("PRServer: stopping...")
         self.server_close()
@@ -304,6 +390,9 @@ class PRServerConnection(object):
     def getPR(self, version, pkgarch, checksum):
         return self.connection.getPR(version, pkgarch, checksum)
 
+    def getPRs(self, queries):
+        return self.connection.getPRs(queries)
+
     def ping(self):
         return self.connection.ping()
 